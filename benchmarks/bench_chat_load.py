@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Benchmark: streaming chat load and latency
+Drives a streaming chat endpoint and reports time to first token (TTFT),
+inter-token latency (ITL), per-request decode rate and aggregate tokens/s
+at p50/p95/p99, as a table and optionally as JSON for comparing commits.
+
+Targets:
+    llm    POST /v1/chat/completions on the LLM service (OpenAI SSE chunks)
+    app    POST /chat on the app (start/token/end frames)
+    llama  POST /completion on llama-server itself, the baseline without
+           the proxy and its filters
+
+Open loop (--mode open) sends requests at Poisson arrivals of --rate per
+second whatever the server does, and measures latency from the scheduled
+send time, so queueing inside an overloaded server shows up in the tail
+instead of silently lowering the offered load. Closed loop (--mode closed)
+keeps --concurrency requests in flight, each sent when the previous one
+finishes, and finds peak throughput.
+
+--spawn starts the LLM service on fake_llama_server.py with a fixed
+--token-delay-ms and --prompt-ms-per-token, so numbers only move when the
+proxy does; --baseline then runs the same load against the fake directly
+and reports the proxy's overhead. --compare fails (exit 1) if a result is
+worse than an earlier --output file by more than --tolerance.
+
+Usage:
+    python benchmarks/bench_chat_load.py --spawn --baseline --mode open --rate 20 --output bench.json
+    python benchmarks/bench_chat_load.py --spawn --compare bench.json
+    python benchmarks/bench_chat_load.py --target app --url http://127.0.0.1:8000 --mode closed --concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import httpx
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LLM_DIR = os.path.join(ROOT, "services", "llm")
+
+PATHS = {"llm": "/v1/chat/completions", "app": "/chat", "llama": "/completion"}
+TOPICS = ["refund policy", "shipping times", "warranty claims", "opening hours", "password reset", "order tracking"]
+
+# Compared by --compare: (section, statistic, whether higher is better)
+TRACKED = [
+    ("ttft_ms", "p50", False),
+    ("ttft_ms", "p95", False),
+    ("itl_ms", "p50", False),
+    ("itl_ms", "p99", False),
+    ("e2e_ms", "p95", False),
+    ("throughput", "tokens_per_second", True),
+]
+
+
+@dataclass
+class Sample:
+    """Timings of one request, in seconds from its scheduled send time"""
+    status: int = 0
+    error: Optional[str] = None
+    ttft: Optional[float] = None
+    token_times: list[float] = field(default_factory=list)
+    total: float = 0.0
+
+
+def make_prompt(i: int, words: int) -> str:
+    """Unique per request, so neither the response cache nor the KV cache turns requests into hits"""
+    topic = TOPICS[i % len(TOPICS)]
+    filler = " ".join(f"detail{(i * 7 + w) % 97}" for w in range(max(words - 12, 0)))
+    return f"Request {i}: please explain our {topic} in two sentences. {filler}".strip()
+
+
+def request_body(target: str, prompt: str, max_tokens: int) -> dict:
+    if target == "llm":
+        return {"messages": [{"role": "user", "content": prompt}], "stream": True, "max_tokens": max_tokens}
+    if target == "app":
+        return {"message": prompt, "stream": True}
+    return {"prompt": prompt, "stream": True, "n_predict": max_tokens}
+
+
+def parse_event(target: str, data: str) -> tuple[Optional[str], bool, Optional[str]]:
+    """(content, done, error) of one SSE data payload"""
+    if data == "[DONE]":
+        return None, True, None
+    event = json.loads(data)
+    if "error" in event:
+        return None, True, str(event["error"])
+    if target == "llm":
+        choices = event.get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content"), False, None
+    if target == "app":
+        kind = event.get("type")
+        if kind == "error":
+            return None, True, event.get("message", "error")
+        return event.get("content") if kind == "token" else None, kind == "end", None
+    return event.get("content") or None, bool(event.get("stop")), None
+
+
+async def send(client: httpx.AsyncClient, target: str, url: str, body: dict, scheduled: float) -> Sample:
+    sample = Sample()
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            sample.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                sample.error = f"HTTP {response.status_code}"
+                return sample
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                content, done, error = parse_event(target, line[6:])
+                if content:
+                    now = time.perf_counter() - scheduled
+                    if sample.ttft is None:
+                        sample.ttft = now
+                    sample.token_times.append(now)
+                if error:
+                    sample.error = error
+                if done:
+                    break
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        sample.error = repr(e)
+    finally:
+        sample.total = time.perf_counter() - scheduled
+    return sample
+
+
+async def run_load(args, target: str, base_url: str) -> tuple[list[Sample], float]:
+    """Run the configured load against one target; returns the samples and the wall time"""
+    url = base_url.rstrip("/") + PATHS[target]
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(args.timeout, connect=5.0)
+    rng = random.Random(args.seed)
+    samples: list[Sample] = []
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        # Warm the connections and the server's code paths; not measured
+        await asyncio.gather(*(
+            send(client, target, url, request_body(target, make_prompt(-1 - i, args.prompt_words), args.max_tokens),
+                 time.perf_counter())
+            for i in range(args.warmup)
+        ))
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+        counter = iter(range(args.requests or sys.maxsize))
+
+        async def one(i: int, scheduled: float):
+            body = request_body(target, make_prompt(i, args.prompt_words), args.max_tokens)
+            samples.append(await send(client, target, url, body, scheduled))
+
+        if args.mode == "closed":
+            async def worker():
+                for i in counter:
+                    if time.perf_counter() >= deadline:
+                        break
+                    await one(i, time.perf_counter())
+
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        else:
+            tasks = []
+            scheduled = started
+            for i in counter:
+                scheduled += rng.expovariate(args.rate)
+                if scheduled >= deadline:
+                    break
+                await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+                tasks.append(asyncio.create_task(one(i, scheduled)))
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    return samples, elapsed
+
+
+def percentiles(values: list[float], scale: float = 1000.0) -> dict:
+    if not values:
+        return {"count": 0}
+    array = np.array(values) * scale
+    return {
+        "count": len(values),
+        "mean": round(float(array.mean()), 3),
+        "p50": round(float(np.percentile(array, 50)), 3),
+        "p95": round(float(np.percentile(array, 95)), 3),
+        "p99": round(float(np.percentile(array, 99)), 3),
+        "max": round(float(array.max()), 3),
+    }
+
+
+def summarize(samples: list[Sample], elapsed: float) -> dict:
+    ok = [s for s in samples if s.error is None and s.ttft is not None]
+    itl = [b - a for s in ok for a, b in zip(s.token_times, s.token_times[1:])]
+    # Decode rate after the first token, so prompt evaluation does not count against it
+    decode = [(len(s.token_times) - 1) / (s.token_times[-1] - s.ttft) for s in ok if s.token_times[-1] > s.ttft]
+    tokens = sum(len(s.token_times) for s in ok)
+    return {
+        "throughput": {
+            "requests": len(samples),
+            "completed": len(ok),
+            "errors": len(samples) - len(ok),
+            "rejected_429": sum(1 for s in samples if s.status == 429),
+            "duration_s": round(elapsed, 3),
+            "requests_per_second": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+            "tokens_per_second": round(tokens / elapsed, 3) if elapsed else 0.0,
+        },
+        "ttft_ms": percentiles([s.ttft for s in ok]),
+        "itl_ms": percentiles(itl),
+        "e2e_ms": percentiles([s.total for s in ok]),
+        "decode_tokens_per_second": percentiles(decode, scale=1.0),
+        "tokens_per_request": percentiles([len(s.token_times) for s in ok], scale=1.0),
+        "error_samples": sorted({s.error for s in samples if s.error})[:5],
+    }
+
+
+def print_summary(name: str, summary: dict):
+    t = summary["throughput"]
+    print(
+        f"\n[{name}] {t['completed']}/{t['requests']} ok, {t['errors']} errors ({t['rejected_429']} x 429), "
+        f"{t['requests_per_second']:.1f} req/s, {t['tokens_per_second']:.1f} tokens/s over {t['duration_s']:.1f}s"
+    )
+    print(f"  {'':<18} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for key, label in (("ttft_ms", "TTFT ms"), ("itl_ms", "ITL ms"), ("e2e_ms", "end-to-end ms"),
+                       ("decode_tokens_per_second", "decode tokens/s")):
+        stats = summary[key]
+        if stats["count"]:
+            print(f"  {label:<18} {stats['p50']:>9.2f} {stats['p95']:>9.2f} {stats['p99']:>9.2f} {stats['max']:>9.2f}")
+    for error in summary["error_samples"]:
+        print(f"  error: {error}")
+
+
+def overhead(proxied: dict, direct: dict) -> dict:
+    """What the proxy adds on top of llama-server, per percentile"""
+    result = {}
+    for key in ("ttft_ms", "itl_ms", "e2e_ms"):
+        if proxied[key]["count"] and direct[key]["count"]:
+            result[key] = {p: round(proxied[key][p] - direct[key][p], 3) for p in ("p50", "p95", "p99")}
+    return result
+
+
+def compare(report: dict, previous: dict, tolerance: float) -> list[str]:
+    """Regressions against an earlier report, beyond tolerance (a fraction)"""
+    regressions = []
+    for target, summary in report["results"].items():
+        before = previous.get("results", {}).get(target)
+        if before is None:
+            continue
+        for section, stat, higher_is_better in TRACKED:
+            old, new = before.get(section, {}).get(stat), summary.get(section, {}).get(stat)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{target} {section}.{stat}: {old:.2f} -> {new:.2f} ({change:+.1%})")
+    return regressions
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_llm_service(args) -> tuple[subprocess.Popen, str, str]:
+    """Start the LLM service on the fake llama-server; returns the process and both base URLs"""
+    port, llama_port = args.port or free_port(), free_port()
+    model = tempfile.NamedTemporaryFile(suffix=".gguf", delete=False)
+    model.close()
+    env = {
+        **os.environ,
+        "MODEL_PATH": model.name,
+        "LLAMA_SERVER_BIN": f"{sys.executable} fake_llama_server.py",
+        "LLAMA_BASE_PORT": str(llama_port),
+        "LLAMA_INSTANCES": "1",
+        # The fake serves any number of requests at once; let admission control do the same
+        "LLAMA_PARALLEL": str(args.slots),
+        "FAKE_TOKEN_DELAY": str(args.token_delay_ms / 1000),
+        "FAKE_PROMPT_MS_PER_TOKEN": str(args.prompt_ms_per_token),
+        "FAKE_REPLY_TOKENS": str(args.reply_tokens),
+    }
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=LLM_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"LLM service exited with {process.returncode}")
+        try:
+            if httpx.get(f"{url}/healthz", timeout=1).json().get("model_loaded"):
+                return process, url, f"http://127.0.0.1:{llama_port}"
+        except (httpx.HTTPError, ValueError):
+            pass
+        time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("LLM service did not become ready within 60s")
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming chat load and latency benchmark")
+    parser.add_argument("--target", choices=sorted(PATHS), default="llm")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of the target")
+    parser.add_argument("--mode", choices=["open", "closed"], default="open")
+    parser.add_argument("--rate", type=float, default=10.0, help="Open loop: mean arrivals per second")
+    parser.add_argument("--concurrency", type=int, default=8, help="Closed loop: requests in flight")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to send requests for")
+    parser.add_argument("--requests", type=int, default=0, help="Stop after this many requests (0: no limit)")
+    parser.add_argument("--warmup", type=int, default=4, help="Unmeasured requests sent first")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--prompt-words", type=int, default=40)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0, help="Seeds the Poisson arrivals")
+    parser.add_argument("--spawn", action="store_true", help="Start the LLM service on fake_llama_server.py")
+    parser.add_argument("--baseline", action="store_true", help="With --spawn, also load the fake directly")
+    parser.add_argument("--port", type=int, default=0, help="With --spawn, LLM service port (default: free)")
+    parser.add_argument("--slots", type=int, default=64, help="With --spawn, LLAMA_PARALLEL")
+    parser.add_argument("--token-delay-ms", type=float, default=20.0, help="With --spawn, fake per-token time")
+    parser.add_argument("--prompt-ms-per-token", type=float, default=0.5, help="With --spawn, fake prompt eval time")
+    parser.add_argument("--reply-tokens", type=int, default=64, help="With --spawn, fake reply length")
+    parser.add_argument("--output", help="Write the report as JSON here")
+    parser.add_argument("--compare", help="Earlier --output report; exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed regression, as a fraction")
+    args = parser.parse_args()
+
+    process = None
+    targets = [(args.target, args.url)]
+    if args.spawn:
+        process, llm_url, llama_url = spawn_llm_service(args)
+        targets = [("llm", llm_url)] + ([("llama", llama_url)] if args.baseline else [])
+        print(f"LLM service at {llm_url}, fake llama-server at {llama_url}")
+
+    load = f"Poisson {args.rate}/s" if args.mode == "open" else f"{args.concurrency} concurrent"
+    print(f"Load: {args.mode} loop, {load}, {args.duration}s, max_tokens {args.max_tokens}")
+    results = {}
+    try:
+        for target, url in targets:
+            samples, elapsed = asyncio.run(run_load(args, target, url))
+            results[target] = summarize(samples, elapsed)
+            print_summary(target, results[target])
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    report = {
+        "benchmark": "chat_load",
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+    if "llm" in results and "llama" in results:
+        report["proxy_overhead_ms"] = overhead(results["llm"], results["llama"])
+        print("\nProxy overhead (llm - llama):")
+        for key, stats in report["proxy_overhead_ms"].items():
+            print(f"  {key:<18} " + ", ".join(f"{p} {v:+.2f}" for p, v in stats.items()))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        changed = [k for k, v in report["config"].items() if previous.get("config", {}).get(k, v) != v]
+        if changed:
+            print(f"\nWarning: settings differ from the compared run ({', '.join(changed)})")
+        regressions = compare(report, previous, args.tolerance)
+        print(f"\nCompared with {previous.get('commit') or args.compare}: "
+              f"{len(regressions) or 'no'} regressions beyond {args.tolerance:.0%}")
+        for regression in regressions:
+            print(f"  {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
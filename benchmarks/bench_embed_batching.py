@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark: dynamic micro-batching of embedding requests
+Drives EmbeddingBatcher with N concurrent single-text callers against a
+deterministic stand-in model whose forward pass costs a fixed overhead
+plus a small per-text cost (the shape of a small transformer on CPU),
+and compares throughput and latency with batching disabled
+(max batch size 1) and enabled.
+
+Callers here are closed-loop (each waits for its result before sending
+the next), so every caller is already queued when a batch starts and
+--max-wait-ms 0 shows the batching that happens for free during forward
+passes; the wait pays off with open-loop, bursty arrivals.
+
+Usage: python benchmarks/bench_embed_batching.py [--requests 2000] [--concurrency 1,8,32,64]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "rag"))
+
+from batcher import EmbeddingBatcher  # noqa: E402
+from embeddings import HashingEmbedder  # noqa: E402
+
+
+class StandInModel(HashingEmbedder):
+    """Hashing embedder that also spends the time a model forward pass would"""
+
+    def __init__(self, overhead_ms: float, per_text_ms: float):
+        super().__init__()
+        self.overhead = overhead_ms / 1000
+        self.per_text = per_text_ms / 1000
+
+    def _embed(self, texts: list[str]) -> np.ndarray:
+        # sleep releases the GIL, like a native forward pass
+        time.sleep(self.overhead + self.per_text * len(texts))
+        return super()._embed(texts)
+
+
+async def run(model, requests: int, concurrency: int, max_batch: int, max_wait_ms: float) -> dict:
+    # Cache off: every text is unique anyway, and the point is the model path
+    batcher = EmbeddingBatcher(model, max_batch_size=max_batch, max_wait_ms=max_wait_ms, cache_size=0)
+    batcher.start()
+    latencies = []
+    counter = iter(range(requests))
+
+    async def worker():
+        for i in counter:
+            start = time.perf_counter()
+            await batcher.embed([f"what is the refund policy for order {i}?"])
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    await batcher.stop()
+    latencies = np.array(latencies) * 1000
+    return {
+        "throughput": requests / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding micro-batching benchmark")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", default="1,8,32,64")
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--overhead-ms", type=float, default=4.0, help="Fixed cost per forward pass")
+    parser.add_argument("--per-text-ms", type=float, default=0.3, help="Added cost per text in a pass")
+    args = parser.parse_args()
+
+    model = StandInModel(args.overhead_ms, args.per_text_ms)
+    print(f"{'callers':>7} {'mode':<10} {'texts/s':>9} {'p50':>9} {'p95':>9}")
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        for mode, max_batch, max_wait in (("unbatched", 1, 0.0), ("batched", args.max_batch, args.max_wait_ms)):
+            result = asyncio.run(run(model, args.requests, concurrency, max_batch, max_wait))
+            print(
+                f"{concurrency:>7} {mode:<10} {result['throughput']:>9.0f} "
+                f"{result['p50_ms']:>7.2f}ms {result['p95_ms']:>7.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Benchmark: SSE frame encoding and token coalescing
+Part 1 encodes a mix of token deltas (words, punctuation, quotes,
+newlines, non-ASCII) with the old per-token json.dumps of the whole chunk
+dict and with the pre-encoded frame template (stdlib escaper, and orjson
+if installed), and reports frames/s and ns per frame.
+
+Part 2 streams --streams concurrent generations of --tokens deltas, one
+every --token-interval-ms, through the framing path of the LLM service
+(optional coalescing, encoding, one os.write per frame to /dev/null as the
+socket write) and reports CPU per token, frames and writes per second,
+and the latency coalescing adds between a token being produced and
+written. CPU includes the simulated token source, the same for every mode.
+
+Usage: python benchmarks/bench_sse_encoding.py [--streams 200] [--tokens 200] [--coalesce 4:10,8:20]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "llm"))
+
+import sse  # noqa: E402
+
+WORDS = [
+    " the", " refund", " policy", ",", " applies", " within", " 30", " days", ".", "\n\n",
+    " \"Yes\"", " café", " naïve", " —", " 日本", " ✓", " order", " #1234", " is", " shipped",
+]
+
+
+def legacy_frame(content: str) -> bytes:
+    """How frames were built before: the whole chunk dict through json.dumps, then encoded"""
+    openai_data = {"choices": [{"delta": {"content": content}}]}
+    return f"data: {json.dumps(openai_data)}\n\n".encode()
+
+
+def template_frame(escape):
+    def frame(content: str) -> bytes:
+        return sse.CONTENT_PREFIX + escape(content) + sse.CONTENT_SUFFIX
+    return frame
+
+
+ENCODERS = {"json.dumps": legacy_frame}
+ENCODERS.update({f"template+{name}": template_frame(escape) for name, escape in sse.ESCAPERS.items()})
+
+
+def bench_encoders(frames: int, batch: int):
+    deltas = [WORDS[i % len(WORDS)] for i in range(frames)]
+    if batch > 1:
+        # Coalesced deltas are longer, which changes which escaper wins
+        deltas = ["".join(deltas[i:i + batch]) for i in range(0, frames, batch)]
+    for name, encode in ENCODERS.items():
+        # Decodes to the same content whatever the encoder
+        assert json.loads(encode(deltas[11])[6:])["choices"][0]["delta"]["content"] == deltas[11]
+    print(f"\nEncoding, {batch} token(s) per delta")
+    print(f"{'encoder':<18} {'frames/s':>12} {'ns/frame':>9}")
+    for name, encode in ENCODERS.items():
+        start = time.perf_counter()
+        for delta in deltas:
+            encode(delta)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<18} {len(deltas) / elapsed:>12,.0f} {elapsed / len(deltas) * 1e9:>9.0f}")
+
+
+async def token_source(tokens: int, interval: float, produced: list[float]):
+    """A generation: tokens deltas, one per interval; records when each was produced"""
+    for i in range(tokens):
+        await asyncio.sleep(interval)
+        produced.append(time.perf_counter())
+        # One leading space per delta, so written frames can be counted back into tokens
+        yield " " + WORDS[i % len(WORDS)].lstrip(" ")
+
+
+async def stream(fd: int, encode, tokens: int, interval: float, max_tokens: int, max_delay_ms: float, stats: dict):
+    produced: list[float] = []
+    written = 0
+    deltas = sse.frame_deltas(token_source(tokens, interval, produced), max_tokens, max_delay_ms)
+    try:
+        async for delta in deltas:
+            os.write(fd, encode(delta))
+            now = time.perf_counter()
+            count = delta.count(" ")
+            stats["delays"].extend(now - t for t in produced[written:written + count])
+            written += count
+            stats["frames"] += 1
+        os.write(fd, sse.DONE_FRAME)
+    finally:
+        await deltas.aclose()
+    stats["tokens"] += written
+
+
+async def bench_stream(args, encode, max_tokens: int, max_delay_ms: float) -> dict:
+    stats = {"frames": 0, "tokens": 0, "delays": []}
+    fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        cpu, wall = time.process_time(), time.perf_counter()
+        await asyncio.gather(*(
+            stream(fd, encode, args.tokens, args.token_interval_ms / 1000, max_tokens, max_delay_ms, stats)
+            for _ in range(args.streams)
+        ))
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    finally:
+        os.close(fd)
+    delays = np.array(stats["delays"]) * 1000
+    return {
+        "cpu_us_per_token": cpu / stats["tokens"] * 1e6,
+        "frames_per_second": stats["frames"] / wall,
+        "tokens_per_frame": stats["tokens"] / stats["frames"],
+        "delay_mean_ms": float(delays.mean()),
+        "delay_p99_ms": float(np.percentile(delays, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE encoding and coalescing benchmark")
+    parser.add_argument("--frames", type=int, default=500_000, help="Part 1: deltas encoded per encoder")
+    parser.add_argument("--streams", type=int, default=200, help="Part 2: concurrent generations")
+    parser.add_argument("--tokens", type=int, default=200, help="Part 2: deltas per generation")
+    parser.add_argument("--token-interval-ms", type=float, default=20.0, help="Part 2: time between deltas")
+    parser.add_argument("--coalesce", default="4:10,8:20", help="Part 2: tokens:ms settings to compare")
+    args = parser.parse_args()
+
+    print(f"orjson: {'available' if sse.orjson is not None else 'not installed'}; service default: {sse.escape.__name__}")
+    bench_encoders(args.frames, 1)
+    bench_encoders(args.frames, 8)
+
+    settings = [(1, 0.0)] + [tuple(map(float, s.split(":"))) for s in args.coalesce.split(",") if s]
+    print(
+        f"\nStreaming: {args.streams} streams x {args.tokens} tokens, one every {args.token_interval_ms:g}ms "
+        f"({args.streams * 1000 / args.token_interval_ms:,.0f} tokens/s offered)"
+    )
+    print(
+        f"{'encoder':<18} {'coalesce':>10} {'CPU us/tok':>11} {'frames/s':>10} "
+        f"{'tok/frame':>10} {'delay avg':>10} {'delay p99':>10}"
+    )
+    for name, encode in ENCODERS.items():
+        for max_tokens, max_delay_ms in settings:
+            result = asyncio.run(bench_stream(args, encode, int(max_tokens), max_delay_ms))
+            label = "off" if max_tokens <= 1 else f"{int(max_tokens)}/{max_delay_ms:g}ms"
+            print(
+                f"{name:<18} {label:>10} {result['cpu_us_per_token']:>11.1f} {result['frames_per_second']:>10,.0f} "
+                f"{result['tokens_per_frame']:>10.2f} {result['delay_mean_ms']:>8.2f}ms {result['delay_p99_ms']:>8.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: streaming stop-sequence matching
+Compares the legacy per-delta filter_generated_user_messages call with the
+incremental StopSequenceStream on a simulated token stream. Correctness,
+including stop strings split across deltas, is covered by
+services/llm/tests/test_stop_sequences.py.
+
+Usage: python benchmarks/bench_stop_sequences.py [--tokens 2000] [--repeat 20]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "llm"))
+
+from main import filter_generated_user_messages  # noqa: E402
+from stop_sequences import DEFAULT_STOP_SEQUENCES, StopSequenceMatcher  # noqa: E402
+
+MATCHER = StopSequenceMatcher(DEFAULT_STOP_SEQUENCES)
+
+
+def make_deltas(n_tokens: int) -> list[str]:
+    words = "The quick brown fox jumps over the lazy dog and then rests in the shade .".split()
+    deltas = [(" " if i else "") + words[i % len(words)] for i in range(n_tokens)]
+    deltas[len(deltas) // 2] += "\n"
+    return deltas
+
+
+def bench(name: str, fn, deltas: list[str], repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(deltas)
+        best = min(best, time.perf_counter() - start)
+    chars = sum(len(d) for d in deltas)
+    print(f"{name:<34} {best * 1e3:8.3f} ms  {best / len(deltas) * 1e9:8.0f} ns/token  "
+          f"{best / chars * 1e9:6.0f} ns/char")
+
+
+def legacy(deltas: list[str]):
+    for delta in deltas:
+        filter_generated_user_messages(delta)
+
+
+def incremental(deltas: list[str]):
+    stream = MATCHER.stream()
+    for delta in deltas:
+        stream.feed(delta)
+    stream.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stop-sequence matcher microbenchmark")
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    deltas = make_deltas(args.tokens)
+    print(f"{args.tokens} deltas, {len(MATCHER.patterns)} stop sequences, best of {args.repeat}")
+    bench("filter_generated_user_messages", legacy, deltas, args.repeat)
+    bench("StopSequenceStream", incremental, deltas, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
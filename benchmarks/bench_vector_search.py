@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Benchmark: vector search recall and latency vs corpus size
+Builds memory-mapped indexes over a synthetic clustered corpus (topics as
+Gaussian clusters on the unit sphere) and measures recall@k against exact
+float32 search, plus per-query latency, for:
+
+- exact scan over float32 rows
+- exact scan over float16 rows
+- IVF over float16 rows at several nprobe settings
+
+Usage: python benchmarks/bench_vector_search.py [--sizes 10000,100000,300000] [--queries 200]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "services", "rag"))
+
+from embeddings import normalize  # noqa: E402
+from vector_store import VectorIndex, top_k_indices, write_index  # noqa: E402
+
+
+def make_corpus(n: int, dim: int, topics: int, rng: np.random.Generator) -> np.ndarray:
+    centers = normalize(rng.standard_normal((topics, dim)).astype(np.float32))
+    labels = rng.integers(0, topics, n)
+    # Within-topic cosine similarity around 0.7, like sentence embeddings of related passages
+    return normalize(centers[labels] + 0.65 * rng.standard_normal((n, dim)).astype(np.float32) / np.sqrt(dim))
+
+
+def make_queries(corpus: np.ndarray, n: int, rng: np.random.Generator) -> np.ndarray:
+    # Paraphrase-like queries: near an existing passage, not identical to it
+    base = corpus[rng.integers(0, len(corpus), n)]
+    return normalize(base + 0.5 * rng.standard_normal(base.shape).astype(np.float32) / np.sqrt(corpus.shape[1]))
+
+
+def exact_truth(corpus: np.ndarray, queries: np.ndarray, k: int) -> list[set]:
+    truth = []
+    for query in queries:
+        truth.append(set(top_k_indices(corpus @ query, k).tolist()))
+    return truth
+
+
+def measure(index: VectorIndex, queries: np.ndarray, truth: list[set], k: int, nprobe=None) -> dict:
+    index.search(queries[0], k=k, nprobe=nprobe)  # fault pages in
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        results = index.search(query, k=k, nprobe=nprobe)
+        latencies.append(time.perf_counter() - start)
+        hits += len(expected & {chunk_id for chunk_id, _ in results})
+    latencies = np.array(latencies) * 1000
+    return {
+        "recall": hits / (k * len(queries)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+def report(size: int, name: str, result: dict, build_s: float):
+    print(
+        f"{size:>9,} {name:<22} recall@k={result['recall']:.3f} "
+        f"p50={result['p50_ms']:7.2f}ms p95={result['p95_ms']:7.2f}ms build={build_s:6.1f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vector search recall/latency benchmark")
+    parser.add_argument("--sizes", default="10000,100000,300000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", default="4,8,16,32")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    chunks_for = lambda n: ({"text": f"chunk {i}"} for i in range(n))  # noqa: E731
+
+    print(f"{'chunks':>9} {'index':<22} (k={args.k}, dim={args.dim}, {args.queries} queries)")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            corpus = make_corpus(size, args.dim, topics=max(16, size // 500), rng=rng)
+            queries = make_queries(corpus, args.queries, rng)
+            truth = exact_truth(corpus, queries, args.k)
+
+            variants = [("exact float32", "float32", 0), ("exact float16", "float16", 0)]
+            variants.append(("ivf float16", "float16", int(4 * np.sqrt(size))))
+            for name, dtype, nlist in variants:
+                path = os.path.join(tmp, f"{size}-{dtype}-{nlist}")
+                start = time.perf_counter()
+                write_index(path, corpus, chunks_for(size), embedder="synthetic", dtype=dtype, nlist=nlist)
+                build_s = time.perf_counter() - start
+                index = VectorIndex(path)
+                if nlist:
+                    for nprobe in [int(p) for p in args.nprobe.split(",")]:
+                        label = f"{name} {nlist}/{nprobe}"
+                        report(size, label, measure(index, queries, truth, args.k, nprobe=nprobe), build_s)
+                else:
+                    report(size, name, measure(index, queries, truth, args.k), build_s)
+                index.close()
+            del corpus
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Audio Buffering and Voice Activity Detection
+
+Fixed-size ring buffer for incoming PCM audio and an energy-based
+segmenter that finds speech onsets, short pauses inside an utterance and
+the end of the utterance. Audio is 16-bit little-endian mono PCM.
+"""
+
+import math
+from array import array
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+SAMPLE_WIDTH = 2  # bytes per 16-bit sample
+
+
+class RingBuffer:
+    """
+    Fixed-capacity byte ring addressed by absolute stream position.
+
+    Positions count every byte ever written, so a reader can hold on to
+    the start of an utterance while the buffer keeps wrapping.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self.written = 0  # absolute position of the next byte
+
+    @property
+    def oldest(self) -> int:
+        """Oldest absolute position still held"""
+        return max(0, self.written - self.capacity)
+
+    def write(self, data: bytes):
+        if len(data) >= self.capacity:
+            # Only the last capacity bytes fit; the rest still count as written
+            self.written += len(data) - self.capacity
+            data = data[-self.capacity:]
+        offset = self.written % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self._buffer[offset:offset + first] = data[:first]
+        if first < len(data):
+            self._buffer[:len(data) - first] = data[first:]
+        self.written += len(data)
+
+    def read(self, start: int, end: Optional[int] = None) -> bytes:
+        """
+        Copy out bytes [start, end); start is clamped to the oldest held byte.
+
+        Args:
+            start: Absolute start position
+            end: Absolute end position, defaults to everything written
+        """
+        end = self.written if end is None else min(end, self.written)
+        start = max(start, self.oldest)
+        if start >= end:
+            return b""
+        begin, stop = start % self.capacity, end % self.capacity
+        if begin < stop:
+            return bytes(self._buffer[begin:stop])
+        return bytes(self._buffer[begin:]) + bytes(self._buffer[:stop])
+
+
+def frame_rms(frame: bytes) -> float:
+    """Root-mean-square level of one frame of 16-bit PCM"""
+    samples = array("h", frame)
+    if not samples:
+        return 0.0
+    return math.sqrt(sum(s * s for s in samples) / len(samples))
+
+
+@dataclass
+class VADEvent:
+    """A segmentation event at an absolute stream position"""
+    kind: str  # speech_start, pause, speech_end
+    position: int
+
+
+class UtteranceSegmenter:
+    """
+    Energy VAD with an adaptive noise floor.
+
+    Emits speech_start once enough consecutive voiced frames arrive (the
+    reported position includes pre-roll so onsets are not clipped), pause
+    at short silences inside speech, which are safe places to cut audio
+    for incremental transcription, and speech_end after a longer silence.
+    An utterance that runs past max_chunk_ms without a pause gets a
+    forced pause at the quietest recent frame.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int = 16000,
+        frame_ms: int = 20,
+        start_ms: int = 60,
+        pause_ms: int = 160,
+        end_ms: int = 400,
+        preroll_ms: int = 200,
+        max_chunk_ms: int = 4000,
+        min_level: float = 300.0,
+        noise_ratio: float = 3.0,
+    ):
+        self.frame_bytes = sample_rate * frame_ms // 1000 * SAMPLE_WIDTH
+        self.bytes_per_ms = sample_rate * SAMPLE_WIDTH / 1000
+        self.start_frames = max(1, start_ms // frame_ms)
+        self.pause_frames = max(1, pause_ms // frame_ms)
+        self.end_frames = max(self.pause_frames + 1, end_ms // frame_ms)
+        self.preroll = int(preroll_ms * self.bytes_per_ms)
+        self.max_chunk = int(max_chunk_ms * self.bytes_per_ms)
+        self.min_level = min_level
+        self.noise_ratio = noise_ratio
+
+        self.noise_floor = min_level / noise_ratio
+        self.in_speech = False
+        self.position = 0  # absolute position of the next unprocessed frame
+        self.last_cut = 0  # position of the last speech_start or pause
+        self.last_voiced_end = 0  # end position of the last voiced frame
+        self._pending = bytearray()
+        self._voiced_run = 0
+        self._silent_run = 0
+        self._paused = False
+        self._recent: deque[tuple[int, float]] = deque(maxlen=25)
+
+    def feed(self, data: bytes) -> list[VADEvent]:
+        """Consume audio and return the events it triggered"""
+        self._pending.extend(data)
+        events = []
+        while len(self._pending) >= self.frame_bytes:
+            frame = bytes(self._pending[:self.frame_bytes])
+            del self._pending[:self.frame_bytes]
+            event = self._frame(frame)
+            if event:
+                events.append(event)
+        return events
+
+    def _frame(self, frame: bytes) -> Optional[VADEvent]:
+        level = frame_rms(frame)
+        start = self.position
+        self.position += len(frame)
+        voiced = level >= max(self.min_level, self.noise_floor * self.noise_ratio)
+
+        if not voiced:
+            # Track background noise only while it is quiet
+            self.noise_floor += 0.05 * (level - self.noise_floor)
+
+        if not self.in_speech:
+            self._voiced_run = self._voiced_run + 1 if voiced else 0
+            if self._voiced_run >= self.start_frames:
+                self.in_speech = True
+                self._silent_run = 0
+                self._paused = False
+                self.last_voiced_end = self.position
+                onset = start - (self.start_frames - 1) * self.frame_bytes
+                self.last_cut = max(0, onset - self.preroll)
+                self._recent.clear()
+                return VADEvent("speech_start", self.last_cut)
+            return None
+
+        self._recent.append((start, level))
+        if voiced:
+            self._silent_run = 0
+            self._paused = False
+            self.last_voiced_end = self.position
+        else:
+            self._silent_run += 1
+            if self._silent_run >= self.end_frames:
+                self.in_speech = False
+                self._voiced_run = 0
+                return VADEvent("speech_end", self.position)
+            if self._silent_run >= self.pause_frames and not self._paused:
+                self._paused = True
+                return self._cut(self.position)
+
+        if self.position - self.last_cut >= self.max_chunk:
+            quietest, _ = min(self._recent, key=lambda item: item[1])
+            return self._cut(quietest if quietest > self.last_cut else self.position)
+        return None
+
+    def _cut(self, position: int) -> VADEvent:
+        self.last_cut = position
+        return VADEvent("pause", position)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Fake STT service for local testing
+
+Implements the /transcribe contract used by voice.py without a speech
+model: it "recognizes" a deterministic word per 400ms of audio and takes
+time proportional to the audio length, like Whisper at a fixed real-time
+factor.
+
+Usage:
+    python fake_stt_server.py --port 8002 --rtf 0.1
+"""
+
+import argparse
+import asyncio
+import os
+
+from fastapi import FastAPI, Request
+import uvicorn
+
+WORDS = "what is the weather like today in the city near me please".split()
+
+app = FastAPI(title="Fake STT")
+settings = {"rtf": 0.1, "base_delay": 0.03}
+
+
+@app.get("/healthz")
+async def health():
+    return {"status": "ok"}
+
+
+@app.post("/transcribe")
+async def transcribe(request: Request, sample_rate: int = 16000, prompt: str = ""):
+    pcm = await request.body()
+    seconds = len(pcm) / 2 / sample_rate
+    await asyncio.sleep(settings["base_delay"] + seconds * settings["rtf"])
+    # Continue the word sequence after the prompt so pieces read as one sentence
+    offset = len(prompt.split())
+    count = max(1, round(seconds / 0.4))
+    return {"text": " ".join(WORDS[(offset + i) % len(WORDS)] for i in range(count))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--rtf", type=float, default=float(os.getenv("FAKE_STT_RTF", "0.1")))
+    parser.add_argument("--base-delay", type=float, default=float(os.getenv("FAKE_STT_BASE_DELAY", "0.03")))
+    args = parser.parse_args()
+
+    settings["rtf"] = args.rtf
+    settings["base_delay"] = args.base_delay
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Fake TTS service for local testing
+
+Implements the /synthesize contract used by tts.py without a voice model:
+streams silent 16-bit PCM whose length follows the text (about 60ms per
+character), produced at a fixed real-time factor in 100ms chunks.
+
+Usage:
+    python fake_tts_server.py --port 8003 --rtf 0.1
+"""
+
+import argparse
+import asyncio
+import os
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import uvicorn
+
+SAMPLE_RATE = 22050
+CHUNK_SECONDS = 0.1
+
+app = FastAPI(title="Fake TTS")
+settings = {"rtf": 0.1, "base_delay": 0.05}
+
+
+@app.get("/healthz")
+async def health():
+    return {"status": "ok"}
+
+
+@app.post("/synthesize")
+async def synthesize(request: Request):
+    body = await request.json()
+    seconds = 0.06 * len(body.get("text", ""))
+    chunk = b"\0\0" * int(SAMPLE_RATE * CHUNK_SECONDS)
+
+    async def stream():
+        await asyncio.sleep(settings["base_delay"])
+        for _ in range(max(1, round(seconds / CHUNK_SECONDS))):
+            await asyncio.sleep(CHUNK_SECONDS * settings["rtf"])
+            yield chunk
+
+    return StreamingResponse(
+        stream(), media_type="audio/pcm", headers={"X-Sample-Rate": str(SAMPLE_RATE)}
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8003)
+    parser.add_argument("--rtf", type=float, default=float(os.getenv("FAKE_TTS_RTF", "0.1")))
+    parser.add_argument("--base-delay", type=float, default=float(os.getenv("FAKE_TTS_BASE_DELAY", "0.05")))
+    args = parser.parse_args()
+
+    settings["rtf"] = args.rtf
+    settings["base_delay"] = args.base_delay
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
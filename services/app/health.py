@@ -0,0 +1,134 @@
+"""
+Downstream Health Monitor
+
+Probes every downstream service concurrently in the background and keeps
+the latest result in memory, so /healthz answers without any network I/O
+and health checks never add probe traffic to a saturated service.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+from prometheus_client import Gauge, Histogram
+
+from upstream import UpstreamClient
+
+logger = logging.getLogger(__name__)
+
+SERVICE_UP = Gauge(
+    'app_downstream_up',
+    'Whether the last health probe of a downstream service succeeded',
+    ['service']
+)
+PROBE_LATENCY = Histogram(
+    'app_downstream_probe_seconds',
+    'Health probe latency per downstream service',
+    ['service'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0)
+)
+
+
+@dataclass
+class ServiceHealth:
+    """Result of the most recent probe of one service"""
+    status: str = "unknown"  # ok, starting, degraded, down or unknown
+    latency_ms: Optional[float] = None
+    checked_at: Optional[float] = None  # unix time of the probe
+    error: Optional[str] = None
+
+
+class HealthMonitor:
+    """
+    Periodically probe downstream services and cache the results.
+
+    Each round probes all services at once and waits for the slowest, so
+    there is never more than one probe in flight per service; probes use
+    the short "health" route timeout of the pooled clients.
+    """
+
+    def __init__(self, targets: dict[str, tuple[UpstreamClient, str]], interval: float = 5.0):
+        """
+        Args:
+            targets: Service name -> (client, health URL or path)
+            interval: Seconds between probe rounds
+        """
+        self.targets = targets
+        self.interval = interval
+        # Results older than this many seconds are reported as stale
+        self.stale_after = 3 * interval
+        self.results = {name: ServiceHealth() for name in targets}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _probe(self, name: str):
+        client, path = self.targets[name]
+        start = time.perf_counter()
+        try:
+            response = await client.get(path, route="health")
+            status = "ok" if response.status_code == 200 else "degraded"
+            if response.status_code == 503:
+                # The LLM service reports its startup phase while loading the model
+                try:
+                    status = response.json().get("status", status)
+                except ValueError:
+                    pass
+            error = None if status == "ok" else f"HTTP {response.status_code}"
+        except httpx.RequestError as e:
+            status, error = "down", f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        latency = time.perf_counter() - start
+
+        previous = self.results[name].status
+        if previous != status and previous != "unknown":
+            logger.warning(f"Downstream {name} changed from {previous} to {status}")
+        self.results[name] = ServiceHealth(
+            status=status,
+            latency_ms=round(latency * 1000, 2),
+            checked_at=time.time(),
+            error=error,
+        )
+        SERVICE_UP.labels(service=name).set(1 if status == "ok" else 0)
+        PROBE_LATENCY.labels(service=name).observe(latency)
+
+    async def check_all(self):
+        """Probe every service concurrently"""
+        await asyncio.gather(*(self._probe(name) for name in self.targets))
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Health monitor round failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> dict[str, dict]:
+        """Cached results with their age; no I/O"""
+        now = time.time()
+        services = {}
+        for name, result in self.results.items():
+            age = None if result.checked_at is None else round(now - result.checked_at, 3)
+            services[name] = {
+                "status": result.status,
+                "latency_ms": result.latency_ms,
+                "checked_at": result.checked_at,
+                "age_s": age,
+                "stale": age is None or age > self.stale_after,
+                "error": result.error,
+            }
+        return services
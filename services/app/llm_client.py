@@ -0,0 +1,176 @@
+"""
+LLM Streaming Client
+
+Streams chat completions from the OpenAI-compatible LLM service and
+measures time-to-first-token and total latency of every generation.
+"""
+
+import json
+import logging
+import os
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+import metrics
+from tracing import Span, tracer, use_span
+from upstream import UpstreamClient
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = os.getenv("MODEL_NAME", "llama-3.1-8b-instruct")
+MAX_TOKENS = int(os.getenv("MAX_TOKENS", "512"))
+TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
+
+
+class LLMError(Exception):
+    """The LLM service rejected or failed a request"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[str] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+@dataclass
+class GenerationTiming:
+    """Timestamps of one generation (perf_counter seconds)"""
+    mode: str
+    started_at: float = field(default_factory=time.perf_counter)
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    tokens: int = 0
+
+    @property
+    def ttft(self) -> Optional[float]:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def total(self) -> Optional[float]:
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+class ChatStream:
+    """
+    An open streaming completion.
+
+    Iterate to receive content deltas; always aclose() when done, which
+    also aborts the upstream generation if it is still running, and ends
+    the generation's span.
+    """
+
+    def __init__(self, stack: AsyncExitStack, response, timing: GenerationTiming, span: Span):
+        self._stack = stack
+        self._response = response
+        self.timing = timing
+        self.span = span
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        timing = self.timing
+        inter_token = metrics.inter_token_histogram(timing.mode)
+        last_token_at = None
+        async for line in self._response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[6:]
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            if "error" in chunk:
+                raise LLMError(502, str(chunk["error"]))
+            choices = chunk.get("choices")
+            content = choices[0].get("delta", {}).get("content") if choices else None
+            if not content:
+                continue
+            now = time.perf_counter()
+            if last_token_at is None:
+                timing.first_token_at = now
+                metrics.record_ttft(timing.mode, timing.ttft)
+            else:
+                inter_token.observe(now - last_token_at)
+            last_token_at = now
+            timing.tokens += 1
+            yield content
+        timing.finished_at = time.perf_counter()
+        metrics.record_generation(timing.mode, timing.total)
+        self._end_span()
+
+    async def collect(self) -> str:
+        """Aggregate the whole stream into one string and close it"""
+        try:
+            return "".join([delta async for delta in self])
+        finally:
+            await self.aclose()
+
+    def _end_span(self):
+        timing = self.timing
+        self.span.end(
+            tokens=timing.tokens,
+            ttft_ms=round(timing.ttft * 1000, 1) if timing.ttft is not None else None,
+            completed=timing.finished_at is not None,
+        )
+
+    async def aclose(self):
+        await self._stack.aclose()
+        self._end_span()
+
+
+async def open_chat_stream(
+    client: UpstreamClient,
+    messages: list[dict],
+    mode: str = "text",
+    **options
+) -> ChatStream:
+    """
+    Start a streaming chat completion and return once response headers arrive.
+
+    Opening before the response to our own client is committed lets
+    overload (429) and other upstream errors be passed through with their
+    status code instead of surfacing mid-stream.
+
+    Args:
+        client: Pooled client for the LLM service
+        messages: OpenAI-style message list
+        mode: "text" or "voice", used for latency targets and admission priority
+        **options: Overrides for model, temperature, max_tokens
+
+    Raises:
+        LLMError: The LLM service answered with an error status
+        httpx.RequestError: The LLM service could not be reached
+    """
+    payload = {
+        "model": options.get("model", MODEL_NAME),
+        "messages": messages,
+        "temperature": options.get("temperature", TEMPERATURE),
+        "max_tokens": options.get("max_tokens", MAX_TOKENS),
+        "stream": True,
+        "priority": mode,
+    }
+    timing = GenerationTiming(mode=mode)
+    span = tracer.start_span("llm", mode=mode)
+    stack = AsyncExitStack()
+    try:
+        # The LLM service's spans become children of this one
+        with use_span(span):
+            response = await stack.enter_async_context(client.stream("POST", "/chat/completions", json=payload))
+        if response.status_code != 200:
+            body = await response.aread()
+            try:
+                detail = json.loads(body).get("detail", "")
+            except (json.JSONDecodeError, AttributeError):
+                detail = body.decode(errors="replace")
+            raise LLMError(response.status_code, detail or "LLM request failed", response.headers.get("Retry-After"))
+    except BaseException as e:
+        await stack.aclose()
+        span.end(error=type(e).__name__)
+        raise
+    return ChatStream(stack, response, timing, span)
@@ -6,25 +6,101 @@ REST and WebSocket endpoints for text and voice chat.
 """
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, AsyncGenerator
+from contextlib import asynccontextmanager
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from starlette.background import BackgroundTask
+import asyncio
+import httpx
+import json
 import logging
 import os
 
+from upstream import UpstreamClient, UpstreamRegistry
+from health import HealthMonitor
+from voice import STTClient, VoiceSession
+from tts import TTSClient
+from llm_client import ChatStream, LLMError, open_chat_stream
+from rag_client import with_context
+from metrics import MetricsMiddleware, WS_SESSIONS, WS_SESSIONS_TOTAL, record_cancellation
+from tracing import TracingMiddleware, tracer
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+# httpx logs every request at INFO, which floods the log with health probes
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Service URLs from environment
+LLM_URL = os.getenv("OPENAI_COMPAT_BASE_URL", "http://llm:8001/v1")
+STT_URL = os.getenv("STT_URL", "http://stt:8002")
+TTS_URL = os.getenv("TTS_URL", "http://tts:8003")
+RAG_URL = os.getenv("RAG_URL", "http://rag:8004")
+
+# The LLM base URL carries the OpenAI /v1 prefix; its health endpoint is at the root
+LLM_HEALTH_URL = LLM_URL.rstrip("/").removesuffix("/v1") + "/healthz"
+LLM_TRACES_URL = LLM_URL.rstrip("/").removesuffix("/v1") + "/debug/traces"
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "5"))
+
+# Pooled clients for downstream services, created in lifespan
+upstreams: Optional[UpstreamRegistry] = None
+health_monitor: Optional[HealthMonitor] = None
+
+
+def get_upstream(name: str) -> UpstreamClient:
+    """
+    Return the shared client for a downstream service.
+    
+    Args:
+        name: One of "llm", "stt", "tts" or "rag"
+    """
+    return upstreams.get(name)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create long-lived keep-alive clients for every downstream service,
+    start the background health monitor and close both on shutdown.
+    """
+    global upstreams, health_monitor
+    
+    upstreams = UpstreamRegistry()
+    upstreams.add(UpstreamClient("llm", LLM_URL))
+    upstreams.add(UpstreamClient("stt", STT_URL))
+    upstreams.add(UpstreamClient("tts", TTS_URL))
+    upstreams.add(UpstreamClient("rag", RAG_URL))
+    logger.info("Upstream clients initialized")
+    
+    health_monitor = HealthMonitor(
+        {
+            "llm": (upstreams.get("llm"), LLM_HEALTH_URL),
+            "stt": (upstreams.get("stt"), "/healthz"),
+            "tts": (upstreams.get("tts"), "/healthz"),
+            "rag": (upstreams.get("rag"), "/healthz"),
+        },
+        interval=HEALTH_CHECK_INTERVAL
+    )
+    health_monitor.start()
+    
+    yield
+    
+    await health_monitor.stop()
+    await upstreams.aclose()
+
 
 # Initialize FastAPI app
 app = FastAPI(
     title="Voicebot RAG API",
     description="Low-latency voice and text chatbot with RAG",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan
 )
 
 # CORS middleware configuration
@@ -36,11 +112,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Service URLs from environment
-LLM_URL = os.getenv("OPENAI_COMPAT_BASE_URL", "http://llm:8001")
-STT_URL = os.getenv("STT_URL", "http://stt:8002")
-TTS_URL = os.getenv("TTS_URL", "http://tts:8003")
-RAG_URL = "http://rag:8004"
+# Request rate, errors and latency per endpoint
+app.add_middleware(MetricsMiddleware)
+
+# A trace and X-Request-ID per request, propagated to downstream services
+app.add_middleware(TracingMiddleware)
 
 
 # =============================================================================
@@ -69,19 +145,23 @@ async def health_check():
     """
     Health check endpoint for container orchestration.
     
+    Answers from the health monitor's cache without probing anything, so
+    it stays fast under load. The app itself is healthy whenever it can
+    answer; downstream problems are reported as "degraded".
+    
     Returns:
-        Health status of this service and downstream services
-    """
-    services_status = {
-        "app": "ok",
-        "llm": "unknown",  # TODO: Check LLM service health
-        "stt": "unknown",  # TODO: Check STT service health
-        "tts": "unknown",  # TODO: Check TTS service health
-        "rag": "unknown",  # TODO: Check RAG service health
-    }
+        Health status of this service and downstream services, with
+        per-service probe latency and result age
+    """
+    services_status = health_monitor.snapshot()
+    all_ok = all(
+        service["status"] == "ok" and not service["stale"]
+        for service in services_status.values()
+    )
+    services_status["app"] = {"status": "ok"}
     
     return {
-        "status": "ok",
+        "status": "ok" if all_ok else "degraded",
         "services": services_status
     }
 
@@ -90,6 +170,31 @@ async def health_check():
 # Text Chat Endpoint (Server-Sent Events)
 # =============================================================================
 
+# Fixed SSE frame pieces; only the token text is encoded per token
+START_FRAME = 'data: {"type": "start"}\n\n'
+TOKEN_FRAME_PREFIX = 'data: {"type": "token", "content": '
+FRAME_SUFFIX = '}\n\n'
+
+
+def sse_event(payload: dict) -> str:
+    """Encode one SSE event with proper JSON escaping"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def llm_error_response(e: Exception) -> JSONResponse:
+    """
+    Map a failure to start an LLM generation to an HTTP response.
+    
+    Overload from the LLM service (429) is passed through with its
+    Retry-After header so clients back off.
+    """
+    if isinstance(e, LLMError):
+        headers = {"Retry-After": e.retry_after} if e.retry_after else None
+        return JSONResponse({"error": e.detail}, status_code=e.status_code, headers=headers)
+    logger.error(f"LLM service unreachable: {e}")
+    return JSONResponse({"error": "LLM service unavailable"}, status_code=503)
+
+
 @app.post("/chat")
 async def chat(request: ChatRequest):
     """
@@ -103,84 +208,176 @@ async def chat(request: ChatRequest):
     """
     logger.info(f"Chat request: {request.message[:50]}...")
     
-    async def generate_response() -> AsyncGenerator[str, None]:
-        """Generate streaming response using SSE format"""
-        try:
-            # TODO: Implement RAG retrieval if use_rag is True
-            
-            # TODO: Call LLM service for response generation
-            
-            # For now, send a simple demo response
-            yield "data: {\"type\": \"start\"}\n\n"
-            yield f"data: {{\"type\": \"token\", \"content\": \"Hello! \"}}\n\n"
-            yield f"data: {{\"type\": \"token\", \"content\": \"I received your message: \"}}\n\n"
-            yield f"data: {{\"type\": \"token\", \"content\": \"{request.message}\"}}\n\n"
-            yield "data: {\"type\": \"end\"}\n\n"
-            
-        except Exception as e:
-            logger.error(f"Error in chat: {e}")
-            yield f"data: {{\"type\": \"error\", \"message\": \"{str(e)}\"}}\n\n"
+    messages = [{"role": "user", "content": request.message}]
+    if request.use_rag:
+        messages = await with_context(get_upstream("rag"), messages, request.message)
+    
+    try:
+        stream = await open_chat_stream(get_upstream("llm"), messages, mode="text")
+    except (LLMError, httpx.RequestError) as e:
+        return llm_error_response(e)
     
     if request.stream:
         return StreamingResponse(
-            generate_response(),
+            generate_response(stream),
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
                 "Connection": "keep-alive",
-            }
+            },
+            # A client gone before the first frame never starts the generator,
+            # so its finally cannot be relied on to release the upstream stream
+            background=BackgroundTask(stream.aclose),
         )
-    else:
-        # Non-streaming response
-        return JSONResponse({
-            "response": f"Hello! I received your message: {request.message}"
+    
+    # Non-streaming response: aggregate the same upstream stream
+    try:
+        text = await stream.collect()
+    except (LLMError, httpx.HTTPError) as e:
+        logger.error(f"Error in chat: {e}")
+        return JSONResponse({"error": "Failed to generate response"}, status_code=502)
+    return JSONResponse({"response": text})
+
+
+async def generate_response(stream: ChatStream) -> AsyncGenerator[str, None]:
+    """
+    Re-frame LLM deltas as SSE events.
+    
+    Args:
+        stream: Open LLM stream; closed when the client disconnects or the
+            generation ends
+    """
+    try:
+        yield START_FRAME
+        async for delta in stream:
+            yield TOKEN_FRAME_PREFIX + json.dumps(delta) + FRAME_SUFFIX
+        timing = stream.timing
+        yield sse_event({
+            "type": "end",
+            "ttft_ms": round(timing.ttft * 1000, 1) if timing.ttft is not None else None,
+            "total_ms": round(timing.total * 1000, 1),
         })
+    except (LLMError, httpx.HTTPError) as e:
+        logger.error(f"Error in chat: {e}")
+        yield sse_event({"type": "error", "message": str(e)})
+    except (asyncio.CancelledError, GeneratorExit):
+        # Client disconnected; closing the stream below aborts the LLM generation
+        record_cancellation("disconnect")
+        raise
+    finally:
+        await stream.aclose()
 
 
 # =============================================================================
 # Voice Chat Endpoint (WebSocket)
 # =============================================================================
 
+# RFC 6455: a close frame's reason is at most 123 bytes of UTF-8
+MAX_CLOSE_REASON_BYTES = 123
+
+
+def close_reason(error: Exception) -> str:
+    """Error text cut to fit a WebSocket close frame, without splitting a character"""
+    return str(error).encode()[:MAX_CLOSE_REASON_BYTES].decode(errors="ignore")
+
+
 @app.websocket("/voice")
 async def voice_chat(websocket: WebSocket):
     """
     Voice chat endpoint using WebSocket for real-time audio streaming.
     
-    Flow:
-    1. Client sends audio chunks
-    2. STT transcribes audio to text
-    3. RAG retrieves relevant context (if needed)
-    4. LLM generates response
-    5. TTS converts response to audio
-    6. Audio chunks streamed back to client
+    Flow (streaming, see voice.py for the message protocol):
+    1. Client streams PCM audio frames into a ring buffer
+    2. VAD cuts the utterance at short pauses; each piece is sent to STT
+       while the user is still speaking
+    3. At end of speech only the tail is left to transcribe
+    4. RAG retrieves relevant context, started on the stable partial
+       transcript and reused if the final one asks the same question
+    5. LLM generates the response, streamed back as token events
+    6. Each finished sentence is sent to TTS while the LLM keeps going;
+       audio is streamed back in order as binary frames
+    7. Per-stage timings are sent as timing events
     """
     await websocket.accept()
     logger.info("WebSocket connection established")
+    WS_SESSIONS.inc()
+    outcome = "closed"
     
     try:
-        while True:
-            # Receive audio data from client
-            data = await websocket.receive_bytes()
-            logger.info(f"Received audio chunk: {len(data)} bytes")
-            
-            # TODO: Implement voice processing pipeline
-            # 1. Send audio to STT service
-            # 2. Get transcript
-            # 3. Process with RAG + LLM
-            # 4. Convert response to audio with TTS
-            # 5. Stream audio back
-            
-            # For now, send a simple acknowledgment
-            await websocket.send_json({
-                "type": "ack",
-                "message": "Audio received, processing not yet implemented"
-            })
-            
+        session = VoiceSession(
+            websocket,
+            stt=STTClient(get_upstream("stt")),
+            llm=get_upstream("llm"),
+            tts=TTSClient(get_upstream("tts")),
+            rag=get_upstream("rag"),
+            sample_rate=int(websocket.query_params.get("sample_rate", "16000")),
+        )
+        await session.run()
+        logger.info("WebSocket connection closed")
+        
     except WebSocketDisconnect:
         logger.info("WebSocket connection closed")
     except Exception as e:
         logger.error(f"Error in voice chat: {e}")
-        await websocket.close(code=1011, reason=str(e))
+        outcome = "error"
+        await websocket.close(code=1011, reason=close_reason(e))
+    finally:
+        WS_SESSIONS.dec()
+        WS_SESSIONS_TOTAL.labels(outcome=outcome).inc()
+
+
+# =============================================================================
+# Trace Debug Endpoints
+# =============================================================================
+
+async def with_llm_spans(trace: dict) -> dict:
+    """
+    Merge the LLM service's spans for the same trace into an app trace.
+    
+    Each service only keeps its own spans; this joins them on the trace
+    ID. Spans are labelled with their service. Best effort: if the LLM
+    service has no record or cannot be reached, the app's spans are
+    returned alone.
+    """
+    spans = [{**span, "service": "app"} for span in trace["spans"]]
+    try:
+        response = await get_upstream("llm").get(f"{LLM_TRACES_URL}/{trace['trace_id']}", route="health")
+        if response.status_code == 200:
+            spans += [{**span, "service": "llm"} for span in response.json()["spans"]]
+    except httpx.HTTPError as e:
+        logger.warning(f"Could not fetch LLM spans for trace {trace['trace_id']}: {e!r}")
+    return {**trace, "spans": sorted(spans, key=lambda span: (span["start"], -(span["duration_ms"] or 0)))}
+
+
+@app.get("/debug/traces")
+async def slowest_traces(limit: int = 10, span: Optional[str] = None, upstream: bool = True):
+    """
+    Slowest recent sampled traces (HTTP requests and voice turns).
+    
+    Args:
+        limit: Traces to return
+        span: Rank by the longest span of this name (e.g. "stt", "llm",
+            "rag.wait") instead of by the whole trace
+        upstream: Include the LLM service's spans of each trace
+        
+    Returns:
+        Traces, slowest first, each with its spans in start order
+    """
+    traces = tracer.exporter.slowest(limit, span)
+    if upstream:
+        traces = await asyncio.gather(*(with_llm_spans(trace) for trace in traces))
+    return {"sample_rate": tracer.sample_rate, "traces": traces}
+
+
+@app.get("/debug/traces/{trace_id}")
+async def get_trace(trace_id: str, upstream: bool = True):
+    """
+    One trace by ID, which is the X-Request-ID returned with every response.
+    """
+    trace = tracer.exporter.get(trace_id)
+    if trace is None:
+        return JSONResponse({"error": "Trace not found or not sampled"}, status_code=404)
+    return await with_llm_spans(trace) if upstream else trace
 
 
 # =============================================================================
@@ -192,13 +389,11 @@ async def metrics():
     """
     Prometheus metrics endpoint.
     
-    TODO: Implement Prometheus metrics collection:
-    - Request latency (P50, P95, P99)
-    - Token generation rate
-    - Error rates
-    - Service health
+    Exports request rate, errors and latency per endpoint, per-stage
+    latency histograms (TTFT, inter-token gap, STT, RAG, LLM, TTS),
+    open WebSocket sessions and upstream pool/circuit breaker metrics.
     """
-    return {"message": "Metrics endpoint - to be implemented"}
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 
 # =============================================================================
@@ -215,7 +410,8 @@ async def root():
             "health": "/healthz",
             "chat": "/chat (POST)",
             "voice": "/voice (WebSocket)",
-            "metrics": "/metrics"
+            "metrics": "/metrics",
+            "traces": "/debug/traces"
         }
     }
 
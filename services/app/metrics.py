@@ -0,0 +1,270 @@
+"""
+Orchestrator metrics
+
+Prometheus metrics for the app service. Buckets are tuned around the
+latency targets in the README so SLA compliance can be read straight off
+the histograms:
+
+- First token: 300ms (text), 700ms (voice)
+- Audio to transcript: 800ms
+- Streaming rate: 30 tok/s, i.e. about 33ms between tokens
+- End-to-end P99: 2.5s
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from tracing import Span, tracer
+
+# Time-to-first-token targets from the README, in seconds
+TTFT_TARGETS = {
+    "text": 0.3,
+    "voice": 0.7,
+}
+
+STAGES = ("stt", "rag", "llm", "tts")
+
+# =============================================================================
+# HTTP
+# =============================================================================
+
+HTTP_REQUESTS = Counter(
+    'app_requests_total',
+    'HTTP requests by endpoint and status',
+    ['method', 'endpoint', 'status']
+)
+HTTP_DURATION = Histogram(
+    'app_request_duration_seconds',
+    'HTTP request duration, including the full body of streamed responses',
+    ['endpoint'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 1.0, 1.5, 2.0, 2.5, 5.0, 10.0, 30.0)
+)
+
+# =============================================================================
+# Pipeline Stages
+# =============================================================================
+
+LLM_TTFT = Histogram(
+    'app_llm_ttft_seconds',
+    'Time from sending a chat request to the first LLM token',
+    ['mode'],
+    buckets=(0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.7, 1.0, 1.5, 2.0, 3.0, 5.0)
+)
+LLM_INTER_TOKEN = Histogram(
+    'app_llm_inter_token_seconds',
+    'Gap between consecutive LLM tokens',
+    ['mode'],
+    buckets=(0.005, 0.01, 0.02, 0.033, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0)
+)
+LLM_GENERATION = Histogram(
+    'app_llm_generation_seconds',
+    'Total time of an LLM generation, request to last token',
+    ['mode'],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+)
+LLM_TTFT_SLA = Counter(
+    'app_llm_ttft_sla_total',
+    'Generations by whether the first token met the README target',
+    ['mode', 'result']
+)
+STAGE_DURATION = Histogram(
+    'app_stage_duration_seconds',
+    'Duration of each pipeline stage (stt, rag, llm, tts)',
+    ['stage'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0, 1.5, 2.0, 2.5, 5.0, 10.0)
+)
+TTS_FIRST_AUDIO = Histogram(
+    'app_tts_first_audio_seconds',
+    'Time from the end of user speech to the first reply audio byte',
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.7, 1.0, 1.25, 1.5, 2.0, 2.5, 3.0, 5.0, 10.0)
+)
+STAGE_ERRORS = Counter(
+    'app_stage_errors_total',
+    'Pipeline stage failures',
+    ['stage']
+)
+
+RAG_SPECULATION = Counter(
+    'app_rag_speculation_total',
+    'Voice turns by whether retrieval on the partial transcript could be reused (hit, miss, none)',
+    ['outcome']
+)
+RAG_SPECULATION_SAVED = Histogram(
+    'app_rag_speculation_saved_seconds',
+    'Retrieval time taken off the voice path by a speculation hit',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0)
+)
+
+REQUESTS_CANCELLED = Counter(
+    'app_requests_cancelled_total',
+    'Replies stopped early because the client disconnected or barged in',
+    ['reason']
+)
+TTS_SEGMENTS_CANCELLED = Counter(
+    'app_tts_segments_cancelled_total',
+    'TTS segments abandoned before they finished synthesizing'
+)
+
+# =============================================================================
+# WebSocket
+# =============================================================================
+
+WS_SESSIONS = Gauge('app_websocket_sessions_active', 'Voice WebSocket sessions currently open')
+WS_SESSIONS_TOTAL = Counter(
+    'app_websocket_sessions_total',
+    'Voice WebSocket sessions by how they ended',
+    ['outcome']
+)
+
+# Bind the fixed label sets once so hot paths skip the label lookup
+_stage_durations = {stage: STAGE_DURATION.labels(stage=stage) for stage in STAGES}
+_stage_errors = {stage: STAGE_ERRORS.labels(stage=stage) for stage in STAGES}
+
+
+def inter_token_histogram(mode: str):
+    """
+    Return the bound inter-token histogram for a mode.
+
+    Resolve once per generation and call observe() per token; that keeps
+    the per-token cost to a single locked bucket increment.
+    """
+    return LLM_INTER_TOKEN.labels(mode=mode)
+
+
+def record_ttft(mode: str, seconds: float):
+    """
+    Record time-to-first-token and whether it met the target.
+
+    Args:
+        mode: "text" or "voice"
+        seconds: Time to first token
+    """
+    LLM_TTFT.labels(mode=mode).observe(seconds)
+    met = seconds <= TTFT_TARGETS.get(mode, TTFT_TARGETS["text"])
+    LLM_TTFT_SLA.labels(mode=mode, result="met" if met else "missed").inc()
+
+
+def record_generation(mode: str, seconds: float):
+    """
+    Record the total latency of a finished generation.
+
+    Args:
+        mode: "text" or "voice"
+        seconds: Time from request to last token
+    """
+    LLM_GENERATION.labels(mode=mode).observe(seconds)
+    _stage_durations["llm"].observe(seconds)
+
+
+def record_first_audio(seconds: float):
+    """
+    Record time-to-first-audio-byte of a voice reply.
+
+    Args:
+        seconds: Time from end of user speech to the first audio byte
+    """
+    TTS_FIRST_AUDIO.observe(seconds)
+
+
+def record_cancellation(reason: str):
+    """
+    Count a reply stopped early.
+
+    Args:
+        reason: "disconnect" or "barge_in"
+    """
+    REQUESTS_CANCELLED.labels(reason=reason).inc()
+
+
+def record_speculation(outcome: str, saved_seconds: Optional[float] = None):
+    """
+    Record how a voice turn's speculative retrieval turned out.
+
+    Args:
+        outcome: "hit" (results reused), "miss" (transcript changed,
+            retrieved again) or "none" (no stable partial to start from)
+        saved_seconds: Retrieval latency that overlapped STT, for hits
+    """
+    RAG_SPECULATION.labels(outcome=outcome).inc()
+    if saved_seconds is not None:
+        RAG_SPECULATION_SAVED.observe(max(0.0, saved_seconds))
+
+
+def record_stage(stage: str, seconds: float):
+    """
+    Record the duration of one pipeline stage.
+
+    Args:
+        stage: One of STAGES
+        seconds: Stage duration
+    """
+    _stage_durations[stage].observe(seconds)
+
+
+@contextmanager
+def time_stage(stage: str) -> Iterator[Span]:
+    """
+    Time a pipeline stage; failures are counted and re-raised.
+
+    The stage is also a span of the current trace, yielded for attributes.
+
+    Args:
+        stage: One of STAGES
+    """
+    start = time.perf_counter()
+    try:
+        with tracer.span(stage) as span:
+            yield span
+    except Exception:
+        _stage_errors[stage].inc()
+        raise
+    finally:
+        _stage_durations[stage].observe(time.perf_counter() - start)
+
+
+# =============================================================================
+# Middleware
+# =============================================================================
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests and timing them per endpoint.
+
+    Implemented at the ASGI level rather than with BaseHTTPMiddleware so
+    streamed responses pass through untouched and are timed until their
+    last byte. Unknown paths share one "other" label to bound cardinality.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._paths = None
+
+    def _endpoint(self, scope) -> str:
+        if self._paths is None:
+            self._paths = {route.path for route in scope["app"].routes}
+        path = scope["path"]
+        return path if path in self._paths else "other"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        endpoint = self._endpoint(scope)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS.labels(method=scope["method"], endpoint=endpoint, status=str(status)).inc()
+            HTTP_DURATION.labels(endpoint=endpoint).observe(time.perf_counter() - start)
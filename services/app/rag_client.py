@@ -0,0 +1,179 @@
+"""
+RAG Retrieval Client
+
+Fetches passages relevant to a question from the RAG service and turns
+them into a grounding system message for the LLM. Voice turns can start
+retrieval speculatively on a partial transcript, so it overlaps the rest
+of speech-to-text instead of following it.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Optional
+
+import httpx
+
+import metrics
+from upstream import UpstreamClient
+
+logger = logging.getLogger(__name__)
+
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "4"))
+# Vector hits below this cosine similarity are not worth the prompt tokens
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.2"))
+# Bounds prompt growth (and so prompt-eval time) regardless of chunk size
+RAG_MAX_CONTEXT_CHARS = int(os.getenv("RAG_MAX_CONTEXT_CHARS", "3000"))
+# Partial transcripts shorter than this rarely retrieve what the full question does
+RAG_SPECULATION_MIN_WORDS = int(os.getenv("RAG_SPECULATION_MIN_WORDS", "3"))
+# Word overlap (Jaccard) between partial and final transcript for reusing the results
+RAG_SPECULATION_MIN_OVERLAP = float(os.getenv("RAG_SPECULATION_MIN_OVERLAP", "0.8"))
+
+WORD = re.compile(r"\w+")
+
+CONTEXT_INSTRUCTIONS = (
+    "Answer using the context below when it is relevant. "
+    "If the context does not contain the answer, say so briefly."
+)
+
+
+async def retrieve(client: UpstreamClient, query: str, top_k: int = RAG_TOP_K) -> list[dict]:
+    """
+    Search the RAG service.
+
+    POST /search with {"query": ..., "top_k": ..., "min_score": ...}
+    returns {"results": [{"id", "text", "score", "metadata", ...}],
+    "took_ms", "timings_ms"}. The service fuses vector and BM25 hits, so
+    the relevance cut-off is applied there, to the vector side only.
+
+    Args:
+        client: RAG upstream client
+        query: User question
+        top_k: Passages to fetch
+
+    Returns:
+        Passages, best first; empty if retrieval failed, so a RAG outage
+        degrades answers instead of failing them
+    """
+    try:
+        with metrics.time_stage("rag") as span:
+            response = await client.post(
+                "/search", route="completion", json={"query": query, "top_k": top_k, "min_score": RAG_MIN_SCORE}
+            )
+            response.raise_for_status()
+            body = response.json()
+            # The RAG service's own breakdown, next to the time the call took from here
+            timings = {f"{stage}_ms": ms for stage, ms in (body.get("timings_ms") or {}).items()}
+            span.set(results=len(body.get("results", [])), took_ms=body.get("took_ms"), **timings)
+    except httpx.HTTPError as e:
+        logger.warning(f"RAG retrieval failed, answering without context: {e!r}")
+        return []
+    return body.get("results", [])
+
+
+def context_message(passages: list[dict]) -> dict:
+    """
+    Build the system message carrying retrieved passages.
+
+    Args:
+        passages: Passages from retrieve(), best first
+
+    Returns:
+        System message with numbered passages, cut at RAG_MAX_CONTEXT_CHARS
+    """
+    parts = []
+    used = 0
+    for number, passage in enumerate(passages, 1):
+        text = passage["text"].strip()
+        if used + len(text) > RAG_MAX_CONTEXT_CHARS and parts:
+            break
+        parts.append(f"[{number}] {text}")
+        used += len(text)
+    return {"role": "system", "content": CONTEXT_INSTRUCTIONS + "\n\nContext:\n" + "\n\n".join(parts)}
+
+
+async def with_context(client: UpstreamClient, messages: list[dict], query: str) -> list[dict]:
+    """Prepend a context message for query to messages, if anything relevant was found"""
+    passages = await retrieve(client, query)
+    if not passages:
+        return messages
+    return [context_message(passages), *messages]
+
+
+def query_words(text: str) -> list[str]:
+    """Lowercased words, ignoring punctuation and spacing differences between transcripts"""
+    return WORD.findall(text.lower())
+
+
+def same_question(partial: str, final: str, min_overlap: float = RAG_SPECULATION_MIN_OVERLAP) -> bool:
+    """Whether results retrieved for partial can stand in for final"""
+    a, b = set(query_words(partial)), set(query_words(final))
+    if not a or not b:
+        return False
+    return len(a & b) / len(a | b) >= min_overlap
+
+
+class SpeculativeRetrieval:
+    """
+    Retrieval for one voice utterance, started before the transcript is final.
+
+    start() is called with each stable partial transcript and replaces any
+    earlier speculative query; result() takes the final transcript and
+    reuses the speculative results if the question has not materially
+    changed, otherwise cancels the query and retrieves afresh.
+    """
+
+    def __init__(self, client: UpstreamClient, top_k: int = RAG_TOP_K):
+        self.client = client
+        self.top_k = top_k
+        self.query: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.started_at = 0.0
+        self.finished_at: Optional[float] = None
+
+    def start(self, partial: str):
+        """Retrieve for a stable partial transcript in the background"""
+        if len(query_words(partial)) < RAG_SPECULATION_MIN_WORDS:
+            return
+        if self.query is not None and query_words(partial) == query_words(self.query):
+            return
+        self.cancel()
+        self.query = partial
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+        self.task = asyncio.create_task(retrieve(self.client, partial, self.top_k))
+        self.task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task):
+        if task is self.task:
+            self.finished_at = time.perf_counter()
+
+    def cancel(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+        self.task = None
+        self.query = None
+
+    async def result(self, transcript: str) -> list[dict]:
+        """
+        Passages for the final transcript.
+
+        Args:
+            transcript: Final transcript of the utterance
+
+        Returns:
+            Passages, best first; the speculative ones when the final
+            transcript asks the same question
+        """
+        final_at = time.perf_counter()
+        if self.task is not None and same_question(self.query, transcript):
+            passages = await self.task
+            waited = time.perf_counter() - final_at
+            # The retrieval time that overlapped STT instead of following it
+            metrics.record_speculation("hit", saved_seconds=(self.finished_at - self.started_at) - waited)
+            return passages
+        metrics.record_speculation("miss" if self.task is not None else "none")
+        self.cancel()
+        return await retrieve(self.client, transcript, self.top_k)
@@ -0,0 +1,27 @@
+from audio import RingBuffer
+
+
+def test_write_larger_than_capacity_counts_skipped_bytes():
+    ring = RingBuffer(8)
+    ring.write(b"0123456789ab")
+    assert ring.written == 12
+    assert ring.oldest == 4
+    assert ring.read(0) == b"456789ab"
+
+
+def test_positions_stay_in_sync_after_large_write():
+    ring = RingBuffer(8)
+    ring.write(b"xy")
+    ring.write(b"0123456789")
+    ring.write(b"cd")
+    assert ring.written == 14
+    assert ring.read(10) == b"89cd"
+    assert ring.read(ring.oldest) == b"456789cd"
+
+
+def test_wraparound_read():
+    ring = RingBuffer(8)
+    ring.write(b"abcdef")
+    ring.write(b"ghij")
+    assert ring.read(2, 10) == b"cdefghij"
+    assert ring.read(0) == b"cdefghij"
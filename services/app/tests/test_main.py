@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import main
+from llm_client import GenerationTiming
+from main import ChatRequest, MAX_CLOSE_REASON_BYTES, chat, close_reason
+
+
+class FakeStream:
+    """Stands in for an open LLM ChatStream"""
+
+    def __init__(self, deltas: list[str]):
+        self.deltas = deltas
+        self.timing = GenerationTiming(mode="text")
+        self.closed = 0
+
+    async def __aiter__(self):
+        for delta in self.deltas:
+            yield delta
+        self.timing.finished_at = self.timing.started_at + 0.1
+
+    async def aclose(self):
+        self.closed += 1
+
+
+@pytest.fixture
+def stream(monkeypatch):
+    stream = FakeStream(["Hello", " there"])
+
+    async def open_chat_stream(client, messages, mode="text", **options):
+        return stream
+
+    monkeypatch.setattr(main, "open_chat_stream", open_chat_stream)
+    monkeypatch.setattr(main, "get_upstream", lambda name: None)
+    return stream
+
+
+def serve(request: ChatRequest, receive, stream: FakeStream, stall_headers: bool = False) -> tuple[bytes, bool]:
+    """Run a /chat response; the body sent and whether the stream was closed by the end"""
+    sent = []
+
+    async def send(message):
+        if stall_headers and message["type"] == "http.response.start":
+            # A client that stops reading before the headers are out
+            await asyncio.Event().wait()
+        sent.append(message.get("body", b""))
+
+    async def scenario():
+        response = await chat(request)
+        await response({"type": "http"}, receive, send)
+        # Checked before asyncio.run() finalizes leftover generators, which a server never does
+        return bool(stream.closed)
+
+    closed = asyncio.run(scenario())
+    return b"".join(sent), closed
+
+
+def test_stream_closed_when_client_leaves_before_first_frame(stream):
+    async def receive():
+        await asyncio.sleep(0.01)
+        return {"type": "http.disconnect"}
+
+    body, closed = serve(ChatRequest(message="Hi"), receive, stream, stall_headers=True)
+    assert body == b""
+    assert closed
+
+
+def test_stream_closed_after_streaming(stream):
+    async def receive():
+        # The client stays connected
+        await asyncio.Event().wait()
+
+    body, closed = serve(ChatRequest(message="Hi"), receive, stream)
+    assert b'"content": "Hello"' in body and b'"type": "end"' in body
+    assert closed
+
+
+@pytest.mark.parametrize("message", ["x" * 500, "é" * 100, "upstream " + "日本" * 60])
+def test_close_reason_fits_close_frame(message):
+    reason = close_reason(RuntimeError(message))
+    assert len(reason.encode()) <= MAX_CLOSE_REASON_BYTES
+    assert message.startswith(reason)
+    assert len(reason.encode()) > MAX_CLOSE_REASON_BYTES - 3
+
+
+def test_close_reason_keeps_short_errors():
+    assert close_reason(ValueError("bad frame")) == "bad frame"
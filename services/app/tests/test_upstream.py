@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from upstream import CircuitBreaker, CircuitOpenError, UpstreamClient
+
+
+async def start_server(hang_first: int):
+    """Local HTTP server: the first hang_first connections never get a reply, later ones get 200"""
+    connections = 0
+
+    async def handle(reader, writer):
+        nonlocal connections
+        connections += 1
+        if connections <= hang_first:
+            await reader.read()
+        else:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+
+def test_cancelled_half_open_probe_lets_the_next_call_probe():
+    async def scenario():
+        server, url = await start_server(hang_first=1)
+        client = UpstreamClient("test", url, connect_retries=0, failure_threshold=1, reset_timeout=0)
+        try:
+            client.breaker.record_failure()
+            assert client.breaker.state == CircuitBreaker.OPEN
+
+            probe = asyncio.create_task(client.get("/"))
+            await asyncio.sleep(0.2)
+            assert client.breaker.state == CircuitBreaker.HALF_OPEN
+            # Only one probe at a time
+            with pytest.raises(CircuitOpenError):
+                await client.get("/")
+            probe.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+
+            response = await client.get("/")
+            assert response.status_code == 200
+            assert client.breaker.state == CircuitBreaker.CLOSED
+        finally:
+            await client.aclose()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_request_does_not_release_another_calls_probe():
+    async def scenario():
+        server, url = await start_server(hang_first=2)
+        client = UpstreamClient("test", url, connect_retries=0, failure_threshold=1, reset_timeout=0)
+        try:
+            # Sent while closed; the circuit opens and another call probes meanwhile
+            closed_call = asyncio.create_task(client.get("/"))
+            await asyncio.sleep(0.1)
+            client.breaker.record_failure()
+            probe = asyncio.create_task(client.get("/"))
+            await asyncio.sleep(0.1)
+            closed_call.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await closed_call
+            with pytest.raises(CircuitOpenError):
+                await client.get("/")
+            probe.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+        finally:
+            await client.aclose()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(scenario())
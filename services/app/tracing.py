@@ -0,0 +1,271 @@
+"""
+Request tracing
+Trace IDs travel between services in a W3C traceparent header and double
+as the request ID returned to clients in X-Request-ID. Each service keeps
+the spans of recent sampled traces in memory, so a slow request can be
+taken apart from a debug endpoint without a collector. Whether a trace is
+sampled is decided once, where it starts, and followed downstream.
+
+Kept identical in services/app and services/llm, as each image is built
+from its own directory; CI fails if the copies differ.
+"""
+
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_MAX_TRACES = int(os.getenv("TRACE_MAX_TRACES", "500"))
+# Spans kept per trace; a long voice session cannot grow one trace without bound
+MAX_SPANS_PER_TRACE = 256
+
+REQUEST_ID_HEADER = "X-Request-ID"
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+NO_TRACE = "0" * 32
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """One timed operation; ended spans of sampled traces go to the exporter"""
+
+    __slots__ = (
+        "tracer", "name", "trace_id", "span_id", "parent_id", "sampled", "local_root",
+        "attributes", "start", "duration", "_started",
+    )
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        sampled: bool,
+        local_root: bool = False,
+        attributes: Optional[dict] = None,
+    ):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.local_root = local_root
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.duration: Optional[float] = None
+        self._started = time.perf_counter()
+
+    def set(self, **attributes):
+        if self.sampled:
+            self.attributes.update(attributes)
+
+    def end(self, **attributes):
+        """Finish the span; later calls are ignored"""
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        if self.sampled:
+            self.attributes.update(attributes)
+            self.tracer.exporter.export(self)
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "attributes": self.attributes,
+        }
+
+
+class InMemoryExporter:
+    """The most recent sampled traces of this process, oldest dropped first"""
+
+    def __init__(self, max_traces: int = TRACE_MAX_TRACES):
+        self.max_traces = max_traces
+        # trace_id -> {"root": local root span once it has ended, "spans": [...]}
+        self.traces: OrderedDict[str, dict] = OrderedDict()
+
+    def export(self, span: Span):
+        trace = self.traces.get(span.trace_id)
+        if trace is None:
+            trace = self.traces[span.trace_id] = {"root": None, "spans": []}
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        if len(trace["spans"]) < MAX_SPANS_PER_TRACE:
+            trace["spans"].append(span)
+        if span.local_root and trace["root"] is None:
+            trace["root"] = span
+
+    def _describe(self, trace_id: str, trace: dict) -> dict:
+        root = trace["root"]
+        return {
+            "trace_id": trace_id,
+            "name": root.name if root else None,
+            "start": round(root.start, 6) if root else None,
+            "duration_ms": round(root.duration * 1000, 3) if root else None,
+            # Parents before children that start with them
+            "spans": [span.to_dict() for span in sorted(trace["spans"], key=lambda span: (span.start, -span.duration))],
+        }
+
+    def get(self, trace_id: str) -> Optional[dict]:
+        trace = self.traces.get(trace_id)
+        return self._describe(trace_id, trace) if trace else None
+
+    def slowest(self, limit: int = 10, span_name: Optional[str] = None) -> list[dict]:
+        """
+        Finished traces, slowest first.
+
+        Args:
+            limit: Traces to return
+            span_name: Rank by the longest span of this name instead of by
+                the whole trace; traces without one are left out
+        """
+        ranked = []
+        for trace_id, trace in list(self.traces.items()):
+            if trace["root"] is None:
+                continue
+            if span_name is None:
+                key = trace["root"].duration
+            else:
+                durations = [span.duration for span in trace["spans"] if span.name == span_name]
+                if not durations:
+                    continue
+                key = max(durations)
+            ranked.append((key, trace_id, trace))
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return [self._describe(trace_id, trace) for _, trace_id, trace in ranked[:limit]]
+
+
+class Tracer:
+    """Creates spans and decides sampling for traces that start here"""
+
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, max_traces: int = TRACE_MAX_TRACES):
+        self.sample_rate = sample_rate
+        self.exporter = InMemoryExporter(max_traces)
+
+    def start_trace(self, name: str, traceparent: Optional[str] = None, **attributes) -> Span:
+        """
+        Root span of this service's part of a trace.
+
+        Args:
+            name: Span name
+            traceparent: Incoming header; the caller's trace and sampling
+                decision are continued if it is valid
+            **attributes: Span attributes
+        """
+        match = TRACEPARENT.match(traceparent or "")
+        if match and match.group(1) != NO_TRACE:
+            trace_id, parent_id, sampled = match.group(1), match.group(2), match.group(3) == "01"
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = random.random() < self.sample_rate
+        return Span(self, name, trace_id, parent_id, sampled, local_root=True, attributes=attributes)
+
+    def start_span(self, name: str, parent: Optional[Span] = None, **attributes) -> Span:
+        """Child of parent, or of the current span; outside any trace it is never recorded"""
+        parent = parent or _current.get()
+        if parent is None:
+            return Span(self, name, NO_TRACE, None, sampled=False)
+        return Span(self, name, parent.trace_id, parent.span_id, parent.sampled, attributes=attributes)
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attributes) -> Iterator[Span]:
+        """Time the block as a span that is current inside it, so calls it makes become its children"""
+        span = self.start_span(name, parent, **attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
+
+    def record(self, name: str, parent: Span, start: float, duration: float, **attributes):
+        """Add a span measured elsewhere, e.g. from timings a server reports"""
+        if not parent.sampled:
+            return
+        span = Span(self, name, parent.trace_id, parent.span_id, True, attributes=attributes)
+        span.start = start
+        span.duration = duration
+        self.exporter.export(span)
+
+
+tracer = Tracer()
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def use_span(span: Optional[Span]) -> Iterator[Optional[Span]]:
+    """Make span current in the block without ending it; tasks created inside inherit it"""
+    token = _current.set(span)
+    try:
+        yield span
+    finally:
+        _current.reset(token)
+
+
+def propagation_headers() -> dict[str, str]:
+    """Headers carrying the current span to the next service; empty outside a trace"""
+    span = _current.get()
+    if span is None or span.trace_id == NO_TRACE:
+        return {}
+    return {"traceparent": span.traceparent, REQUEST_ID_HEADER: span.trace_id}
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware running each HTTP request in a trace.
+
+    The root span stays current for the whole request, streamed body
+    included, and ends with the last byte of the response. The trace ID is
+    returned in X-Request-ID whether or not the trace is sampled.
+    """
+
+    def __init__(self, app, exclude: tuple[str, ...] = ("/healthz", "/metrics", "/debug/")):
+        self.app = app
+        self.exclude = exclude
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        span = tracer.start_trace(
+            f"{scope['method']} {scope['path']}",
+            traceparent=headers.get(b"traceparent", b"").decode("latin-1"),
+        )
+        request_id = span.trace_id.encode()
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id)]
+                span.set(status=message["status"])
+            await send(message)
+
+        token = _current.set(span)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            _current.reset(token)
+            span.end()
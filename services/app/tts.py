@@ -0,0 +1,222 @@
+"""
+Pipelined Text-to-Speech
+
+Splits the LLM token stream into sentences or clauses as it arrives and
+synthesizes each one while the LLM keeps generating. Segments are
+synthesized with bounded parallelism but always played back in order;
+the first segment streams straight through as TTS produces it.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import metrics
+from upstream import UpstreamClient
+
+logger = logging.getLogger(__name__)
+
+PIPER_VOICE = os.getenv("PIPER_VOICE", "en_US-lessac-medium")
+
+# End of a sentence: terminator followed by whitespace
+SENTENCE_END = re.compile(r'[.!?…]+["\')\]]*\s')
+# Clause boundary, used once enough text has accumulated
+CLAUSE_END = re.compile(r'[,;:—]\s')
+# Abbreviations that end in a period without ending the sentence
+ABBREVIATIONS = {"mr.", "mrs.", "ms.", "dr.", "st.", "vs.", "etc.", "e.g.", "i.e.", "approx."}
+
+
+class SentenceSplitter:
+    """
+    Incrementally cut streamed text into speakable segments.
+
+    Sentences are always cut at their end. Clauses are cut when the
+    pending text is long enough, and the very first segment is cut at a
+    clause boundary early so audio can start as soon as possible.
+    """
+
+    def __init__(self, first_clause_chars: int = 20, clause_chars: int = 80):
+        self.first_clause_chars = first_clause_chars
+        self.clause_chars = clause_chars
+        self._pending = ""
+        self._emitted = 0
+
+    def feed(self, delta: str) -> list[str]:
+        self._pending += delta
+        segments = []
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                return segments
+            segment, self._pending = self._pending[:cut].strip(), self._pending[cut:]
+            if segment:
+                segments.append(segment)
+                self._emitted += 1
+
+    def flush(self) -> list[str]:
+        segment, self._pending = self._pending.strip(), ""
+        return [segment] if segment else []
+
+    def _find_cut(self) -> Optional[int]:
+        text = self._pending
+        for match in SENTENCE_END.finditer(text):
+            words = text[:match.start() + 1].split()
+            if words and words[-1].lower() in ABBREVIATIONS:
+                continue
+            # A period between digits is a decimal point, not a sentence end
+            if text[match.start()] == "." and match.start() > 0 and text[match.start() - 1].isdigit() \
+                    and match.end() < len(text) and text[match.end()].isdigit():
+                continue
+            return match.end()
+        threshold = self.first_clause_chars if self._emitted == 0 else self.clause_chars
+        if len(text) >= threshold:
+            clause = CLAUSE_END.search(text, threshold - 2)
+            if clause:
+                return clause.end()
+        return None
+
+
+class TTSClient:
+    """
+    Client for the TTS service.
+
+    POST /synthesize with {"text": ..., "voice": ...} streams back audio
+    bytes as they are synthesized.
+    """
+
+    def __init__(self, client: UpstreamClient, voice: str = PIPER_VOICE):
+        self.client = client
+        self.voice = voice
+
+    async def synthesize(self, text: str) -> AsyncIterator[bytes]:
+        async with self.client.stream(
+            "POST", "/synthesize", json={"text": text, "voice": self.voice}
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                if chunk:
+                    yield chunk
+
+
+class TTSPipeline:
+    """
+    Ordered, bounded-parallelism synthesis of text segments.
+
+    submit() starts a segment immediately (subject to the parallelism
+    limit); audio() yields every segment's audio in submission order,
+    forwarding the current segment's chunks as soon as they arrive while
+    later segments buffer in the background.
+    """
+
+    def __init__(self, tts: TTSClient, max_parallel: int = 2):
+        self.tts = tts
+        self.slots = asyncio.Semaphore(max_parallel)
+        self._segments: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    def submit(self, text: str):
+        chunks: asyncio.Queue = asyncio.Queue()
+        self._tasks.append(asyncio.create_task(self._synthesize(text, chunks)))
+        self._segments.put_nowait((text, chunks))
+
+    def close(self):
+        """No more segments will be submitted"""
+        self._segments.put_nowait(None)
+
+    def cancel(self):
+        """Abort synthesis still in progress, closing its TTS streams"""
+        pending = [task for task in self._tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            metrics.TTS_SEGMENTS_CANCELLED.inc(len(pending))
+
+    async def _synthesize(self, text: str, chunks: asyncio.Queue):
+        try:
+            async with self.slots:
+                with metrics.time_stage("tts"):
+                    async for chunk in self.tts.synthesize(text):
+                        chunks.put_nowait(chunk)
+        except Exception as e:
+            logger.error(f"TTS failed for segment: {e!r}")
+            chunks.put_nowait(e)
+        finally:
+            chunks.put_nowait(None)
+
+    async def audio(self) -> AsyncIterator[tuple[int, str, Optional[bytes]]]:
+        """
+        Yield (index, text, None) at the start of each segment, then
+        (index, text, chunk) for each of its audio chunks.
+        """
+        index = 0
+        while True:
+            item = await self._segments.get()
+            if item is None:
+                return
+            text, chunks = item
+            yield index, text, None
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                if isinstance(chunk, Exception):
+                    continue  # skip the failed segment, keep the rest of the reply
+                yield index, text, chunk
+            index += 1
+
+
+async def speak_stream(
+    deltas: AsyncIterator[str],
+    tts: TTSClient,
+    send_event: Callable[[dict], Awaitable[None]],
+    send_audio: Callable[[bytes], Awaitable[None]],
+    started_at: float,
+    max_parallel: int = 2,
+) -> Optional[float]:
+    """
+    Speak an LLM token stream while it is generated.
+
+    Args:
+        deltas: LLM content deltas
+        tts: TTS client
+        send_event: Sends a JSON event to the client
+        send_audio: Sends an audio chunk to the client
+        started_at: perf_counter time that time-to-first-audio is measured from
+        max_parallel: Segments synthesized at once
+
+    Returns:
+        Seconds from started_at to the first audio byte, or None if no
+        audio was produced
+    """
+    pipeline = TTSPipeline(tts, max_parallel=max_parallel)
+    splitter = SentenceSplitter()
+    first_audio: Optional[float] = None
+
+    async def feed():
+        try:
+            async for delta in deltas:
+                for segment in splitter.feed(delta):
+                    pipeline.submit(segment)
+            for segment in splitter.flush():
+                pipeline.submit(segment)
+        finally:
+            pipeline.close()
+
+    feeder = asyncio.create_task(feed())
+    try:
+        async for index, text, chunk in pipeline.audio():
+            if chunk is None:
+                await send_event({"type": "audio_segment", "index": index, "text": text})
+                continue
+            if first_audio is None:
+                first_audio = time.perf_counter() - started_at
+                metrics.record_first_audio(first_audio)
+            await send_audio(chunk)
+        await feeder  # surfaces LLM stream errors
+    finally:
+        feeder.cancel()
+        pipeline.cancel()
+    return first_audio
@@ -0,0 +1,339 @@
+"""
+Streaming Voice Pipeline
+
+Runs one /voice WebSocket session: incoming PCM goes into a ring buffer,
+the VAD segmenter cuts the utterance at short pauses and every finished
+piece is transcribed while the user keeps talking. When the utterance
+ends only the tail since the last pause is left to transcribe, so the
+final transcript follows the end of speech closely. Retrieval for RAG
+context starts on the stable part of the transcript while that tail is
+still being transcribed, and its results are reused unless the final
+transcript asks something materially different. The transcript is then
+answered by the LLM and spoken sentence by sentence while it is still
+generating, with per-stage timings sent as events.
+
+Protocol:
+    client -> server  binary: 16-bit little-endian mono PCM
+                      text:   {"type": "config", "sample_rate": 16000, "use_rag": true}
+                              {"type": "end"}  force end of utterance
+                              {"type": "barge_in"}  stop the current reply
+    server -> client  {"type": "vad", "state": "speech_start" | "speech_end"}
+                      {"type": "transcript", "final": bool, "text": str}
+                      {"type": "token", "content": str}
+                      {"type": "audio_segment", "index": int, "text": str}
+                      binary: reply audio for the current segment, in order
+                      {"type": "timing", "stage": str, "ms": float}
+                      {"type": "barge_in"}  reply stopped, user is talking
+                      {"type": "response_end"} / {"type": "error", "message": str}
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+import httpx
+from fastapi import WebSocket
+
+import metrics
+from audio import SAMPLE_WIDTH, RingBuffer, UtteranceSegmenter
+from llm_client import LLMError, open_chat_stream
+from rag_client import SpeculativeRetrieval, context_message
+from tracing import Span, tracer, use_span
+from tts import TTSClient, speak_stream
+from upstream import UpstreamClient
+
+logger = logging.getLogger(__name__)
+
+RING_SECONDS = 30
+# Reply segments synthesized at once
+TTS_PARALLEL = int(os.getenv("TTS_PARALLEL", "2"))
+# Whether detected speech interrupts a reply; needs echo cancellation on the client
+BARGE_IN_ENABLED = os.getenv("BARGE_IN_ENABLED", "true").lower() == "true"
+# Whether voice answers are grounded with RAG context; clients can override per session
+VOICE_USE_RAG = os.getenv("VOICE_USE_RAG", "true").lower() == "true"
+
+
+class STTClient:
+    """
+    Client for the STT service transcription endpoint.
+
+    POST /transcribe?sample_rate=N with the raw PCM as body returns
+    {"text": "..."}. The text already transcribed for the utterance is
+    sent as prompt so each piece is decoded in context.
+    """
+
+    def __init__(self, client: UpstreamClient):
+        self.client = client
+
+    async def transcribe(self, pcm: bytes, sample_rate: int, prompt: str = "") -> str:
+        params = {"sample_rate": sample_rate}
+        if prompt:
+            params["prompt"] = prompt[-200:]
+        audio_ms = round(len(pcm) / (sample_rate * SAMPLE_WIDTH) * 1000)
+        with tracer.span("stt.transcribe", audio_ms=audio_ms):
+            response = await self.client.post(
+                "/transcribe",
+                route="completion",
+                params=params,
+                content=pcm,
+                headers={"Content-Type": "application/octet-stream"},
+            )
+            response.raise_for_status()
+            return response.json().get("text", "").strip()
+
+
+class VoiceSession:
+    """State of one voice WebSocket connection"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        stt: STTClient,
+        llm: UpstreamClient,
+        tts: TTSClient,
+        rag: Optional[UpstreamClient] = None,
+        sample_rate: int = 16000,
+        stt_concurrency: int = 2,
+    ):
+        self.websocket = websocket
+        self.stt = stt
+        self.llm = llm
+        self.tts = tts
+        self.rag = rag
+        self.use_rag = VOICE_USE_RAG and rag is not None
+        self.stt_slots = asyncio.Semaphore(stt_concurrency)
+        self.history: list[dict] = []
+        self.response_task: Optional[asyncio.Task] = None
+        self.finishing: set[asyncio.Task] = set()
+        self._configure(sample_rate)
+
+    def _configure(self, sample_rate: int):
+        self.sample_rate = sample_rate
+        self.ring = RingBuffer(sample_rate * SAMPLE_WIDTH * RING_SECONDS)
+        self.segmenter = UtteranceSegmenter(sample_rate=sample_rate)
+        self._reset_utterance()
+
+    def _reset_utterance(self):
+        self.pieces: list[asyncio.Task] = []
+        self.texts: list[Optional[str]] = []
+        self.utterance_start: Optional[int] = None
+        self.piece_start: Optional[int] = None
+        self.retrieval = SpeculativeRetrieval(self.rag) if self.use_rag else None
+        # Trace of the utterance, from speech start until its reply has ended
+        self.turn: Optional[Span] = None
+
+    async def send(self, event: dict):
+        await self.websocket.send_text(json.dumps(event))
+
+    async def send_timing(self, stage: str, seconds: float):
+        await self.send({"type": "timing", "stage": stage, "ms": round(seconds * 1000, 1)})
+
+    async def run(self):
+        """Receive audio and control messages until the client disconnects"""
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes") is not None:
+                    await self.on_audio(message["bytes"])
+                elif message.get("text") is not None:
+                    await self.on_control(json.loads(message["text"]))
+        finally:
+            for task in [*self.pieces, *self.finishing]:
+                task.cancel()
+            if self.retrieval:
+                self.retrieval.cancel()
+            if self.response_task and not self.response_task.done():
+                self.response_task.cancel()
+
+    async def on_control(self, control: dict):
+        kind = control.get("type")
+        if kind == "config":
+            self.use_rag = bool(control.get("use_rag", self.use_rag)) and self.rag is not None
+            self._configure(int(control.get("sample_rate", self.sample_rate)))
+        elif kind == "barge_in":
+            if self.barge_in():
+                await self.send({"type": "barge_in"})
+        elif kind == "end" and self.utterance_start is not None:
+            self.segmenter.in_speech = False
+            await self.end_utterance(self.segmenter.position)
+
+    async def on_audio(self, data: bytes):
+        self.ring.write(data)
+        for event in self.segmenter.feed(data):
+            if event.kind == "speech_start":
+                self._reset_utterance()
+                self.utterance_start = self.piece_start = event.position
+                self.turn = tracer.start_trace("voice.turn")
+                await self.send({"type": "vad", "state": "speech_start"})
+                # Talking over the reply interrupts it
+                if BARGE_IN_ENABLED and self.barge_in():
+                    await self.send({"type": "barge_in"})
+            elif event.kind == "pause" and self.utterance_start is not None:
+                await self.transcribe_piece(event.position)
+            elif event.kind == "speech_end" and self.utterance_start is not None:
+                await self.end_utterance(event.position)
+
+    async def transcribe_piece(self, end: int):
+        """Start transcribing the audio since the last cut, without waiting for it"""
+        pcm = self.ring.read(self.piece_start, end)
+        if not pcm:
+            return
+        self.piece_start = end
+        self.texts.append(None)
+        index = len(self.texts) - 1
+        # Transcription and the retrieval it starts are part of the utterance's trace
+        with use_span(self.turn):
+            self.pieces.append(asyncio.create_task(self._transcribe(pcm, self.texts, index, self.retrieval)))
+
+    async def _transcribe(
+        self, pcm: bytes, texts: list[Optional[str]], index: int, retrieval: Optional[SpeculativeRetrieval]
+    ) -> str:
+        async with self.stt_slots:
+            # Earlier pieces usually finish first; their text is context for this one
+            prompt = " ".join(text for text in texts[:index] if text)
+            text = await self.stt.transcribe(pcm, self.sample_rate, prompt=prompt)
+        texts[index] = text
+        if retrieval and (texts is self.texts or None in texts):
+            # Utterance not fully transcribed yet: speculate on the finished prefix,
+            # which later pieces do not change
+            stable = texts[:texts.index(None)] if None in texts else texts
+            retrieval.start(" ".join(text for text in stable if text))
+        if texts is self.texts and self.segmenter.in_speech:
+            # Still talking: share what has been recognized so far
+            partial = " ".join(text for text in texts if text)
+            await self.send({"type": "transcript", "final": False, "text": partial})
+        return text
+
+    async def end_utterance(self, end: int):
+        """Transcribe the tail and finish the utterance in the background"""
+        speech_end_at = time.perf_counter()
+        await self.send({"type": "vad", "state": "speech_end"})
+        segmenter = self.segmenter
+        # Trailing silence only costs STT time; keep a little for the last phoneme
+        voiced_end = min(end, segmenter.last_voiced_end + 5 * segmenter.frame_bytes)
+        await self.transcribe_piece(voiced_end)
+        pieces, retrieval, turn = self.pieces, self.retrieval, self.turn
+        self._reset_utterance()
+        # Silence the VAD waited through before declaring the end of speech
+        endpointing_seconds = max(0, end - segmenter.last_voiced_end) / segmenter.bytes_per_ms / 1000
+        # The turn started with speech; how long the user talked tells that apart from waiting
+        turn.set(
+            speech_ms=round((time.time() - turn.start) * 1000, 1),
+            endpointing_ms=round(endpointing_seconds * 1000, 1),
+        )
+        # Keep receiving audio while the last piece is transcribed
+        with use_span(turn):
+            task = asyncio.create_task(
+                self.finish_utterance(pieces, retrieval, speech_end_at, endpointing_seconds, turn)
+            )
+        self.finishing.add(task)
+        task.add_done_callback(self.finishing.discard)
+
+    async def finish_utterance(
+        self,
+        pieces: list[asyncio.Task],
+        retrieval: Optional[SpeculativeRetrieval],
+        speech_end_at: float,
+        endpointing_seconds: float,
+        turn: Span,
+    ):
+        """Assemble the final transcript and answer it; the turn's trace ends with the reply"""
+        try:
+            with metrics.time_stage("stt"):
+                texts = await asyncio.gather(*pieces)
+        except httpx.HTTPError as e:
+            if retrieval:
+                retrieval.cancel()
+            turn.end(outcome="stt_error")
+            logger.error(f"Transcription failed: {e!r}")
+            await self.send({"type": "error", "message": "Transcription failed"})
+            return
+        transcript = " ".join(text for text in texts if text)
+        stt_seconds = time.perf_counter() - speech_end_at
+        await self.send({"type": "transcript", "final": True, "text": transcript})
+        await self.send_timing("endpointing", endpointing_seconds)
+        await self.send_timing("stt", stt_seconds)
+        await self.send_timing("audio_to_transcript", endpointing_seconds + stt_seconds)
+        if not transcript:
+            if retrieval:
+                retrieval.cancel()
+            turn.end(outcome="empty")
+            return
+
+        # Reuses the speculative results if the question did not change
+        context = asyncio.create_task(retrieval.result(transcript)) if retrieval else None
+        previous = self.response_task
+        self.response_task = asyncio.create_task(self.respond(transcript, speech_end_at, previous, context))
+        self.response_task.add_done_callback(
+            lambda task: turn.end(outcome="cancelled" if task.cancelled() else "answered")
+        )
+
+    async def respond(
+        self,
+        transcript: str,
+        speech_end_at: float,
+        previous: Optional[asyncio.Task] = None,
+        context: Optional[asyncio.Task] = None,
+    ):
+        """Stream the LLM answer as token events and speak it sentence by sentence"""
+        if previous and not previous.done():
+            await asyncio.wait([previous])
+        self.history.append({"role": "user", "content": transcript})
+        messages = self.history[-10:]
+        if context:
+            # Only the part of retrieval that did not overlap STT delays the reply
+            rag_start = time.perf_counter()
+            with tracer.span("rag.wait"):
+                passages = await context
+            await self.send_timing("rag", time.perf_counter() - rag_start)
+            if passages:
+                messages = [context_message(passages), *messages]
+        try:
+            stream = await open_chat_stream(self.llm, messages, mode="voice")
+        except (LLMError, httpx.RequestError) as e:
+            logger.error(f"LLM request failed: {e}")
+            await self.send({"type": "error", "message": "LLM unavailable"})
+            return
+        parts = []
+
+        async def deltas():
+            async for delta in stream:
+                if not parts:
+                    await self.send_timing("llm_ttft", stream.timing.ttft)
+                parts.append(delta)
+                await self.send({"type": "token", "content": delta})
+                yield delta
+
+        try:
+            first_audio = await speak_stream(
+                deltas(), self.tts, self.send, self.websocket.send_bytes,
+                started_at=speech_end_at, max_parallel=TTS_PARALLEL
+            )
+            if first_audio is not None:
+                await self.send_timing("first_audio", first_audio)
+        except (LLMError, httpx.HTTPError) as e:
+            logger.error(f"LLM stream failed: {e}")
+            await self.send({"type": "error", "message": "LLM stream failed"})
+        finally:
+            # On barge-in this aborts the LLM generation; speak_stream has already
+            # cancelled outstanding TTS segments
+            await stream.aclose()
+            # Keep what was said, even if interrupted, so the conversation stays coherent
+            self.history.append({"role": "assistant", "content": "".join(parts)})
+        if stream.timing.total is not None:
+            await self.send_timing("llm", stream.timing.total)
+        await self.send({"type": "response_end"})
+
+    def barge_in(self) -> bool:
+        """Stop the reply in progress, LLM generation and TTS included; True if there was one"""
+        task = self.response_task
+        if task is None or task.done():
+            return False
+        task.cancel()
+        metrics.record_cancellation("barge_in")
+        return True
@@ -0,0 +1,62 @@
+"""
+Request cancellation
+Stops generation as soon as the client is gone: streamed responses are
+cancelled by Starlette when the client disconnects, non-streaming ones are
+raced against a disconnect watcher here. Closing the llama-server
+connection makes llama.cpp stop generating and frees the slot.
+"""
+
+import asyncio
+from typing import Awaitable, Optional, TypeVar
+
+from fastapi import Request
+from prometheus_client import Counter
+
+T = TypeVar("T")
+
+REQUESTS_CANCELLED = Counter(
+    'llm_requests_cancelled_total', 'Generations stopped because the client went away', ['mode']
+)
+TOKENS_SAVED = Counter(
+    'llm_tokens_saved_total', 'Tokens of max_tokens left ungenerated by cancelled requests'
+)
+
+
+class ClientDisconnected(Exception):
+    """The HTTP client disconnected before the response was ready"""
+
+
+def record_cancellation(mode: str, max_tokens: int, generated: Optional[int] = None):
+    """Count a cancelled generation; tokens saved are only known when tokens were streamed"""
+    REQUESTS_CANCELLED.labels(mode=mode).inc()
+    if generated is not None:
+        TOKENS_SAVED.inc(max(max_tokens - generated, 0))
+
+
+async def _wait_for_disconnect(request: Request):
+    # The body has been read, so the next ASGI message is the disconnect
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_until_disconnect(request: Request, work: Awaitable[T]) -> T:
+    """Await work, cancelling it and raising ClientDisconnected if the client leaves first"""
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.create_task(_wait_for_disconnect(request))
+    try:
+        await asyncio.wait([task, watcher], return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        raise ClientDisconnected()
+    return task.result()
@@ -0,0 +1,130 @@
+"""
+Chat templating
+Renders the full OpenAI-style message list in the prompt format of the
+configured model. Rendering is append-only: the prompt for turn N is an
+exact prefix of the prompt for turn N+1, which is what lets llama.cpp
+reuse the KV cache for everything but the new turn.
+"""
+
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ChatTemplate:
+    """Prompt format for one model family"""
+    name: str
+    message: str  # format string with {role} and {content}
+    generation_prompt: str  # opens the assistant turn the model completes
+    bos: str = ""
+    stop: tuple[str, ...] = ()
+    roles: dict[str, str] = field(default_factory=dict)  # role renames, e.g. system -> user
+
+
+TEMPLATES = {
+    "chatml": ChatTemplate(
+        name="chatml",
+        message="<|im_start|>{role}\n{content}<|im_end|>\n",
+        generation_prompt="<|im_start|>assistant\n",
+        stop=("<|im_end|>", "<|im_start|>"),
+    ),
+    "phi3": ChatTemplate(
+        name="phi3",
+        message="<|{role}|>\n{content}<|end|>\n",
+        generation_prompt="<|assistant|>\n",
+        stop=("<|end|>", "<|user|>", "<|endoftext|>"),
+    ),
+    "llama3": ChatTemplate(
+        name="llama3",
+        message="<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>",
+        generation_prompt="<|start_header_id|>assistant<|end_header_id|>\n\n",
+        bos="<|begin_of_text|>",
+        stop=("<|eot_id|>", "<|start_header_id|>"),
+    ),
+    # TinyLlama chat models use the Zephyr format
+    "zephyr": ChatTemplate(
+        name="zephyr",
+        message="<|{role}|>\n{content}</s>\n",
+        generation_prompt="<|assistant|>\n",
+        stop=("</s>", "<|user|>"),
+    ),
+}
+
+# Substrings of a GGUF file name that identify its template
+FILENAME_HINTS = [
+    ("phi-3", "phi3"),
+    ("llama-3", "llama3"),
+    ("tinyllama", "zephyr"),
+    ("qwen", "chatml"),
+]
+
+
+@dataclass
+class RenderedPrompt:
+    """Prompt text plus its pieces, for per-segment token counting"""
+    text: str
+    segments: list[str]
+
+
+class ChatRenderer:
+    """Renders messages with one template and an optional default system prompt"""
+
+    def __init__(self, template: ChatTemplate, system_prompt: Optional[str] = None):
+        self.template = template
+        self.system_prompt = system_prompt
+
+    def render(self, messages: list) -> RenderedPrompt:
+        template = self.template
+        segments = [template.bos] if template.bos else []
+        if self.system_prompt and not any(m.role == "system" for m in messages):
+            segments.append(template.message.format(role="system", content=self.system_prompt))
+        for message in messages:
+            role = template.roles.get(message.role, message.role)
+            segments.append(template.message.format(role=role, content=message.content.strip()))
+        segments.append(template.generation_prompt)
+        return RenderedPrompt(text="".join(segments), segments=segments)
+
+
+def load_model_config(path: Optional[str] = None) -> dict:
+    """Read model_config.json; missing or invalid files yield an empty config"""
+    path = path or os.getenv("MODEL_CONFIG_PATH", os.path.join(os.path.dirname(__file__), "model_config.json"))
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError as e:
+        logger.error(f"Invalid model config {path}: {e}")
+        return {}
+
+
+def resolve_template_name(model_path: str, config: dict) -> str:
+    """Pick the template: LLAMA_CHAT_TEMPLATE, then model_config.json if it describes this model, then file name"""
+    override = os.getenv("LLAMA_CHAT_TEMPLATE")
+    if override:
+        return override
+    model_file = os.path.basename(model_path)
+    config_file = config.get("model_file") or os.path.basename(config.get("model_path", ""))
+    if config.get("chat_template") and config_file == model_file:
+        return config["chat_template"]
+    lowered = model_file.lower()
+    for hint, name in FILENAME_HINTS:
+        if hint in lowered:
+            return name
+    return "chatml"
+
+
+def create_renderer(model_path: str, config: Optional[dict] = None) -> ChatRenderer:
+    config = load_model_config() if config is None else config
+    name = resolve_template_name(model_path, config)
+    template = TEMPLATES.get(name)
+    if template is None:
+        logger.warning(f"Unknown chat template {name}, using chatml")
+        template = TEMPLATES["chatml"]
+    logger.info(f"Using chat template {template.name} for {os.path.basename(model_path)}")
+    return ChatRenderer(template, system_prompt=config.get("system_prompt"))
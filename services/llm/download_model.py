@@ -1,101 +1,391 @@
 #!/usr/bin/env python3
 """
-Model download script for Llama 3.1 8B Instruct in GGUF format
-Downloads the Q4_K_M quantized version for optimal CPU performance
+Model downloader
+Fetches the GGUF file described by model_config.json ("model_url",
+"model_sha256", "model_path") with parallel HTTP Range requests.
+
+- Parts are written at their offsets into a preallocated <file>.part
+- Finished parts are recorded in a <file>.part.json sidecar, so an
+  interrupted download resumes with only the unfinished parts
+- SHA-256 is computed while downloading, over the contiguous finished
+  prefix of the file, and checked against the manifest hash
+- The verified file is renamed into place, so llama-server never sees a
+  partial model
+
+Servers without Range support fall back to a single stream. Without a
+manifest hash, the sha256 Hugging Face reports for LFS files is used; if
+there is neither, nothing is downloaded unless --allow-unverified is given.
+
+Usage:
+    python download_model.py                      # as configured
+    python download_model.py --url http://127.0.0.1:9000/model.gguf --output /tmp/model.gguf
 """
 
+import argparse
+import hashlib
+import json
 import os
+import re
 import sys
-import requests
-import hashlib
-from pathlib import Path
-
-# Model configuration - Using Phi-3 Mini for fast testing
-MODEL_NAME = "phi-3-mini"
-MODEL_FILE = "Phi-3-mini-4k-instruct-Q4_K_M.gguf"
-MODEL_URL = f"https://huggingface.co/microsoft/Phi-3-mini-4k-instruct-gguf/resolve/main/{MODEL_FILE}"
-MODEL_PATH = "/models"
-EXPECTED_SIZE = 2.3 * 1024 * 1024 * 1024  # ~2.3GB
-
-def download_file(url: str, filepath: str) -> bool:
-    """Download file with progress bar"""
-    print(f"Downloading {MODEL_FILE}...")
-    print(f"URL: {url}")
-    print(f"Destination: {filepath}")
-    
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import httpx
+
+from chat_template import load_model_config
+
+PART_SIZE = 16 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+RETRIES = 5
+SHA256 = re.compile(r"^[0-9a-f]{64}$")
+CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+
+
+class DownloadError(Exception):
+    """The file could not be downloaded or failed verification"""
+
+
+def linked_sha256(responses: list[httpx.Response]) -> Optional[str]:
+    """The sha256 Hugging Face reports for an LFS file in X-Linked-ETag, from the first response carrying one"""
+    for response in responses:
+        linked = response.headers.get("x-linked-etag", "").strip('"').lower()
+        if SHA256.match(linked):
+            return linked
+    return None
+
+
+def probe(client: httpx.Client, url: str) -> dict:
+    """
+    Size, validator, Range support and reported sha256 of the remote file.
+
+    Asks for the first byte only: a 206 answer carries the full size in
+    Content-Range, a 200 means the server ignores ranges.
+    """
+    # Hugging Face sends the linked ETag on its redirect, not on the CDN response it leads to
     try:
-        response = requests.get(url, stream=True)
+        head = [client.head(url, follow_redirects=False)]
+    except httpx.HTTPError:
+        head = []
+    with client.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
         response.raise_for_status()
-        
-        total_size = int(response.headers.get('content-length', 0))
-        downloaded = 0
-        
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    if total_size > 0:
-                        percent = (downloaded / total_size) * 100
-                        print(f"\rProgress: {percent:.1f}% ({downloaded / (1024*1024*1024):.2f}GB / {total_size / (1024*1024*1024):.2f}GB)", end="", flush=True)
-        
-        print(f"\nDownload completed: {filepath}")
+        headers = response.headers
+        ranges = response.status_code == 206
+        if ranges:
+            size = int(headers["content-range"].rsplit("/", 1)[1])
+        else:
+            size = int(headers.get("content-length", 0))
+        chain = [*head, *response.history, response]
+    return {
+        "size": size,
+        "ranges": ranges,
+        "validator": headers.get("etag") or headers.get("last-modified") or "",
+        "sha256": linked_sha256(chain),
+    }
+
+
+class ProgressFile:
+    """Sidecar recording which parts of the .part file are complete"""
+
+    def __init__(self, path: str, identity: dict):
+        self.path = path
+        self.identity = identity
+        self.done: set[int] = set()
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Take over finished parts from an earlier run for the same file; False if there is none"""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if saved.get("identity") != self.identity:
+            return False
+        self.done = set(saved["done"])
         return True
-        
-    except Exception as e:
-        print(f"\nError downloading model: {e}")
-        return False
-
-def verify_file(filepath: str) -> bool:
-    """Verify downloaded file"""
-    if not os.path.exists(filepath):
-        print(f"File not found: {filepath}")
-        return False
-    
-    file_size = os.path.getsize(filepath)
-    print(f"File size: {file_size / (1024*1024*1024):.2f}GB")
-    
-    if file_size < EXPECTED_SIZE * 0.9:  # Allow 10% tolerance
-        print(f"Warning: File size seems too small (expected ~{EXPECTED_SIZE / (1024*1024*1024):.1f}GB)")
-        return False
-    
-    print("File verification passed")
-    return True
 
-def main():
-    """Main download function"""
-    print("=== Llama 3.1 8B Instruct Model Downloader ===")
-    print(f"Model: {MODEL_NAME}")
-    print(f"Quantization: Q4_K_M (optimized for CPU)")
-    print(f"Expected size: ~4.7GB")
-    print()
-    
-    # Create models directory
-    os.makedirs(MODEL_PATH, exist_ok=True)
-    model_filepath = os.path.join(MODEL_PATH, MODEL_FILE)
-    
-    # Check if model already exists
-    if os.path.exists(model_filepath):
-        print(f"Model already exists: {model_filepath}")
-        if verify_file(model_filepath):
-            print("Model is ready to use!")
+    def mark_done(self, index: int, fd: int):
+        with self._lock:
+            # Data first: the sidecar must never claim bytes that are not on disk
+            os.fsync(fd)
+            self.done.add(index)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"identity": self.identity, "done": sorted(self.done)}, f)
+            os.replace(tmp, self.path)
+
+
+class Hasher:
+    """SHA-256 of the file, advanced over the finished prefix as parts complete"""
+
+    def __init__(self, fd: int, size: int, part_size: int):
+        self.fd = fd
+        self.size = size
+        self.part_size = part_size
+        self.sha256 = hashlib.sha256()
+        self.next_part = 0
+        self.hashed = 0
+
+    def advance(self, done: set[int]):
+        while self.next_part in done:
+            end = min((self.next_part + 1) * self.part_size, self.size)
+            while self.hashed < end:
+                # Just written, so usually still in the page cache
+                block = os.pread(self.fd, min(READ_SIZE, end - self.hashed), self.hashed)
+                self.sha256.update(block)
+                self.hashed += len(block)
+            self.next_part += 1
+
+
+def check_content_range(response: httpx.Response, start: int, end: int, size: int):
+    """A 206 must carry exactly the requested bytes of a file of the probed size"""
+    match = CONTENT_RANGE.match(response.headers.get("content-range", ""))
+    if (
+        not match
+        or (int(match.group(1)), int(match.group(2)) + 1) != (start, end)
+        or match.group(3) not in ("*", str(size))
+    ):
+        raise DownloadError(
+            f"Asked for bytes {start}-{end - 1} of {size}, got Content-Range {response.headers.get('content-range')!r}"
+        )
+
+
+def download_part(
+    client: httpx.Client, url: str, fd: int, start: int, end: int, size: int, stop: threading.Event
+) -> int:
+    """Fetch bytes [start, end) of a size-byte file into fd at their offset, retrying with backoff"""
+    for attempt in range(RETRIES):
+        position = start
+        try:
+            headers = {"Range": f"bytes={start}-{end - 1}"}
+            with client.stream("GET", url, headers=headers) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise DownloadError(f"Expected a 206 for a range request, got {response.status_code}")
+                check_content_range(response, start, end, size)
+                for chunk in response.iter_bytes(READ_SIZE):
+                    if stop.is_set():
+                        raise DownloadError("Download stopped")
+                    chunk = chunk[:end - position]
+                    os.pwrite(fd, chunk, position)
+                    position += len(chunk)
+            if position == end:
+                return end - start
+            raise httpx.ReadError(f"Connection closed {end - position} bytes early")
+        except httpx.HTTPError as e:
+            if attempt == RETRIES - 1:
+                raise DownloadError(f"Bytes {start}-{end - 1} failed after {RETRIES} attempts: {e!r}")
+            time.sleep(min(2 ** attempt, 30))
+
+
+def preallocate(fd: int, size: int):
+    """Reserve the space up front: no fragmentation, and a full disk fails now rather than at 90%"""
+    if hasattr(os, "posix_fallocate") and size:
+        try:
+            os.posix_fallocate(fd, 0, size)
             return
-        else:
-            print("Existing model file appears corrupted, re-downloading...")
-            os.remove(model_filepath)
-    
-    # Download the model
-    print("Starting download...")
-    if download_file(MODEL_URL, model_filepath):
-        if verify_file(model_filepath):
-            print("\n✅ Model download completed successfully!")
-            print(f"Model ready at: {model_filepath}")
-        else:
-            print("\n❌ Model verification failed")
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+def print_progress(downloaded: int, total: int, started: float, resumed: int):
+    elapsed = max(time.monotonic() - started, 1e-6)
+    rate = (downloaded - resumed) / elapsed / (1024 * 1024)
+    percent = downloaded / total * 100 if total else 0.0
+    print(
+        f"\rProgress: {percent:.1f}% ({downloaded / 1024 ** 3:.2f}GB / {total / 1024 ** 3:.2f}GB) {rate:.1f}MB/s",
+        end="",
+        flush=True,
+    )
+
+
+def download(
+    url: str,
+    path: str,
+    sha256: Optional[str] = None,
+    workers: int = 8,
+    part_size: int = PART_SIZE,
+    timeout: float = 30.0,
+    allow_unverified: bool = False,
+) -> str:
+    """
+    Download url to path, resuming an earlier attempt if there is one.
+
+    Args:
+        url: File URL
+        path: Destination file
+        sha256: Expected hex digest; the server's, if it reports one, when None
+        workers: Concurrent range requests
+        part_size: Bytes per range request and per resume unit
+        timeout: Connect and read timeout per request
+        allow_unverified: Download even if neither sha256 nor the server
+            gives a hash to check against
+
+    Returns:
+        The SHA-256 hex digest, verified unless allow_unverified applied
+
+    Raises:
+        DownloadError: On failure, if there is no hash to verify against,
+            or if the hash does not match (the partial file is discarded then)
+    """
+    part_path = path + ".part"
+    progress_path = part_path + ".json"
+    limits = httpx.Limits(max_connections=workers, max_keepalive_connections=workers)
+    with httpx.Client(follow_redirects=True, timeout=timeout, limits=limits) as client:
+        remote = probe(client, url)
+        expected = (sha256 or remote["sha256"] or "").lower() or None
+        if expected is None and not allow_unverified:
+            raise DownloadError(
+                "No SHA-256 to verify against: set model_sha256 in model_config.json or pass --allow-unverified"
+            )
+        size = remote["size"]
+        if not remote["ranges"] or not size:
+            print("Server does not support range requests, downloading in one stream")
+            workers, part_size = 1, max(size, 1)
+        identity = {"url": url, "size": size, "validator": remote["validator"], "part_size": part_size}
+        progress = ProgressFile(progress_path, identity)
+        # A single stream cannot resume; start over
+        resumed = remote["ranges"] and progress.load() and os.path.exists(part_path)
+
+        fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+        try:
+            if not resumed:
+                os.ftruncate(fd, 0)
+                preallocate(fd, size)
+            parts = [(i, i * part_size, min((i + 1) * part_size, size)) for i in range((size + part_size - 1) // part_size)]
+            todo = [part for part in parts if part[0] not in progress.done]
+            done_bytes = sum(end - start for i, start, end in parts if i in progress.done)
+            if resumed:
+                print(f"Resuming: {done_bytes / 1024 ** 3:.2f}GB already downloaded, {len(todo)} parts left")
+
+            hasher = Hasher(fd, size, part_size)
+            stop = threading.Event()
+            started = time.monotonic()
+            resumed_bytes = done_bytes
+
+            if remote["ranges"]:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    futures = {
+                        pool.submit(download_part, client, url, fd, start, end, size, stop): index
+                        for index, start, end in todo
+                    }
+                    try:
+                        pending = set(futures)
+                        while pending:
+                            finished = {f for f in pending if f.done()}
+                            failed = [f for f in finished if f.exception() is not None]
+                            # Record every part that made it before giving up, so a rerun skips them
+                            for future in finished.difference(failed):
+                                done_bytes += future.result()
+                                progress.mark_done(futures[future], fd)
+                            if failed:
+                                failed[0].result()
+                            pending -= finished
+                            hasher.advance(progress.done)
+                            print_progress(done_bytes, size, started, resumed_bytes)
+                            if pending:
+                                time.sleep(0.2)
+                    except BaseException:
+                        stop.set()
+                        raise
+            else:
+                with client.stream("GET", url) as response:
+                    response.raise_for_status()
+                    position = 0
+                    for chunk in response.iter_bytes(READ_SIZE):
+                        os.pwrite(fd, chunk, position)
+                        hasher.sha256.update(chunk)
+                        position += len(chunk)
+                        print_progress(position, size, started, 0)
+                hasher.hashed = size = position
+            print()
+
+            hasher.advance(progress.done)
+            if hasher.hashed != size:
+                raise DownloadError(f"Only {hasher.hashed} of {size} bytes were written")
+            digest = hasher.sha256.hexdigest()
+            if expected is None:
+                print(f"Warning: not verified (--allow-unverified); the file hashes to {digest}")
+            elif digest != expected:
+                os.remove(part_path)
+                if os.path.exists(progress_path):
+                    os.remove(progress_path)
+                raise DownloadError(f"SHA-256 mismatch: expected {expected}, got {digest}")
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    os.replace(part_path, path)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    return digest
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(READ_SIZE):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def main():
+    config = load_model_config()
+    parser = argparse.ArgumentParser(description="Download the model described by model_config.json")
+    parser.add_argument("--url", default=config.get("model_url"), help="Overrides model_url")
+    parser.add_argument("--sha256", default=config.get("model_sha256"), help="Overrides model_sha256")
+    parser.add_argument(
+        "--output",
+        default=os.getenv("MODEL_PATH") or config.get("model_path"),
+        help="Destination file (default: MODEL_PATH, then model_path)",
+    )
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent range requests")
+    parser.add_argument("--part-size-mb", type=int, default=PART_SIZE // (1024 * 1024))
+    parser.add_argument("--force", action="store_true", help="Download even if the file exists")
+    parser.add_argument(
+        "--allow-unverified", action="store_true", help="Accept a file no SHA-256 is known for"
+    )
+    args = parser.parse_args()
+
+    if not args.url or not args.output:
+        print("No model_url/model_path in model_config.json and no --url/--output given")
+        sys.exit(2)
+
+    print(f"=== Model Downloader: {config.get('model_name', os.path.basename(args.output))} ===")
+    print(f"URL: {args.url}")
+    print(f"Destination: {args.output}")
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+
+    if os.path.exists(args.output) and not args.force:
+        if not args.sha256:
+            if args.allow_unverified:
+                print("Model already exists (no SHA-256 configured, not verified)")
+                return
+            print("❌ Model already exists but cannot be verified: set model_sha256 or pass --allow-unverified")
             sys.exit(1)
-    else:
-        print("\n❌ Model download failed")
+        print("Model already exists, verifying...")
+        if file_sha256(args.output) == args.sha256.lower():
+            print("✅ Model is ready to use!")
+            return
+        print("Existing model failed verification, downloading again")
+
+    try:
+        digest = download(
+            args.url,
+            args.output,
+            sha256=args.sha256,
+            workers=args.workers,
+            part_size=args.part_size_mb * 1024 * 1024,
+            allow_unverified=args.allow_unverified,
+        )
+    except (DownloadError, httpx.HTTPError, OSError) as e:
+        print(f"\n❌ Model download failed: {e}")
         sys.exit(1)
+    print(f"✅ Model ready at {args.output} (sha256 {digest})")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Fake llama-server for local testing
+Speaks the subset of the llama.cpp server protocol used by main.py
+(/health, /tokenize and /completion with optional SSE streaming) without a model.
+/stats reports generated and cancelled counts, to check that dropped
+clients really stop generation.
+
+Timing is deterministic, for load tests (benchmarks/bench_chat_load.py):
+--prompt-ms-per-token is spent before the first token on the prompt
+tokens not already cached for the slot, then --token-delay per token.
+--reply-tokens sets the reply length (the canned reply, repeated).
+
+Logs slot and timing lines to stderr in llama.cpp's format after every
+request; --verbose adds a line per token, enough output to fill a pipe
+nobody reads.
+
+Accepts and ignores the real llama-server flags, so it can stand in via
+LLAMA_SERVER_BIN="python fake_llama_server.py".
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+REPLY = "Hello! This is a canned reply from the fake llama-server."
+
+app = FastAPI(title="Fake llama-server")
+settings = {
+    "token_delay": 0.0,
+    "prompt_ms_per_token": 0.5,
+    "reply_tokens": 0,
+    "startup_delay": 0.0,
+    "n_ctx_slot": 4096,
+    "verbose": False,
+    "started_at": time.time(),
+}
+# Last prompt seen per slot, to report KV-cache reuse like llama.cpp does
+slot_prompts: dict[int, list[str]] = {}
+stats = {"tokens_generated": 0, "completions": 0, "cancelled": 0}
+
+
+def _tokens(text: str) -> list[str]:
+    """Split into word-sized pieces that keep their leading space, like BPE output"""
+    words = text.split(" ")
+    return [words[0]] + [f" {word}" for word in words[1:]]
+
+
+def _reply(n_predict: int) -> list[str]:
+    """The canned reply, repeated to --reply-tokens if set, cut at n_predict"""
+    tokens = _tokens(REPLY)
+    if settings["reply_tokens"]:
+        repeated = _tokens(" ".join([REPLY] * (settings["reply_tokens"] // len(tokens) + 1)))
+        tokens = repeated[:settings["reply_tokens"]]
+    return tokens[:n_predict]
+
+
+def _cached_prefix(slot: int, prompt_tokens: list[str]) -> int:
+    previous = slot_prompts.get(slot, [])
+    common = 0
+    for a, b in zip(previous, prompt_tokens):
+        if a != b:
+            break
+        common += 1
+    slot_prompts[slot] = prompt_tokens
+    return common
+
+
+def _timings(n_prompt: int, n_cached: int, n_predicted: int, elapsed: float) -> dict:
+    predicted_ms = max(elapsed * 1000, 0.001)
+    return {
+        "prompt_n": n_prompt - n_cached,
+        "prompt_ms": settings["prompt_ms_per_token"] * (n_prompt - n_cached),
+        "predicted_n": n_predicted,
+        "predicted_ms": predicted_ms,
+        "predicted_per_second": n_predicted / (predicted_ms / 1000),
+    }
+
+
+def _log(line: str):
+    print(line, file=sys.stderr, flush=True)
+
+
+def _log_request(slot: int, task: int, n_prompt: int, n_cached: int, n_predicted: int, elapsed: float):
+    """The lines llama-server prints when a request finishes"""
+    timings = _timings(n_prompt, n_cached, n_predicted, elapsed)
+    slot = max(slot, 0)
+    prompt_ms, prompt_n = timings["prompt_ms"], timings["prompt_n"]
+    predicted_ms = timings["predicted_ms"]
+    _log(
+        f"slot update_slots: id  {slot} | task {task} | new prompt, n_ctx_slot = {settings['n_ctx_slot']}, "
+        f"n_keep = 0, n_prompt_tokens = {n_prompt}"
+    )
+    if prompt_n:
+        _log(
+            f"prompt eval time = {prompt_ms:10.2f} ms / {prompt_n:5d} tokens "
+            f"({prompt_ms / prompt_n:8.2f} ms per token, {prompt_n * 1000 / max(prompt_ms, 0.001):8.2f} tokens per second)"
+        )
+    if n_predicted:
+        _log(
+            f"       eval time = {predicted_ms:10.2f} ms / {n_predicted:5d} tokens "
+            f"({predicted_ms / n_predicted:8.2f} ms per token, {timings['predicted_per_second']:8.2f} tokens per second)"
+        )
+    _log(f"      total time = {prompt_ms + predicted_ms:10.2f} ms / {prompt_n + n_predicted:5d} tokens")
+    _log(f"slot      release: id  {slot} | task {task} | stop processing: n_past = {n_prompt + n_predicted}, truncated = 0")
+
+
+@app.get("/health")
+async def health():
+    if time.time() - settings["started_at"] < settings["startup_delay"]:
+        return JSONResponse({"error": {"code": 503, "message": "Loading model"}}, status_code=503)
+    return {"status": "ok"}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+@app.post("/tokenize")
+async def tokenize(request: Request):
+    body = await request.json()
+    return {"tokens": list(range(len(_tokens(body.get("content", "")))))}
+
+
+@app.post("/completion")
+async def completion(request: Request):
+    body = await request.json()
+    prompt = body.get("prompt", "")
+    tokens = _reply(body.get("n_predict", 512))
+    prompt_tokens = _tokens(prompt)
+    n_prompt = len(prompt_tokens)
+    slot = body.get("id_slot", -1)
+    n_cached = _cached_prefix(slot, prompt_tokens) if body.get("cache_prompt") and slot >= 0 else 0
+    start = time.time()
+    stats["completions"] += 1
+    task = stats["completions"]
+    # Prompt evaluation; the KV cache above makes repeated prefixes cheap, as in llama.cpp
+    prompt_seconds = settings["prompt_ms_per_token"] * (n_prompt - n_cached) / 1000
+
+    if not body.get("stream"):
+        await asyncio.sleep(prompt_seconds)
+        for _ in tokens:
+            await asyncio.sleep(settings["token_delay"])
+            # llama.cpp also polls the connection while generating a non-streamed reply
+            if await request.is_disconnected():
+                stats["cancelled"] += 1
+                return JSONResponse({}, status_code=499)
+            stats["tokens_generated"] += 1
+        _log_request(slot, task, n_prompt, n_cached, len(tokens), time.time() - start)
+        return {
+            "content": "".join(tokens),
+            "stop": True,
+            "tokens_evaluated": n_prompt,
+            "tokens_predicted": len(tokens),
+            "timings": _timings(n_prompt, n_cached, len(tokens), time.time() - start),
+        }
+
+    async def stream():
+        try:
+            if prompt_seconds:
+                await asyncio.sleep(prompt_seconds)
+            for token in tokens:
+                if settings["token_delay"]:
+                    await asyncio.sleep(settings["token_delay"])
+                stats["tokens_generated"] += 1
+                if settings["verbose"]:
+                    _log(f"slot process_toke: id  {max(slot, 0)} | task {task} | n_decoded = {stats['tokens_generated']}, token = {token!r}")
+                yield f"data: {json.dumps({'content': token, 'stop': False})}\n\n"
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client went away: like llama.cpp, stop generating
+            stats["cancelled"] += 1
+            raise
+        _log_request(slot, task, n_prompt, n_cached, len(tokens), time.time() - start)
+        final = {
+            "content": "",
+            "stop": True,
+            "tokens_evaluated": n_prompt,
+            "tokens_predicted": len(tokens),
+            "timings": _timings(n_prompt, n_cached, len(tokens), time.time() - start),
+        }
+        yield f"data: {json.dumps(final)}\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--token-delay", type=float, default=float(os.getenv("FAKE_TOKEN_DELAY", "0")))
+    parser.add_argument(
+        "--prompt-ms-per-token", type=float, default=float(os.getenv("FAKE_PROMPT_MS_PER_TOKEN", "0.5"))
+    )
+    parser.add_argument("--reply-tokens", type=int, default=int(os.getenv("FAKE_REPLY_TOKENS", "0")))
+    parser.add_argument("--startup-delay", type=float, default=float(os.getenv("FAKE_STARTUP_DELAY", "0")))
+    parser.add_argument("--verbose", action="store_true", default=os.getenv("FAKE_VERBOSE", "") == "1")
+    # Real llama-server flags that shape what is logged
+    parser.add_argument("--ctx-size", type=int, default=4096)
+    parser.add_argument("--parallel", type=int, default=1)
+    args, _ = parser.parse_known_args()
+
+    settings["token_delay"] = args.token_delay
+    settings["prompt_ms_per_token"] = args.prompt_ms_per_token
+    settings["reply_tokens"] = args.reply_tokens
+    settings["startup_delay"] = args.startup_delay
+    settings["n_ctx_slot"] = args.ctx_size // max(args.parallel, 1)
+    settings["verbose"] = args.verbose
+    settings["started_at"] = time.time()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
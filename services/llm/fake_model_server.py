@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Fake model host for local testing
+Serves one file with HTTP Range support the way the Hugging Face CDN
+does (206 + Content-Range, ETag, sha256 in X-Linked-ETag), so
+download_model.py can be exercised without a multi-GB download.
+--drop-rate makes some responses stop halfway, to exercise retries and
+resume; --no-ranges makes it ignore Range headers.
+
+Usage:
+    python fake_model_server.py /tmp/model.gguf --port 9000 --drop-rate 0.2
+    python download_model.py --url http://127.0.0.1:9000/model.gguf --output /tmp/out.gguf
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import re
+
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+import uvicorn
+
+RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+CHUNK = 256 * 1024
+
+app = FastAPI(title="Fake model host")
+settings = {"path": "", "sha256": "", "drop_rate": 0.0, "ranges": True}
+stats = {"requests": 0, "bytes": 0, "dropped": 0}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+@app.get("/{name}")
+async def serve(name: str, request: Request):
+    stats["requests"] += 1
+    path = settings["path"]
+    size = os.path.getsize(path)
+    headers = {
+        "ETag": f'"{settings["sha256"][:16]}"',
+        "X-Linked-ETag": f'"{settings["sha256"]}"',
+        "Accept-Ranges": "bytes" if settings["ranges"] else "none",
+    }
+    start, end, status = 0, size, 200
+    match = RANGE.fullmatch(request.headers.get("range", ""))
+    if settings["ranges"] and match:
+        start = int(match.group(1))
+        end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+        if start >= size:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+    headers["Content-Length"] = str(end - start)
+    # Dropped responses end early, like a connection reset mid-transfer
+    cut = start + (end - start) // 2 if random.random() < settings["drop_rate"] and end - start > 1 else end
+    if cut < end:
+        stats["dropped"] += 1
+
+    def body():
+        with open(path, "rb") as f:
+            f.seek(start)
+            position = start
+            while position < cut:
+                block = f.read(min(CHUNK, cut - position))
+                position += len(block)
+                stats["bytes"] += len(block)
+                yield block
+            if cut < end:
+                raise ConnectionResetError("Dropped by --drop-rate")
+
+    return StreamingResponse(body(), status_code=status, headers=headers, media_type="application/octet-stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("file", help="File to serve, under any name")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--no-ranges", action="store_true")
+    args = parser.parse_args()
+
+    sha256 = hashlib.sha256()
+    with open(args.file, "rb") as f:
+        while block := f.read(1024 * 1024):
+            sha256.update(block)
+    settings.update(path=args.file, sha256=sha256.hexdigest(), drop_rate=args.drop_rate, ranges=not args.no_ranges)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+llama-server output
+A child blocks on write once its pipe buffer (64 KiB on Linux) is full,
+stalling generation, so each child's stdout and stderr share one pipe that
+is read for as long as the child runs. Lines are forwarded to the
+llama_server logger, rate-limited per child, and the timing lines
+llama.cpp prints after every request feed Prometheus metrics whether or
+not the line itself was forwarded.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import IO, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Lines per second forwarded per child, and how many may come at once
+LLAMA_LOG_RATE = float(os.getenv("LLAMA_LOG_RATE", "20"))
+LLAMA_LOG_BURST = int(os.getenv("LLAMA_LOG_BURST", "200"))
+# Longer lines (e.g. a logged prompt) are dropped rather than buffered
+MAX_LINE_BYTES = 64 * 1024
+# Seconds between reports of how many lines were not logged
+SUPPRESSED_REPORT_INTERVAL = 10.0
+
+logger = logging.getLogger(__name__)
+server_logger = logging.getLogger("llama_server")
+
+PROMPT_EVAL_MS_PER_TOKEN = Histogram(
+    'llama_server_prompt_eval_ms_per_token', 'Prompt evaluation time per token reported by llama-server',
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+)
+EVAL_TOKENS_PER_SECOND = Histogram(
+    'llama_server_eval_tokens_per_second', 'Generation speed per request reported by llama-server',
+    buckets=(1, 2.5, 5, 10, 15, 20, 30, 50, 75, 100, 200)
+)
+LAST_PROMPT_EVAL_MS_PER_TOKEN = Gauge(
+    'llama_server_last_prompt_eval_ms_per_token', 'Prompt evaluation time per token of the last request', ['instance']
+)
+LAST_EVAL_TOKENS_PER_SECOND = Gauge(
+    'llama_server_last_eval_tokens_per_second', 'Generation speed of the last request', ['instance']
+)
+KV_CACHE_USAGE = Gauge(
+    'llama_server_kv_cache_usage_ratio', 'Share of the slot context held in the KV cache', ['instance', 'slot']
+)
+LOG_LINES_SUPPRESSED = Counter(
+    'llama_server_log_lines_suppressed_total', 'llama-server output lines not logged, over the rate limit or too long', ['instance']
+)
+
+# "prompt eval time =  123.45 ms /  10 tokens ( 12.35 ms per token,  81.00 tokens per second)"
+# and the same for "eval time"; older builds prefix llama_print_timings: and count runs
+TIMING = re.compile(
+    r"(prompt eval|eval) time\s*=\s*[\d.]+ ms\s*/\s*(\d+) (?:tokens|runs)\s*"
+    r"\(\s*([\d.]+) ms per token,\s*([\d.]+) tokens per second\)"
+)
+# "slot update_slots: id  0 | task 3 | new prompt, n_ctx_slot = 4096, ..."
+SLOT_CONTEXT = re.compile(r"\bid\s+(\d+) \|.*\bn_ctx_slot = (\d+)")
+# "slot      release: id  0 | task 3 | stop processing: n_past = 75, ..."
+SLOT_PAST = re.compile(r"\bid\s+(\d+) \|.*\bn_past = (\d+)")
+ERROR_LINE = re.compile(r"\b(error|failed|fatal|abort)", re.IGNORECASE)
+
+
+class TimingParser:
+    """Metrics from one child's per-request timing and slot lines"""
+
+    def __init__(self, instance: str):
+        self.instance = instance
+        # slot -> context size, learnt from the line that starts each request
+        self.slot_context: dict[str, int] = {}
+
+    def feed(self, line: str):
+        if "time =" in line:
+            match = TIMING.search(line)
+            if match:
+                kind, tokens, ms_per_token, tokens_per_second = match.groups()
+                if int(tokens) == 0:
+                    return
+                if kind == "prompt eval":
+                    PROMPT_EVAL_MS_PER_TOKEN.observe(float(ms_per_token))
+                    LAST_PROMPT_EVAL_MS_PER_TOKEN.labels(instance=self.instance).set(float(ms_per_token))
+                else:
+                    EVAL_TOKENS_PER_SECOND.observe(float(tokens_per_second))
+                    LAST_EVAL_TOKENS_PER_SECOND.labels(instance=self.instance).set(float(tokens_per_second))
+            return
+        if "n_ctx_slot" in line:
+            match = SLOT_CONTEXT.search(line)
+            if match:
+                self.slot_context[match.group(1)] = int(match.group(2))
+        if "n_past" in line:
+            match = SLOT_PAST.search(line)
+            if match and self.slot_context.get(match.group(1)):
+                slot, n_past = match.group(1), int(match.group(2))
+                KV_CACHE_USAGE.labels(instance=self.instance, slot=slot).set(n_past / self.slot_context[slot])
+
+
+class RateLimiter:
+    """Token bucket: rate per second on average, burst at once"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class OutputDrainer:
+    """Reads one child's output pipe until it closes"""
+
+    def __init__(self, instance: str, rate: float = LLAMA_LOG_RATE, burst: int = LLAMA_LOG_BURST):
+        self.instance = instance
+        self.limiter = RateLimiter(rate, burst)
+        self.parser = TimingParser(instance)
+        self.suppressed = 0
+        self.reported_at = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self, pipe: IO[bytes]):
+        """Start reading pipe on the running loop"""
+        self.task = asyncio.create_task(self._drain(pipe))
+
+    async def _drain(self, pipe: IO[bytes]):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=MAX_LINE_BYTES)
+        try:
+            transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        except OSError as e:
+            logger.error(f"Cannot read output of {self.instance}: {e}")
+            return
+        try:
+            while True:
+                try:
+                    raw = await reader.readline()
+                except ValueError:
+                    # Over MAX_LINE_BYTES; the reader has already discarded it
+                    self._skip()
+                    continue
+                if not raw:
+                    break
+                self.handle(raw.decode(errors="replace").rstrip())
+        finally:
+            transport.close()
+            self._report_suppressed(final=True)
+
+    def handle(self, line: str):
+        if not line:
+            return
+        try:
+            self.parser.feed(line)
+        except ValueError as e:
+            logger.debug(f"Unparsed llama-server line from {self.instance}: {e}")
+        if not self.limiter.allow():
+            self._skip()
+            return
+        self._report_suppressed()
+        level = logging.WARNING if ERROR_LINE.search(line) else logging.INFO
+        server_logger.log(level, f"[{self.instance}] {line}")
+
+    def _skip(self):
+        self.suppressed += 1
+        LOG_LINES_SUPPRESSED.labels(instance=self.instance).inc()
+
+    def _report_suppressed(self, final: bool = False):
+        now = time.monotonic()
+        if not self.suppressed or (not final and now - self.reported_at < SUPPRESSED_REPORT_INTERVAL):
+            return
+        server_logger.warning(
+            f"[{self.instance}] {self.suppressed} lines not logged in the last {now - self.reported_at:.0f}s"
+        )
+        self.suppressed = 0
+        self.reported_at = now
+
+    async def stop(self, timeout: float = 2.0):
+        """Wait for the rest of the output once the child has exited, then give up"""
+        if self.task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), timeout)
+        except asyncio.TimeoutError:
+            # A grandchild still holds the pipe open
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
@@ -0,0 +1,431 @@
+"""
+llama-server process pool
+Runs N llama-server children, each on its own port with its own thread and
+CPU-affinity slice, and routes every request to the healthy child with the
+fewest outstanding requests.
+"""
+
+import asyncio
+import logging
+import os
+import shlex
+import subprocess
+import signal
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+from llama_logs import OutputDrainer
+from sessions import SESSION_ROUTING, SessionAffinity
+from upstream import CircuitOpenError, UpstreamClient
+
+logger = logging.getLogger(__name__)
+
+INSTANCE_OUTSTANDING = Gauge(
+    'llama_instance_outstanding_requests', 'Requests in flight per llama-server instance', ['instance']
+)
+INSTANCE_TOKENS_PER_SECOND = Gauge(
+    'llama_instance_tokens_per_second', 'Smoothed generation speed per llama-server instance', ['instance']
+)
+INSTANCE_HEALTHY = Gauge(
+    'llama_instance_healthy', 'Whether the llama-server instance passed its last health check', ['instance']
+)
+INSTANCE_RESTARTS = Counter(
+    'llama_instance_restarts_total', 'Automatic restarts of llama-server instances', ['instance']
+)
+INSTANCE_FAILOVERS = Counter(
+    'llama_instance_failovers_total', 'Requests moved to another instance after a connect failure', ['instance']
+)
+
+# Errors raised before a request reaches llama-server, so it is safe to try another instance
+FAILOVER_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, CircuitOpenError)
+
+
+class NoHealthyInstanceError(RuntimeError):
+    """Raised when no llama-server instance can take a request"""
+
+
+class LlamaInstance:
+    """One llama-server child process and its pooled client"""
+
+    def __init__(
+        self, index: int, host: str, port: int, cpus: list[int], threads: int, client: UpstreamClient, name: str = ""
+    ):
+        self.index = index
+        self.name = name or f"llama-{index}"
+        self.host = host
+        self.port = port
+        self.cpus = cpus
+        self.threads = threads
+        self.client = client
+        self.process: Optional[subprocess.Popen] = None
+        self.output: Optional[OutputDrainer] = None
+        self.healthy = False
+        self.outstanding = 0
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self.tokens_per_second = 0.0
+        self.spawned_at = 0.0
+        self.ever_healthy = False
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def is_running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def set_healthy(self, healthy: bool):
+        self.healthy = healthy
+        self.ever_healthy = self.ever_healthy or healthy
+        INSTANCE_HEALTHY.labels(instance=self.name).set(1 if healthy else 0)
+
+    def _track(self, delta: int):
+        self.outstanding += delta
+        INSTANCE_OUTSTANDING.labels(instance=self.name).set(self.outstanding)
+
+    def record_speed(self, tokens_per_second: float, alpha: float = 0.2):
+        """Fold a new generation speed sample into the moving average"""
+        if tokens_per_second <= 0:
+            return
+        if self.tokens_per_second == 0.0:
+            self.tokens_per_second = tokens_per_second
+        else:
+            self.tokens_per_second += alpha * (tokens_per_second - self.tokens_per_second)
+        INSTANCE_TOKENS_PER_SECOND.labels(instance=self.name).set(self.tokens_per_second)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "port": self.port,
+            "healthy": self.healthy,
+            "running": self.is_running(),
+            "outstanding": self.outstanding,
+            "tokens_per_second": round(self.tokens_per_second, 2),
+            "restarts": self.restarts,
+        }
+
+
+def cpu_slices(size: int, cpus: Optional[list[int]] = None) -> list[list[int]]:
+    """Split the available CPUs into size contiguous, non-overlapping slices"""
+    if cpus is None:
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = list(range(os.cpu_count() or 1))
+    if len(cpus) < size:
+        # More instances than CPUs: share round-robin rather than leave one with none
+        return [[cpus[i % len(cpus)]] for i in range(size)]
+    per_instance = len(cpus) // size
+    return [cpus[i * per_instance:(i + 1) * per_instance] for i in range(size)]
+
+
+class LlamaServerPool:
+    """Supervises llama-server children and balances requests across them"""
+
+    def __init__(
+        self,
+        model_path: str,
+        client_factory: Callable[[str, str], UpstreamClient],
+        size: int = 1,
+        host: str = "127.0.0.1",
+        base_port: int = 8080,
+        threads_per_instance: Optional[int] = None,
+        binary: str = "llama-server",
+        extra_args: Optional[list[str]] = None,
+        health_interval: float = 5.0,
+        unhealthy_restart_after: int = 6,
+        ready_timeout: float = 300.0,
+        slots_per_instance: int = 1,
+        name: str = "llama",
+    ):
+        self.model_path = model_path
+        self.name = name
+        self.binary = shlex.split(binary)
+        self.extra_args = extra_args or []
+        self.health_interval = health_interval
+        self.unhealthy_restart_after = unhealthy_restart_after
+        self.ready_timeout = ready_timeout
+        self.slots_per_instance = slots_per_instance
+        self.sessions = SessionAffinity(slots_per_instance)
+        self.instances: list[LlamaInstance] = []
+        self._monitor_task: Optional[asyncio.Task] = None
+
+        for index, cpus in enumerate(cpu_slices(size)):
+            port = base_port + index
+            url = f"http://{host}:{port}"
+            instance_name = f"{name}-{index}"
+            client = client_factory(instance_name, url)
+            threads = threads_per_instance or len(cpus)
+            self.instances.append(LlamaInstance(index, host, port, cpus, threads, client, instance_name))
+
+    def _command(self, instance: LlamaInstance) -> list[str]:
+        return self.binary + [
+            "--model", self.model_path,
+            "--host", instance.host,
+            "--port", str(instance.port),
+            "--threads", str(instance.threads),
+        ] + self.extra_args
+
+    def _spawn(self, instance: LlamaInstance):
+        cpus = instance.cpus
+
+        def preexec():
+            os.setsid()  # Own process group so the whole child tree can be signalled
+            if hasattr(os, "sched_setaffinity"):
+                try:
+                    os.sched_setaffinity(0, cpus)
+                except OSError:
+                    pass
+
+        cmd = self._command(instance)
+        logger.info(f"Starting {instance.name} on port {instance.port} (cpus {cpus}): {' '.join(cmd)}")
+        instance.process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            preexec_fn=preexec,
+        )
+        # Read for the child's whole life: a full pipe would block llama-server mid-generation
+        instance.output = OutputDrainer(instance.name)
+        instance.output.start(instance.process.stdout)
+        instance.consecutive_failures = 0
+        instance.spawned_at = time.monotonic()
+        instance.ever_healthy = False
+        instance.set_healthy(False)
+
+    def start(self):
+        """Spawn every child; readiness is established by check_health"""
+        for instance in self.instances:
+            self._spawn(instance)
+
+    async def _probe(self, instance: LlamaInstance) -> bool:
+        if not instance.is_running():
+            return False
+        try:
+            response = await instance.client.get("/health", route="health")
+            return response.status_code == 200
+        except httpx.RequestError:
+            return False
+
+    async def check_health(self) -> int:
+        """Probe all children concurrently and return how many are healthy"""
+        results = await asyncio.gather(*(self._probe(instance) for instance in self.instances))
+        for instance, healthy in zip(self.instances, results):
+            instance.set_healthy(healthy)
+            instance.consecutive_failures = 0 if healthy else instance.consecutive_failures + 1
+        return sum(results)
+
+    def healthy_count(self) -> int:
+        return sum(1 for instance in self.instances if instance.healthy)
+
+    async def wait_until_ready(self, timeout: float, initial_delay: float = 0.25, max_delay: float = 1.0) -> int:
+        """Poll children with exponential backoff until all are healthy, all have exited or timeout passes"""
+        deadline = time.monotonic() + timeout
+        delay = initial_delay
+        while True:
+            healthy = await self.check_health()
+            if healthy == len(self.instances):
+                return healthy
+            if not any(instance.is_running() for instance in self.instances):
+                logger.error("All llama-server instances exited during startup")
+                return healthy
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return healthy
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+    async def warm_up(self, prompt: str, n_predict: int):
+        """Run one short completion on every healthy child to fault in weights and build compute graphs"""
+        async def warm(instance: LlamaInstance):
+            start = time.monotonic()
+            try:
+                response = await instance.client.post(
+                    "/completion",
+                    route="completion",
+                    json={"prompt": prompt, "n_predict": n_predict, "temperature": 0, "stream": False},
+                )
+                response.raise_for_status()
+                logger.info(f"Warmed up {instance.name} in {time.monotonic() - start:.2f}s")
+            except httpx.HTTPError as e:
+                logger.warning(f"Warm-up of {instance.name} failed: {e}")
+
+        await asyncio.gather(*(warm(instance) for instance in self.instances if instance.healthy))
+
+    async def _restart(self, instance: LlamaInstance, reason: str):
+        logger.warning(f"Restarting {instance.name}: {reason}")
+        await asyncio.to_thread(self._terminate, instance)
+        await self._stop_output(instance)
+        instance.restarts += 1
+        INSTANCE_RESTARTS.labels(instance=instance.name).inc()
+        self._spawn(instance)
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                for instance in self.instances:
+                    if instance.process is not None and not instance.is_running():
+                        await self._restart(instance, f"exited with code {instance.process.returncode}")
+                await self.check_health()
+                for instance in self.instances:
+                    if instance.healthy:
+                        continue
+                    if instance.ever_healthy:
+                        # Was serving and stopped answering: treat as hung
+                        if instance.consecutive_failures >= self.unhealthy_restart_after:
+                            await self._restart(
+                                instance, f"failed {instance.consecutive_failures} consecutive health checks"
+                            )
+                    elif time.monotonic() - instance.spawned_at > self.ready_timeout:
+                        # Still loading is expected; only give up after the readiness deadline
+                        await self._restart(instance, f"not ready within {self.ready_timeout:.0f}s")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"llama-server pool monitor error: {e}")
+
+    def start_monitor(self):
+        if self._monitor_task is None:
+            self._monitor_task = asyncio.create_task(self._monitor())
+
+    def _pick(self, exclude: set[int]) -> LlamaInstance:
+        candidates = [i for i in self.instances if i.healthy and i.index not in exclude]
+        if not candidates:
+            raise NoHealthyInstanceError("No healthy llama-server instance available")
+        return min(candidates, key=lambda i: (i.outstanding, i.index))
+
+    def _place(self, session: Optional[str], exclude: set[int]) -> tuple[LlamaInstance, Optional[tuple[int, int]]]:
+        """
+        Choose an instance and, for a conversation, the slot holding its KV cache.
+        A pinned conversation stays put unless its instance is down or saturated.
+        Returns the claimed (instance, slot) placement, or None to let llama.cpp pick a slot.
+        """
+        if session is None:
+            return self._pick(exclude), None
+        placement = self.sessions.get(session)
+        if placement is not None:
+            instance = self.instances[placement[0]]
+            if instance.healthy and instance.index not in exclude and instance.outstanding < self.slots_per_instance:
+                if self.sessions.claim(placement):
+                    SESSION_ROUTING.labels(result="pinned").inc()
+                    return instance, placement
+                # Same conversation already generating in that slot; don't queue behind it
+                SESSION_ROUTING.labels(result="slot_busy").inc()
+                return instance, None
+            SESSION_ROUTING.labels(result="moved").inc()
+        else:
+            SESSION_ROUTING.labels(result="new").inc()
+        instance = self._pick(exclude)
+        placement = self.sessions.pin(session, instance.index)
+        return instance, placement if self.sessions.claim(placement) else None
+
+    @staticmethod
+    def _with_slot(kwargs: dict, placement: Optional[tuple[int, int]]) -> dict:
+        if "json" not in kwargs:
+            return kwargs
+        body = {**kwargs["json"], "id_slot": placement[1] if placement else -1}
+        return {**kwargs, "json": body}
+
+    async def request(
+        self, method: str, path: str, route: str = "default", session: Optional[str] = None, **kwargs
+    ) -> tuple[LlamaInstance, httpx.Response]:
+        """Send a request to the conversation's or least-loaded child, failing over on connect errors"""
+        tried: set[int] = set()
+        while True:
+            instance, placement = self._place(session, tried)
+            instance._track(1)
+            try:
+                send_kwargs = self._with_slot(kwargs, placement) if session else kwargs
+                return instance, await instance.client.request(method, path, route=route, **send_kwargs)
+            except FAILOVER_ERRORS as e:
+                self._mark_failed(instance, tried, e)
+            finally:
+                instance._track(-1)
+                if placement:
+                    self.sessions.release(placement)
+
+    @asynccontextmanager
+    async def stream(
+        self, method: str, path: str, session: Optional[str] = None, **kwargs
+    ) -> AsyncIterator[tuple[LlamaInstance, httpx.Response]]:
+        """Open a streaming request on the conversation's or least-loaded child, failing over on connect errors"""
+        tried: set[int] = set()
+        while True:
+            instance, placement = self._place(session, tried)
+            instance._track(1)
+            try:
+                try:
+                    send_kwargs = self._with_slot(kwargs, placement) if session else kwargs
+                    context = instance.client.stream(method, path, **send_kwargs)
+                    response = await context.__aenter__()
+                except FAILOVER_ERRORS as e:
+                    self._mark_failed(instance, tried, e)
+                    continue
+                try:
+                    yield instance, response
+                except BaseException as e:
+                    if not await context.__aexit__(type(e), e, e.__traceback__):
+                        raise
+                else:
+                    await context.__aexit__(None, None, None)
+                return
+            finally:
+                instance._track(-1)
+                if placement:
+                    self.sessions.release(placement)
+
+    def _mark_failed(self, instance: LlamaInstance, tried: set[int], error: Exception):
+        logger.warning(f"{instance.name} unreachable ({error}), failing over")
+        instance.set_healthy(False)
+        tried.add(instance.index)
+        INSTANCE_FAILOVERS.labels(instance=instance.name).inc()
+
+    def stats(self) -> list[dict]:
+        return [instance.stats() for instance in self.instances]
+
+    async def _stop_output(self, instance: LlamaInstance):
+        if instance.output is not None:
+            await instance.output.stop()
+            instance.output = None
+
+    def _terminate(self, instance: LlamaInstance):
+        process = instance.process
+        if process is None:
+            return
+        if process.poll() is not None:
+            instance.process = None
+            instance.set_healthy(False)
+            return
+        try:
+            os.killpg(os.getpgid(process.pid), signal.SIGTERM)
+            process.wait(timeout=10)
+        except (subprocess.TimeoutExpired, ProcessLookupError):
+            logger.warning(f"Force killing {instance.name}...")
+            try:
+                os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            # Reap it, or it stays a zombie
+            process.wait()
+        instance.process = None
+        instance.set_healthy(False)
+
+    async def stop(self):
+        """Stop the monitor, every child process and their clients"""
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            try:
+                await self._monitor_task
+            except asyncio.CancelledError:
+                pass
+            self._monitor_task = None
+        # Off the event loop: while a swap retires this pool, the new one is serving
+        await asyncio.gather(*(asyncio.to_thread(self._terminate, instance) for instance in self.instances))
+        for instance in self.instances:
+            await self._stop_output(instance)
+            await instance.client.aclose()
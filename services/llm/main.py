@@ -5,22 +5,34 @@ Provides OpenAI-compatible API with SSE streaming support
 
 import os
 import json
+import secrets
 import asyncio
 import time
-import subprocess
-import signal
 import logging
 import httpx
 from typing import Optional, AsyncGenerator
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
 from fastapi.responses import StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
+from upstream import UpstreamClient
+from llama_pool import LlamaInstance, LlamaServerPool, NoHealthyInstanceError
+from model_manager import Deployment, ModelManager, ModelSettings, SwapError
+from startup import StartupTracker
+from tokenizer import TokenCounter, record_usage
+from chat_template import TEMPLATES, ChatRenderer, RenderedPrompt, load_model_config
+from sessions import PromptCacheStats, session_key
+from response_cache import Flight, ResponseCache
+from scheduler import AdmissionRejected, AdmissionScheduler, Ticket
+from cancellation import ClientDisconnected, record_cancellation, run_until_disconnect
+from tracing import Span, TracingMiddleware, tracer
+from sse import DONE_FRAME, SSE_COALESCE_MS, SSE_COALESCE_TOKENS, content_frame, frame_deltas, json_frame
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -40,8 +52,150 @@ def get_metrics():
 
 # Global variables
 model_loaded = False
-llama_server_process: Optional[subprocess.Popen] = None
-llama_server_url = "http://localhost:8080"
+model_manager: Optional[ModelManager] = None
+scheduler: Optional[AdmissionScheduler] = None
+startup = StartupTracker()
+startup_task: Optional[asyncio.Task] = None
+prompt_cache_stats = PromptCacheStats()
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """Opt-in response cache; only deterministic (temperature 0) requests unless configured otherwise"""
+    if os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    return ResponseCache(
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "300")),
+        max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024")),
+        max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+        cache_nondeterministic=os.getenv("RESPONSE_CACHE_NONDETERMINISTIC", "false").lower() == "true",
+    )
+
+response_cache = create_response_cache()
+
+# /admin endpoints change what the service runs; they are refused until a token is set
+LLM_ADMIN_TOKEN = os.getenv("LLM_ADMIN_TOKEN", "")
+# A swap may only load model files from here (paths from model_config.json are trusted)
+MODELS_DIR = os.path.realpath(os.getenv("MODELS_DIR", "/models"))
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    """Bearer LLM_ADMIN_TOKEN, checked in constant time"""
+    if not LLM_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set LLM_ADMIN_TOKEN")
+    if not secrets.compare_digest((authorization or "").encode(), f"Bearer {LLM_ADMIN_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+def in_models_dir(path: str) -> bool:
+    real = os.path.realpath(path)
+    return os.path.commonpath([real, MODELS_DIR]) == MODELS_DIR
+
+def current_deployment() -> Deployment:
+    """The deployment new requests go to; captured once per request so a swap never mixes models"""
+    if model_manager is None or model_manager.current is None:
+        raise NoHealthyInstanceError("No model deployed")
+    return model_manager.current
+
+async def tokenize_remote(text: str) -> list[int]:
+    """Tokenize with llama-server so counts match the loaded model exactly"""
+    with current_deployment().use() as deployment:
+        _, response = await deployment.pool.request("POST", "/tokenize", json={"content": text})
+    response.raise_for_status()
+    return response.json()["tokens"]
+
+token_counter = TokenCounter(
+    remote=tokenize_remote,
+    tokenizer_path=os.getenv("LLAMA_TOKENIZER_PATH"),
+    cache_size=int(os.getenv("TOKENIZE_CACHE_SIZE", "4096")),
+)
+
+def create_llama_client(name: str, base_url: str) -> UpstreamClient:
+    """Create the pooled client used for every call to one llama-server instance"""
+    connect_timeout = float(os.getenv("LLAMA_CONNECT_TIMEOUT", "2"))
+    read_timeout = float(os.getenv("LLAMA_READ_TIMEOUT", "30"))
+    return UpstreamClient(
+        name,
+        base_url,
+        route_timeouts={
+            "health": httpx.Timeout(connect=connect_timeout, read=2.0, write=2.0, pool=1.0),
+            "completion": httpx.Timeout(connect=connect_timeout, read=read_timeout, write=10.0, pool=5.0),
+            "stream": httpx.Timeout(connect=connect_timeout, read=read_timeout, write=10.0, pool=5.0),
+        },
+        max_connections=int(os.getenv("LLAMA_MAX_CONNECTIONS", "64")),
+        max_keepalive_connections=int(os.getenv("LLAMA_MAX_KEEPALIVE", "32")),
+        connect_retries=int(os.getenv("LLAMA_CONNECT_RETRIES", "2")),
+    )
+
+def create_llama_pool(settings: ModelSettings, green: bool = False) -> LlamaServerPool:
+    """
+    Create a llama-server pool for a model from environment settings.
+
+    There are two port ranges and instance names (blue: llama-N on the
+    base ports, green: llama-green-N further up); a swap starts the new
+    pool on the one the serving pool does not use.
+    """
+    threads = os.getenv("LLAMA_THREADS_PER_INSTANCE")
+    parallel = int(os.getenv("LLAMA_PARALLEL", "1"))
+    base_port = int(os.getenv("LLAMA_BASE_PORT", "8080"))
+    if green:
+        base_port += int(os.getenv("LLAMA_SWAP_PORT_OFFSET", "100"))
+    return LlamaServerPool(
+        settings.model_path,
+        client_factory=create_llama_client,
+        size=int(os.getenv("LLAMA_INSTANCES", "1")),
+        host=os.getenv("LLAMA_HOST", "127.0.0.1"),
+        base_port=base_port,
+        threads_per_instance=int(threads) if threads else None,
+        binary=os.getenv("LLAMA_SERVER_BIN", "llama-server"),
+        extra_args=settings.server_args(parallel),
+        health_interval=float(os.getenv("LLAMA_HEALTH_INTERVAL", "5")),
+        ready_timeout=float(os.getenv("LLAMA_READY_TIMEOUT", "300")),
+        slots_per_instance=parallel,
+        name="llama-green" if green else "llama",
+    )
+
+async def warm_up_pool(pool: LlamaServerPool):
+    """Run a short completion on every child so the first real request does not pay for page faults"""
+    warmup_tokens = int(os.getenv("LLAMA_WARMUP_TOKENS", "8"))
+    if warmup_tokens > 0:
+        await pool.warm_up(os.getenv("LLAMA_WARMUP_PROMPT", "Hello"), warmup_tokens)
+
+def on_model_swap(deployment: Deployment):
+    """Forget what was computed with the previous model"""
+    if response_cache:
+        response_cache.clear()
+    token_counter.clear()
+
+def create_scheduler() -> AdmissionScheduler:
+    """Admission control sized to the pool's generation slots unless overridden"""
+    max_concurrency = os.getenv("LLM_MAX_CONCURRENCY")
+    slots = int(os.getenv("LLAMA_INSTANCES", "1")) * int(os.getenv("LLAMA_PARALLEL", "1"))
+    return AdmissionScheduler(
+        max_concurrency=int(max_concurrency) if max_concurrency else slots,
+        max_queue=int(os.getenv("LLM_MAX_QUEUE", "32")),
+        queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "10")),
+    )
+
+async def start_llama_pool():
+    """Wait for llama-server readiness, warm up, then mark the model loaded"""
+    global model_loaded
+    llama_pool = model_manager.current.pool
+    
+    healthy = await llama_pool.wait_until_ready(llama_pool.ready_timeout)
+    
+    # Restart dead or hung instances from here on
+    llama_pool.start_monitor()
+    
+    while not healthy:
+        if startup.phase != "failed":
+            logger.error("llama.cpp server pool not ready before deadline, waiting for the monitor to recover it")
+            startup.enter("failed")
+        await asyncio.sleep(llama_pool.health_interval)
+        healthy = llama_pool.healthy_count()
+    
+    startup.enter("warming")
+    await warm_up_pool(llama_pool)
+    
+    model_loaded = True
+    startup.enter("ready")
+    logger.info(f"llama.cpp server pool ready: {healthy}/{len(llama_pool.instances)} instances healthy")
 
 class ChatMessage(BaseModel):
     role: str
@@ -53,6 +207,8 @@ class ChatCompletionRequest(BaseModel):
     temperature: float = 0.7
     max_tokens: int = 512
     stream: bool = False
+    user: Optional[str] = None  # conversation id for KV-cache affinity
+    priority: str = "text"  # admission class: voice, text or batch
 
 class ChatCompletionResponse(BaseModel):
     id: str
@@ -64,86 +220,57 @@ class ChatCompletionResponse(BaseModel):
 
 class HealthResponse(BaseModel):
     status: str
+    phase: str
     model_loaded: bool
     uptime: float
+    model: Optional[str] = None
+    instances: list[dict] = []
     
     class Config:
         protected_namespaces = ()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Manage llama.cpp server lifecycle"""
-    global llama_server_process, model_loaded
+    """Manage llama.cpp server pool lifecycle"""
+    global model_manager, scheduler, startup_task
     
-    # Start llama.cpp server
-    logger.info("Starting llama.cpp server...")
-    model_path = os.getenv("MODEL_PATH", "/models/tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf")
+    # Start llama.cpp servers
+    logger.info("Starting llama.cpp server pool...")
+    # llama-server settings and the prompt format come from model_config.json; MODEL_PATH picks the file
+    settings = ModelSettings.from_config(load_model_config(), model_path=os.getenv("MODEL_PATH"))
+    model_manager = ModelManager(
+        create_llama_pool,
+        warm_up_pool,
+        drain_timeout=float(os.getenv("MODEL_SWAP_DRAIN_TIMEOUT", "120")),
+        on_swap=on_model_swap,
+    )
+    scheduler = create_scheduler()
+    logger.info(f"Admission control: {scheduler.max_concurrency} concurrent, queue of {scheduler.max_queue}")
+    if SSE_COALESCE_TOKENS > 1:
+        logger.info(f"SSE coalescing: up to {SSE_COALESCE_TOKENS} tokens or {SSE_COALESCE_MS:g}ms per frame")
     
-    if not os.path.exists(model_path):
-        logger.error(f"Model file not found at {model_path}")
+    if not os.path.exists(settings.model_path):
+        logger.error(f"Model file not found at {settings.model_path}")
         logger.error("Please ensure the model is downloaded to the models volume")
+        startup.enter("failed")
     else:
-        logger.info(f"Starting llama.cpp server with model: {model_path}")
-        
-        # Start llama.cpp server
-        cmd = [
-            "llama-server",
-            "--model", model_path,
-            "--host", "0.0.0.0",
-            "--port", "8080",
-            "--n-predict", "512",
-            "--ctx-size", "2048",
-            "--threads", str(os.cpu_count() or 4),
-            "--batch-size", "512",
-            "--n-gpu-layers", "0",  # CPU only for now
-        ]
-        
+        logger.info(f"Starting llama.cpp server pool with model: {settings.model_path}")
         try:
-            llama_server_process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                preexec_fn=os.setsid  # Detach from current process group
-            )
-            
-            # Wait for server to start
-            await asyncio.sleep(10)
-            
-            # Check if server is running
-            if llama_server_process.poll() is None:
-                # Test server health
-                try:
-                    async with httpx.AsyncClient() as client:
-                        response = await client.get(f"{llama_server_url}/health", timeout=5)
-                        if response.status_code == 200:
-                            model_loaded = True
-                            logger.info("llama.cpp server started successfully")
-                        else:
-                            logger.error(f"llama.cpp server health check failed: {response.status_code}")
-                except httpx.RequestError as e:
-                    logger.error(f"Failed to connect to llama.cpp server: {e}")
-            else:
-                logger.error("llama.cpp server failed to start")
-                
+            model_manager.deploy(settings)
+            # Readiness is polled in the background so /healthz can report progress
+            startup_task = asyncio.create_task(start_llama_pool())
         except Exception as e:
-            logger.error(f"Error starting llama.cpp server: {e}")
+            logger.error(f"Error starting llama.cpp server pool: {e}")
+            startup.enter("failed")
     
     yield
     
     # Cleanup
-    if llama_server_process:
-        logger.info("Shutting down llama.cpp server...")
-        try:
-            os.killpg(os.getpgid(llama_server_process.pid), signal.SIGTERM)
-            llama_server_process.wait(timeout=10)
-        except (subprocess.TimeoutExpired, ProcessLookupError):
-            logger.warning("Force killing llama.cpp server...")
-            try:
-                os.killpg(os.getpgid(llama_server_process.pid), signal.SIGKILL)
-            except ProcessLookupError:
-                pass
-        logger.info("llama.cpp server shut down")
+    if startup_task and not startup_task.done():
+        startup_task.cancel()
+    logger.info("Shutting down llama.cpp server pool...")
+    await model_manager.stop()
+    logger.info("llama.cpp server pool shut down")
 
 # Initialize FastAPI app with lifespan
 app = FastAPI(title="LLM Service", version="1.0.0", lifespan=lifespan)
@@ -157,23 +284,27 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+# Continue the caller's trace (or start one) for every request; spans are kept in memory
+app.add_middleware(TracingMiddleware)
+
 @app.get("/healthz", response_model=HealthResponse)
-async def health_check():
-    """Health check endpoint"""
-    # Check if llama.cpp server is actually running
-    llama_healthy = False
-    if llama_server_process and llama_server_process.poll() is None:
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"{llama_server_url}/health", timeout=2)
-                llama_healthy = response.status_code == 200
-        except httpx.RequestError:
-            llama_healthy = False
+async def health_check(response: Response):
+    """Health check endpoint; 503 until warm-up has finished so healthchecks gate traffic"""
+    # Instance health is kept current by the pool monitor
+    deployment = model_manager.current if model_manager else None
+    llama_healthy = deployment is not None and deployment.pool.healthy_count() > 0
+    healthy = startup.ready and model_loaded and llama_healthy
+    
+    if not healthy:
+        response.status_code = 503
     
     return HealthResponse(
-        status="ok" if model_loaded and llama_healthy else "degraded",
+        status="ok" if healthy else ("starting" if startup.phase in ("starting", "warming") else "degraded"),
+        phase=startup.phase,
         model_loaded=model_loaded and llama_healthy,
-        uptime=time.time()
+        uptime=time.time(),
+        model=os.path.basename(deployment.settings.model_path) if deployment else None,
+        instances=deployment.pool.stats() if deployment else []
     )
 
 @app.get("/metrics")
@@ -181,8 +312,57 @@ async def metrics():
     """Prometheus metrics endpoint"""
     return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
+class ModelSwapRequest(BaseModel):
+    """Fields left out are taken from model_config.json as it is on disk now"""
+    model_path: Optional[str] = None
+    chat_template: Optional[str] = None
+    context_size: Optional[int] = None
+    max_tokens: Optional[int] = None
+    batch_size: Optional[int] = None
+    n_gpu_layers: Optional[int] = None
+    
+    class Config:
+        protected_namespaces = ()
+
+@app.post("/admin/model", status_code=202, dependencies=[Depends(require_admin)])
+async def swap_model(request: ModelSwapRequest):
+    """Switch models blue/green: the new pool starts and warms up next to the old one, which drains and stops"""
+    if request.model_path and not in_models_dir(request.model_path):
+        raise HTTPException(status_code=400, detail=f"model_path must be inside {MODELS_DIR}")
+    overrides = request.model_dump(exclude_none=True)
+    settings = ModelSettings.from_config(load_model_config(), **overrides)
+    if not settings.model_path or not os.path.isfile(settings.model_path):
+        raise HTTPException(status_code=400, detail=f"Model file not found: {settings.model_path}")
+    if request.chat_template and request.chat_template not in TEMPLATES:
+        raise HTTPException(status_code=400, detail=f"Unknown chat template {request.chat_template}")
+    if not model_loaded:
+        raise HTTPException(status_code=503, detail="No model is serving yet; fix the startup model instead")
+    try:
+        generation = model_manager.start_swap(settings)
+    except SwapError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"generation": generation, "state": "starting", "model_path": settings.model_path}
+
+@app.get("/admin/model", dependencies=[Depends(require_admin)])
+async def get_model():
+    """Serving model, deployments still draining and the state of the latest swap"""
+    return model_manager.stats()
+
+@app.get("/debug/traces")
+async def slowest_traces(limit: int = 10, span: Optional[str] = None):
+    """Slowest recent sampled requests with their spans; span ranks by that span (e.g. "admission")"""
+    return {"sample_rate": tracer.sample_rate, "traces": tracer.exporter.slowest(limit, span)}
+
+@app.get("/debug/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """This service's spans of one trace; the ID is the caller's X-Request-ID"""
+    trace = tracer.exporter.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found or not sampled")
+    return trace
+
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
+async def chat_completions(request: ChatCompletionRequest, http_request: Request):
     """OpenAI-compatible chat completions endpoint"""
     start_time = time.time()
     
@@ -195,148 +375,350 @@ async def chat_completions(request: ChatCompletionRequest):
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     try:
+        cache_key = response_cache.key_for(request) if response_cache else None
+        if cache_key:
+            # Cache hit, or join/start the single shared generation for this key
+            if request.stream:
+                response = await cached_chat_completion(request, cache_key)
+            else:
+                response = await run_until_disconnect(http_request, cached_chat_completion(request, cache_key))
+            request_count.labels(method='POST', endpoint='/v1/chat/completions', status='200').inc()
+            if not request.stream:
+                request_duration.labels(endpoint='/v1/chat/completions').observe(time.time() - start_time)
+            return response
+        
+        # Wait for a generation slot, or fail fast with 429 when overloaded
+        ticket = await admit(request)
+        
         if request.stream:
-            # Streaming response
+            # Streaming response; the slot is held until the stream ends
             request_count.labels(method='POST', endpoint='/v1/chat/completions', status='200').inc()
-            return StreamingResponse(
-                generate_streaming_response(request),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                }
-            )
+            return streaming_response(release_when_done(generate_streaming_response(request), ticket))
         else:
-            # Non-streaming response
-            response = await generate_completion(request)
+            # Non-streaming response; abandoned if the client disconnects first
+            try:
+                response = await run_until_disconnect(http_request, generate_completion(request))
+            finally:
+                ticket.release()
             request_count.labels(method='POST', endpoint='/v1/chat/completions', status='200').inc()
             request_duration.labels(endpoint='/v1/chat/completions').observe(time.time() - start_time)
             return response
             
+    except HTTPException as e:
+        request_count.labels(method='POST', endpoint='/v1/chat/completions', status=str(e.status_code)).inc()
+        raise
+    except ClientDisconnected:
+        # Nobody is listening; 499 is only recorded, never delivered
+        record_cancellation("non_stream", request.max_tokens)
+        request_count.labels(method='POST', endpoint='/v1/chat/completions', status='499').inc()
+        return Response(status_code=499)
     except Exception as e:
         logger.error(f"Error in chat completions: {e}")
         request_count.labels(method='POST', endpoint='/v1/chat/completions', status='500').inc()
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+async def admit(request: ChatCompletionRequest) -> Ticket:
+    """Acquire a generation slot; overload becomes 429 with a Retry-After hint"""
+    try:
+        # Time spent queueing for a slot
+        with tracer.span("admission", priority=request.priority):
+            return await scheduler.acquire(request.priority)
+    except AdmissionRejected as e:
+        logger.warning(f"Shedding {request.priority} request: {e.reason}")
+        raise HTTPException(
+            status_code=429,
+            detail=f"Server overloaded ({e.reason}), retry later",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+async def release_when_done(frames: AsyncGenerator[bytes, None], ticket: Ticket) -> AsyncGenerator[bytes, None]:
+    """Pass frames through, giving the slot back when the stream ends or the client leaves"""
+    try:
+        async for frame in frames:
+            yield frame
+    finally:
+        await frames.aclose()
+        ticket.release()
+
+async def cached_chat_completion(request: ChatCompletionRequest, cache_key: str):
+    """Serve from the response cache, following an in-flight generation on a miss"""
+    # Only the request that starts a generation needs a slot; hits and followers don't
+    ticket: Optional[Ticket] = None
+    if not response_cache.contains(cache_key):
+        ticket = await admit(request)
+        if response_cache.contains(cache_key):
+            # An identical request got there while this one was queued
+            ticket.release()
+            ticket = None
+    
+    async def produce(flight: Flight):
+        try:
+            if request.stream:
+                usage: dict = {}
+                async for delta in stream_completion(request, usage):
+                    flight.publish(delta)
+                flight.finish(usage)
+            else:
+                content, usage = await complete(request)
+                flight.publish(content)
+                flight.finish(usage)
+        finally:
+            ticket.release()
+    
+    entry, follower = response_cache.lookup(cache_key, produce)
+    
+    if request.stream:
+        deltas = replay_chunks(entry.chunks) if entry else follower
+        return streaming_response(generate_streaming_response(request, deltas))
+    
+    if entry is None:
+        try:
+            entry = await follower.result()
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise completion_error(e)
+    return build_completion_response(request, entry.content, entry.usage)
+
+async def replay_chunks(chunks: list[str]) -> AsyncGenerator[str, None]:
+    for chunk in chunks:
+        yield chunk
+
+def streaming_response(frames: AsyncGenerator[bytes, None]) -> StreamingResponse:
+    return StreamingResponse(
+        frames,
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+        }
+    )
+
+def completion_error(e: Exception) -> HTTPException:
+    """Map an upstream failure to the HTTP error returned to the client"""
+    if isinstance(e, NoHealthyInstanceError):
+        logger.error(f"No llama.cpp server available: {e}")
+        return HTTPException(status_code=503, detail=str(e))
+    if isinstance(e, httpx.RequestError):
+        logger.error(f"Error calling llama.cpp server: {e}")
+        return HTTPException(status_code=500, detail=f"Failed to generate completion: {str(e)}")
+    logger.error(f"Unexpected error in generate_completion: {e}")
+    return HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
 async def generate_completion(request: ChatCompletionRequest) -> ChatCompletionResponse:
     """Generate non-streaming completion using llama.cpp"""
-    # Convert messages to llama.cpp format
-    prompt = format_messages_for_llama(request.messages)
+    try:
+        content, usage = await complete(request)
+    except Exception as e:
+        raise completion_error(e)
+    return build_completion_response(request, content, usage)
+
+async def complete(request: ChatCompletionRequest) -> tuple[str, dict]:
+    """Run one non-streaming llama.cpp completion; returns filtered content and usage"""
+    # Held until the reply is read, so a model swap drains this request first
+    with current_deployment().use() as deployment:
+        # Convert messages to llama.cpp format
+        prompt = format_messages_for_llama(request.messages, deployment.renderer)
     
-    # Prepare llama.cpp request
-    llama_request = {
-        "prompt": prompt,
-        "n_predict": request.max_tokens,
-        "temperature": request.temperature,
-        "stream": False
-    }
+        # Prepare llama.cpp request
+        llama_request = {
+            "prompt": prompt.text,
+            "n_predict": request.max_tokens,
+            "temperature": request.temperature,
+            "stop": deployment.stop_matcher.patterns,
+            "cache_prompt": True,  # reuse the slot's KV cache for the unchanged prefix
+            "stream": False
+        }
     
-    try:
         # Call llama.cpp server
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{llama_server_url}/completion",
-                json=llama_request,
-                timeout=30
+        with tracer.span("llama.completion", generation=deployment.generation) as span:
+            instance, response = await deployment.pool.request(
+                "POST", "/completion", route="completion",
+                session=session_key(request.messages, request.user), json=llama_request
             )
+            span.set(instance=instance.name)
             response.raise_for_status()
-            
-            llama_response = response.json()
-        content = llama_response.get("content", "")
-        
-        # Filter out generated user messages to prevent "talking to itself"
-        content = filter_generated_user_messages(content)
-        
-        # Count tokens (rough estimation)
-        prompt_tokens = len(prompt.split())
-        completion_tokens = len(content.split())
         
-        # Update metrics
-        _, _, token_count = get_metrics()
-        token_count.inc(completion_tokens)
-        
-        return ChatCompletionResponse(
-            id=f"chatcmpl-{int(time.time())}",
-            created=int(time.time()),
-            model=request.model,
-            choices=[{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": content
-                },
-                "finish_reason": "stop"
-            }],
-            usage={
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": prompt_tokens + completion_tokens
-            }
-        )
-        
-    except httpx.RequestError as e:
+            llama_response = response.json()
+            trace_llama_timings(span, llama_response)
+    record_generation_speed(instance, llama_response)
+    prompt_cache_stats.record(llama_response)
+    content = llama_response.get("content", "")
+    
+    # Filter out generated user messages to prevent "talking to itself"
+    content = filter_generated_user_messages(content)
+    
+    # Prefer llama.cpp's own counts, falling back to the cached tokenizer
+    prompt_tokens = llama_response.get("tokens_evaluated") or await token_counter.count_segments(prompt.segments)
+    completion_tokens = llama_response.get("tokens_predicted") or await token_counter.count(content)
+    
+    # Update metrics
+    _, _, token_count = get_metrics()
+    token_count.inc(completion_tokens)
+    record_usage(prompt_tokens, completion_tokens, reported_tokens_per_second(llama_response))
+    
+    return content, {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
+
+def build_completion_response(request: ChatCompletionRequest, content: str, usage: dict) -> ChatCompletionResponse:
+    return ChatCompletionResponse(
+        id=f"chatcmpl-{int(time.time())}",
+        created=int(time.time()),
+        model=request.model,
+        choices=[{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": content
+            },
+            "finish_reason": "stop"
+        }],
+        usage=usage
+    )
+
+async def generate_streaming_response(
+    request: ChatCompletionRequest, deltas: Optional[AsyncGenerator[str, None]] = None
+) -> AsyncGenerator[bytes, None]:
+    """Frame content deltas (generated by default, or replayed from the cache) as OpenAI SSE chunks"""
+    deltas = deltas if deltas is not None else stream_completion(request)
+    # Several deltas per frame when coalescing is configured (SSE_COALESCE_TOKENS)
+    deltas = frame_deltas(deltas)
+    try:
+        async for delta in deltas:
+            yield content_frame(delta)
+        yield DONE_FRAME
+    except (httpx.HTTPError, NoHealthyInstanceError) as e:
         logger.error(f"Error calling llama.cpp server: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to generate completion: {str(e)}")
-    except Exception as e:
-        logger.error(f"Unexpected error in generate_completion: {e}")
-        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+        yield json_frame({'error': 'Failed to generate completion'})
+    finally:
+        # Close the upstream stream now rather than at garbage collection,
+        # so a disconnected client stops llama.cpp generation immediately
+        await deltas.aclose()
 
-async def generate_streaming_response(request: ChatCompletionRequest) -> AsyncGenerator[str, None]:
-    """Generate streaming response using llama.cpp"""
+async def stream_completion(request: ChatCompletionRequest, usage: Optional[dict] = None) -> AsyncGenerator[str, None]:
+    """Stream filtered content deltas from llama.cpp; fills usage once generation ends"""
+    deployment = current_deployment()
     # Convert messages to llama.cpp format
-    prompt = format_messages_for_llama(request.messages)
+    prompt = format_messages_for_llama(request.messages, deployment.renderer)
     
     # Prepare llama.cpp request
     llama_request = {
-        "prompt": prompt,
+        "prompt": prompt.text,
         "n_predict": request.max_tokens,
         "temperature": request.temperature,
+        "stop": deployment.stop_matcher.patterns,  # llama.cpp ends generation as soon as one appears
+        "cache_prompt": True,  # reuse the slot's KV cache for the unchanged prefix
         "stream": True
     }
+    stop_stream = deployment.stop_matcher.stream()
+    generated_chunks = 0
+    final_data: dict = {}
+    first_token_at: Optional[float] = None
+    # Started and ended by hand: a generator must not switch the current span across yields
+    span = tracer.start_span("llama.completion", generation=deployment.generation, stream=True)
     
-    try:
+    # Held for the whole stream, so a model swap drains it before stopping the old pool
+    with deployment.use():
         # Call llama.cpp server with streaming
-        async with httpx.AsyncClient() as client:
-            async with client.stream(
-                "POST",
-                f"{llama_server_url}/completion",
-                json=llama_request,
-                timeout=30
-            ) as response:
+        try:
+            async with deployment.pool.stream(
+                "POST", "/completion", session=session_key(request.messages, request.user), json=llama_request
+            ) as (instance, response):
+                span.set(instance=instance.name)
                 response.raise_for_status()
-                
+            
                 # Stream the response
                 async for line in response.aiter_lines():
                     if line:
                         if line.startswith('data: '):
                             data = line[6:]  # Remove 'data: ' prefix
                             if data.strip() == '[DONE]':
-                                yield "data: [DONE]\n\n"
                                 break
                             else:
                                 try:
                                     llama_data = json.loads(data)
-                                    # Convert llama.cpp format to OpenAI format
-                                    if 'content' in llama_data:
-                                        # Filter out generated user messages
-                                        filtered_content = filter_generated_user_messages(llama_data['content'])
-                                        if filtered_content:  # Only yield if there's content after filtering
-                                            openai_data = {
-                                                "choices": [{
-                                                    "delta": {
-                                                        "content": filtered_content
-                                                    }
-                                                }]
-                                            }
-                                            yield f"data: {json.dumps(openai_data)}\n\n"
-                                            _, _, token_count = get_metrics()
-                                            token_count.inc(1)
                                 except json.JSONDecodeError:
                                     continue
-                            
-    except httpx.RequestError as e:
-        logger.error(f"Error calling llama.cpp server: {e}")
-        yield f"data: {json.dumps({'error': 'Failed to generate completion'})}\n\n"
+                                content = llama_data.get('content', '')
+                                if content:
+                                    # llama.cpp streams one token per chunk
+                                    generated_chunks += 1
+                                    if first_token_at is None:
+                                        first_token_at = time.time()
+                                        span.set(ttft_ms=round((first_token_at - span.start) * 1000, 1))
+                                # Hold back only text that could still become a stop sequence
+                                filtered_content = stop_stream.feed(content)
+                                if llama_data.get('stop'):
+                                    final_data = llama_data
+                                    record_generation_speed(instance, llama_data)
+                                    prompt_cache_stats.record(llama_data)
+                                    trace_llama_timings(span, llama_data)
+                                    filtered_content += stop_stream.flush()
+                                if filtered_content:
+                                    yield filtered_content
+                                if llama_data.get('stop') or stop_stream.stopped:
+                                    # Closing the response stops generation upstream
+                                    break
+            
+                # Release any held-back text if the stream ended without a final chunk
+                tail = stop_stream.flush()
+                if tail:
+                    yield tail
+        except (GeneratorExit, asyncio.CancelledError):
+            # Client went away: leaving the block closed the llama.cpp connection, which stops generation
+            record_cancellation("stream", request.max_tokens, generated_chunks)
+            span.set(cancelled=True)
+            raise
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.end(chunks=generated_chunks)
+    
+    # Token accounting once the upstream stream is closed
+    prompt_tokens = final_data.get("tokens_evaluated") or await token_counter.count_segments(prompt.segments)
+    completion_tokens = final_data.get("tokens_predicted") or generated_chunks
+    tokens_per_second = reported_tokens_per_second(final_data)
+    if tokens_per_second is None and first_token_at is not None and completion_tokens > 1:
+        elapsed = time.time() - first_token_at
+        tokens_per_second = (completion_tokens - 1) / elapsed if elapsed > 0 else None
+    _, _, token_count = get_metrics()
+    token_count.inc(completion_tokens)
+    record_usage(prompt_tokens, completion_tokens, tokens_per_second)
+    if usage is not None:
+        usage.update(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens
+        )
+
+def reported_tokens_per_second(llama_data: dict) -> Optional[float]:
+    """Generation speed from llama.cpp's timings block, if present"""
+    timings = llama_data.get("timings") or {}
+    tokens_per_second = timings.get("predicted_per_second")
+    return float(tokens_per_second) if tokens_per_second else None
+
+def record_generation_speed(instance: LlamaInstance, llama_data: dict):
+    """Feed llama.cpp's reported generation speed into the instance's tokens/s"""
+    tokens_per_second = reported_tokens_per_second(llama_data)
+    if tokens_per_second:
+        instance.record_speed(tokens_per_second)
+
+def trace_llama_timings(span: Span, llama_data: dict):
+    """Add llama.cpp's own prompt evaluation and generation times as children of the completion span"""
+    timings = llama_data.get("timings") or {}
+    prompt_ms, predicted_ms = timings.get("prompt_ms"), timings.get("predicted_ms")
+    if prompt_ms is None or predicted_ms is None:
+        return
+    # llama.cpp reports durations only; it evaluates the prompt as soon as the request arrives
+    tracer.record("llama.prompt_eval", span, span.start, prompt_ms / 1000, tokens=timings.get("prompt_n"))
+    tracer.record(
+        "llama.generate", span, span.start + prompt_ms / 1000, predicted_ms / 1000,
+        tokens=timings.get("predicted_n"), tokens_per_second=timings.get("predicted_per_second")
+    )
 
 def filter_generated_user_messages(content: str) -> str:
     """Filter out generated user messages to prevent AI talking to itself"""
@@ -384,24 +766,9 @@ def filter_generated_user_messages(content: str) -> str:
     
     return result
 
-def format_messages_for_llama(messages: list[ChatMessage]) -> str:
-    """Convert OpenAI chat messages to TinyLlama chat format"""
-    # Find the last user message
-    last_user_message = None
-    for message in reversed(messages):
-        if message.role == "user":
-            last_user_message = message.content
-            break
-    
-    if not last_user_message:
-        return "Hello! How can I help you today?"
-    
-    # Use a very simple format that should prevent conversation loops
-    prompt = f"""<|im_start|>user
-{last_user_message}<|im_end|>
-<|im_start|>assistant
-"""
-    return prompt
+def format_messages_for_llama(messages: list[ChatMessage], renderer: ChatRenderer) -> RenderedPrompt:
+    """Render the full conversation in the model's chat template"""
+    return renderer.render(messages)
 
 if __name__ == "__main__":
     uvicorn.run(
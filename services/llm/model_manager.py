@@ -0,0 +1,251 @@
+"""
+Model manager
+Owns the llama-server deployment that serves requests: the pool plus the
+chat template and stop strings that belong to its model, built from
+model_config.json. A swap is blue/green: the new pool starts on the other
+set of ports next to the old one and is warmed up. New requests then go
+to it in a single reference switch, and the old pool is stopped once its
+in-flight requests have finished or the drain timeout has passed.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, replace
+from typing import Awaitable, Callable, Iterator, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from chat_template import ChatRenderer, create_renderer
+from llama_pool import LlamaServerPool
+from stop_sequences import DEFAULT_STOP_SEQUENCES, StopSequenceMatcher
+
+logger = logging.getLogger(__name__)
+
+MODEL_SWAPS = Counter('llm_model_swaps_total', 'Model swaps by result', ['result'])
+MODEL_SWAP_DURATION = Histogram(
+    'llm_model_swap_seconds', 'Time from a swap request until new requests go to the new model',
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+)
+MODEL_DRAIN_DURATION = Histogram(
+    'llm_model_drain_seconds', 'Time the replaced deployment took to finish its in-flight requests',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+)
+MODEL_DRAINS = Counter('llm_model_drains_total', 'Drains of replaced deployments by result', ['result'])
+MODEL_GENERATION = Gauge('llm_model_generation', 'Deployment generation serving requests')
+
+
+class SwapError(RuntimeError):
+    """The new deployment could not be brought up; the old one keeps serving"""
+
+
+@dataclass(frozen=True)
+class ModelSettings:
+    """What a deployment runs: the model file and its llama-server settings"""
+    model_path: str
+    chat_template: Optional[str] = None
+    context_size: int = 2048  # per slot
+    max_tokens: int = 512
+    batch_size: int = 512
+    n_gpu_layers: int = 0
+    system_prompt: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, config: dict, model_path: Optional[str] = None, **overrides) -> "ModelSettings":
+        """
+        Settings from a model_config.json dict.
+
+        Args:
+            config: Parsed model_config.json
+            model_path: Model file, overriding the config's
+            **overrides: Field values taking precedence over the config
+
+        Returns:
+            Settings; the config's chat_template only applies if the
+            config describes this model file
+        """
+        config_path = config.get("model_path") or ""
+        path = model_path or config_path
+        config_file = config.get("model_file") or os.path.basename(config_path)
+        same_model = config_file == os.path.basename(path)
+        settings = cls(
+            model_path=path,
+            chat_template=config.get("chat_template") if same_model else None,
+            context_size=int(config.get("context_size", cls.context_size)),
+            max_tokens=int(config.get("max_tokens", cls.max_tokens)),
+            batch_size=int(config.get("batch_size", cls.batch_size)),
+            n_gpu_layers=int(config.get("n_gpu_layers", cls.n_gpu_layers)),
+            system_prompt=config.get("system_prompt"),
+        )
+        return replace(settings, **{k: v for k, v in overrides.items() if v is not None})
+
+    def server_args(self, parallel: int) -> list[str]:
+        """llama-server flags other than model, host, port and threads"""
+        return [
+            "--n-predict", str(self.max_tokens),
+            # llama.cpp splits the context between slots, so give each slot the full window
+            "--ctx-size", str(self.context_size * parallel),
+            "--parallel", str(parallel),
+            "--batch-size", str(self.batch_size),
+            "--n-gpu-layers", str(self.n_gpu_layers),
+        ]
+
+    def renderer(self) -> ChatRenderer:
+        config = {"model_file": os.path.basename(self.model_path), "system_prompt": self.system_prompt}
+        if self.chat_template:
+            config["chat_template"] = self.chat_template
+        return create_renderer(self.model_path, config)
+
+
+class Deployment:
+    """One pool with its prompt format, counting the requests that use it"""
+
+    def __init__(self, generation: int, settings: ModelSettings, pool: LlamaServerPool, green: bool = False):
+        self.generation = generation
+        self.settings = settings
+        self.pool = pool
+        # Which of the two port ranges the pool runs on
+        self.green = green
+        self.renderer = settings.renderer()
+        self.stop_matcher = StopSequenceMatcher(DEFAULT_STOP_SEQUENCES + list(self.renderer.template.stop))
+        self.active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @contextmanager
+    def use(self) -> Iterator["Deployment"]:
+        """Hold the deployment for one request, streams included, so a swap waits for it"""
+        self.active += 1
+        self._idle.clear()
+        try:
+            yield self
+        finally:
+            self.active -= 1
+            if self.active == 0:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        """Wait for in-flight requests to finish; False if some were still running at the timeout"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> dict:
+        return {"generation": self.generation, "active_requests": self.active, **asdict(self.settings)}
+
+
+class ModelManager:
+    """The serving deployment and blue/green swaps to a new one"""
+
+    def __init__(
+        self,
+        pool_factory: Callable[[ModelSettings, bool], LlamaServerPool],
+        warm_up: Callable[[LlamaServerPool], Awaitable[None]],
+        drain_timeout: float = 120.0,
+        on_swap: Optional[Callable[[Deployment], None]] = None,
+    ):
+        self.pool_factory = pool_factory
+        self.warm_up = warm_up
+        self.drain_timeout = drain_timeout
+        self.on_swap = on_swap
+        self.current: Optional[Deployment] = None
+        self.generation = 0
+        self.swap_task: Optional[asyncio.Task] = None
+        self.status: dict = {"state": "idle"}
+        self._draining: set[Deployment] = set()
+
+    def deploy(self, settings: ModelSettings) -> Deployment:
+        """Create and start the first deployment; readiness is up to the caller"""
+        deployment = Deployment(self.generation, settings, self.pool_factory(settings, False))
+        deployment.pool.start()
+        self.current = deployment
+        MODEL_GENERATION.set(deployment.generation)
+        return deployment
+
+    @property
+    def swapping(self) -> bool:
+        return self.swap_task is not None and not self.swap_task.done()
+
+    def start_swap(self, settings: ModelSettings) -> int:
+        """Begin swapping to settings in the background; returns the new generation"""
+        if self.swapping:
+            raise SwapError("A model swap is already in progress")
+        self.generation += 1
+        self.status = {"state": "starting", "generation": self.generation, "model_path": settings.model_path}
+        self.swap_task = asyncio.create_task(self._swap(self.generation, settings))
+        return self.generation
+
+    async def _swap(self, generation: int, settings: ModelSettings):
+        started = time.monotonic()
+        # The other range than the serving pool's, however many swaps failed before
+        green = not self.current.green if self.current else False
+        pool = self.pool_factory(settings, green)
+        logger.info(f"Model swap {generation}: starting {settings.model_path} next to the current deployment")
+        try:
+            pool.start()
+            healthy = await pool.wait_until_ready(pool.ready_timeout)
+            if healthy < len(pool.instances):
+                raise SwapError(f"Only {healthy}/{len(pool.instances)} instances became ready")
+            self.status["state"] = "warming"
+            await self.warm_up(pool)
+        except BaseException as e:
+            await pool.stop()
+            MODEL_SWAPS.labels(result="failed").inc()
+            self.status.update(state="failed", error=repr(e))
+            logger.error(f"Model swap {generation} failed, keeping the current model: {e!r}")
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        deployment = Deployment(generation, settings, pool, green)
+        pool.start_monitor()
+        old, self.current = self.current, deployment
+        swap_seconds = time.monotonic() - started
+        MODEL_SWAP_DURATION.observe(swap_seconds)
+        MODEL_SWAPS.labels(result="success").inc()
+        MODEL_GENERATION.set(generation)
+        self.status.update(state="draining", swap_seconds=round(swap_seconds, 2))
+        logger.info(f"Model swap {generation}: new requests go to {settings.model_path} after {swap_seconds:.1f}s")
+        if self.on_swap:
+            self.on_swap(deployment)
+
+        if old is not None:
+            await self._retire(old)
+        self.status["state"] = "done"
+
+    async def _retire(self, old: Deployment):
+        """Let the old deployment finish what it is generating, then stop it"""
+        self._draining.add(old)
+        drain_started = time.monotonic()
+        drained = await old.drain(self.drain_timeout)
+        drain_seconds = time.monotonic() - drain_started
+        MODEL_DRAIN_DURATION.observe(drain_seconds)
+        MODEL_DRAINS.labels(result="completed" if drained else "timeout").inc()
+        if not drained:
+            logger.warning(f"Stopping generation {old.generation} with {old.active} requests still running")
+        self.status["drain_seconds"] = round(drain_seconds, 2)
+        await old.pool.stop()
+        self._draining.discard(old)
+        logger.info(f"Generation {old.generation} stopped after draining for {drain_seconds:.1f}s")
+
+    def stats(self) -> dict:
+        return {
+            "current": self.current.stats() if self.current else None,
+            "draining": [deployment.stats() for deployment in self._draining],
+            "swap": self.status,
+        }
+
+    async def stop(self):
+        if self.swapping:
+            self.swap_task.cancel()
+            try:
+                await self.swap_task
+            except asyncio.CancelledError:
+                pass
+        for deployment in [*self._draining, self.current]:
+            if deployment is not None:
+                await deployment.pool.stop()
@@ -0,0 +1,273 @@
+"""
+Response cache with single-flight deduplication
+Caches completed chat completions keyed on the normalized request, with LRU
+and TTL eviction under an entry and byte budget. Concurrent identical
+requests share one upstream generation: the first starts it, the rest follow
+its output as it is produced.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+CACHE_LOOKUPS = Counter('llm_response_cache_total', 'Response cache lookups', ['result'])
+CACHE_ENTRIES = Gauge('llm_response_cache_entries', 'Responses currently cached')
+CACHE_BYTES = Gauge('llm_response_cache_bytes', 'Approximate memory held by cached responses')
+CACHE_EVICTIONS = Counter('llm_response_cache_evictions_total', 'Cached responses evicted', ['reason'])
+
+# Per-entry bookkeeping overhead counted against the byte budget
+ENTRY_OVERHEAD_BYTES = 256
+
+
+@dataclass
+class CachedResponse:
+    """A finished generation: the streamed deltas, their concatenation and usage"""
+    chunks: list[str]
+    usage: dict = field(default_factory=dict)
+
+    @property
+    def content(self) -> str:
+        return "".join(self.chunks)
+
+    @property
+    def size(self) -> int:
+        return sum(len(chunk.encode("utf-8")) for chunk in self.chunks) + ENTRY_OVERHEAD_BYTES
+
+
+class Flight:
+    """One in-progress generation that any number of requests can follow"""
+
+    def __init__(self):
+        self.chunks: list[str] = []
+        self.usage: dict = {}
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self.followers = 0
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: str):
+        if chunk:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self, usage: Optional[dict] = None):
+        self.usage = usage or {}
+        self.done = True
+        self._notify()
+
+    def fail(self, error: BaseException):
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def join(self) -> "Follower":
+        """A new follower; it counts from now, not from its first read"""
+        self.followers += 1
+        return Follower(self)
+
+    def _leave(self):
+        self.followers -= 1
+        if self.followers == 0 and not self.done and self.task:
+            # Nobody is left to read the rest
+            self.task.cancel()
+
+
+class Follower:
+    """
+    One request's place on a flight: yields every chunk from the start, then
+    live chunks until the generation ends. Release it (aclose, or reading to
+    the end) exactly once; the generation is cancelled when the last
+    follower is released early.
+    """
+
+    def __init__(self, flight: Flight):
+        self.flight = flight
+        self.index = 0
+        self.released = False
+
+    def __aiter__(self) -> "Follower":
+        return self
+
+    async def __anext__(self) -> str:
+        flight = self.flight
+        if self.released:
+            raise StopAsyncIteration
+        try:
+            while self.index >= len(flight.chunks):
+                if flight.done:
+                    self.release()
+                    if flight.error is not None:
+                        raise flight.error
+                    raise StopAsyncIteration
+                await flight._changed.wait()
+        except asyncio.CancelledError:
+            self.release()
+            raise
+        self.index += 1
+        return flight.chunks[self.index - 1]
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.flight._leave()
+
+    async def aclose(self):
+        self.release()
+
+    def __del__(self):
+        # Safety net for a response stream that was dropped before it started
+        try:
+            self.release()
+        except RuntimeError:
+            pass
+
+    async def result(self) -> CachedResponse:
+        try:
+            async for _ in self:
+                pass
+        finally:
+            self.release()
+        return CachedResponse(chunks=list(self.flight.chunks), usage=self.flight.usage)
+
+
+class ResponseCache:
+    """LRU + TTL cache of responses plus the table of in-flight generations"""
+
+    def __init__(
+        self,
+        ttl: float = 300.0,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        cache_nondeterministic: bool = False,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_nondeterministic = cache_nondeterministic
+        self.bytes = 0
+        # Bumped by clear(); a generation started before then must not be stored
+        self.epoch = 0
+        self._entries: OrderedDict[str, tuple[float, CachedResponse]] = OrderedDict()
+        self._flights: dict[str, Flight] = {}
+
+    def key_for(self, request) -> Optional[str]:
+        """Cache key for a request, or None if its settings make it uncacheable"""
+        if request.temperature > 0 and not self.cache_nondeterministic:
+            return None
+        normalized = {
+            "model": request.model,
+            "temperature": request.temperature,
+            "max_tokens": request.max_tokens,
+            # Streamed and whole replies are filtered differently, so they never share an entry
+            "stream": bool(request.stream),
+            # Collapse whitespace so trivially different spellings share an entry
+            "messages": [[m.role, " ".join(m.content.split())] for m in request.messages],
+        }
+        encoded = json.dumps(normalized, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        item = self._entries.get(key)
+        if item is None:
+            return None
+        expires_at, entry = item
+        if expires_at < time.monotonic():
+            self._remove(key, "expired")
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CachedResponse):
+        if entry.size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key, "replaced")
+        self._entries[key] = (time.monotonic() + self.ttl, entry)
+        self.bytes += entry.size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)), "capacity")
+        self._publish()
+
+    def clear(self):
+        """
+        Drop every stored response and detach in-flight generations: they
+        still finish for their followers, but new requests start afresh and
+        their results are not stored.
+        """
+        self.epoch += 1
+        self._flights = {}
+        for key in list(self._entries):
+            self._remove(key, "cleared")
+
+    def contains(self, key: str) -> bool:
+        """True if a lookup would be a hit or join an in-flight generation"""
+        return key in self._flights or self.get(key) is not None
+
+    def _remove(self, key: str, reason: str):
+        _, entry = self._entries.pop(key)
+        self.bytes -= entry.size
+        CACHE_EVICTIONS.labels(reason=reason).inc()
+        self._publish()
+
+    def _publish(self):
+        CACHE_ENTRIES.set(len(self._entries))
+        CACHE_BYTES.set(self.bytes)
+
+    def lookup(
+        self, key: str, produce: Callable[[Flight], Awaitable[None]]
+    ) -> tuple[Optional[CachedResponse], Optional[Follower]]:
+        """
+        Return (entry, None) on a hit. Otherwise return (None, follower) of an
+        existing flight for the same key, or of a new one whose generation is
+        started here. The follower counts at once, so the flight cannot be
+        cancelled under a caller that has not started reading yet.
+        produce must publish chunks to the flight and finish or fail it.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            CACHE_LOOKUPS.labels(result="hit").inc()
+            return entry, None
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            CACHE_LOOKUPS.labels(result="coalesced").inc()
+            return None, flight.join()
+
+        CACHE_LOOKUPS.labels(result="miss").inc()
+        flight = Flight()
+        flights, epoch = self._flights, self.epoch
+        flights[key] = flight
+
+        async def run():
+            try:
+                await produce(flight)
+                if not flight.done:
+                    flight.finish()
+            except BaseException as e:
+                flight.fail(e)
+                if not isinstance(e, Exception):
+                    raise
+            finally:
+                if flights.get(key) is flight:
+                    del flights[key]
+            if flight.error is None and flight.chunks and self.epoch == epoch:
+                self.put(key, CachedResponse(chunks=list(flight.chunks), usage=flight.usage))
+
+        # The generation outlives any single caller; it is only cancelled once every follower has left
+        follower = flight.join()
+        flight.task = asyncio.create_task(run())
+        return None, follower
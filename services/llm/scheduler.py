@@ -0,0 +1,176 @@
+"""
+Admission control
+Sits between the HTTP handlers and llama-server: at most max_concurrency
+requests generate at once (matched to the available slots), the rest wait in
+a bounded priority queue (voice ahead of text) with a queue-time deadline.
+When the queue is full, requests are shed immediately with a Retry-After hint
+instead of piling up inside llama.cpp.
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# Lower value = served first
+PRIORITIES = {"voice": 0, "text": 1, "batch": 2}
+
+QUEUE_DEPTH = Gauge('llm_queue_depth', 'Requests waiting for a generation slot', ['priority'])
+ACTIVE_REQUESTS = Gauge('llm_active_requests', 'Requests holding a generation slot')
+QUEUE_WAIT = Histogram(
+    'llm_queue_wait_seconds', 'Time spent waiting for a generation slot', ['priority'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+REQUESTS_SHED = Counter('llm_requests_shed_total', 'Requests rejected by admission control', ['priority', 'reason'])
+
+
+class AdmissionRejected(Exception):
+    """Request was not admitted; retry_after is a hint in seconds"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Request rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A held generation slot; release exactly once when the request ends"""
+
+    def __init__(self, scheduler: "AdmissionScheduler"):
+        self._scheduler = scheduler
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._scheduler._release(time.monotonic() - self._started)
+
+    def __del__(self):
+        # Safety net for a response stream that was dropped before it started
+        try:
+            self.release()
+        except RuntimeError:
+            pass
+
+
+class _Waiter:
+    __slots__ = ("priority", "name", "future", "enqueued_at", "queued")
+
+    def __init__(self, priority: int, name: str):
+        self.priority = priority
+        self.name = name
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        # Counted in _queued until granted, displaced, timed out or cancelled
+        self.queued = True
+
+
+class AdmissionScheduler:
+    """Concurrency limit plus bounded priority queue with deadlines and load shedding"""
+
+    def __init__(self, max_concurrency: int, max_queue: int = 32, queue_timeout: float = 10.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        # Smoothed time a request holds its slot, for Retry-After estimates
+        self.service_time = 1.0
+        self._heap: list[tuple[int, int, _Waiter]] = []
+        self._seq = itertools.count()
+        self._queued = 0
+
+    def _publish(self):
+        ACTIVE_REQUESTS.set(self.active)
+        counts = dict.fromkeys(PRIORITIES, 0)
+        for _, _, waiter in self._heap:
+            if not waiter.future.done():
+                counts[waiter.name] += 1
+        for name, count in counts.items():
+            QUEUE_DEPTH.labels(priority=name).set(count)
+
+    def retry_after(self) -> int:
+        """Seconds until the current queue would have drained"""
+        backlog = (self._queued + self.active) / max(self.max_concurrency, 1)
+        return max(1, math.ceil(backlog * self.service_time))
+
+    def _reject(self, name: str, reason: str) -> AdmissionRejected:
+        REQUESTS_SHED.labels(priority=name, reason=reason).inc()
+        return AdmissionRejected(reason, self.retry_after())
+
+    def _dequeue(self, waiter: _Waiter):
+        """Stop counting a waiter as queued; the first caller wins, whichever path it is"""
+        if waiter.queued:
+            waiter.queued = False
+            self._queued -= 1
+
+    def _lowest_queued(self) -> Optional[_Waiter]:
+        pending = [w for _, _, w in self._heap if not w.future.done()]
+        return max(pending, key=lambda w: (w.priority, w.enqueued_at), default=None)
+
+    async def acquire(self, priority: str = "text") -> Ticket:
+        """Wait for a slot; raises AdmissionRejected when shed or past the queue deadline"""
+        name = priority if priority in PRIORITIES else "text"
+        level = PRIORITIES[name]
+
+        if self.active < self.max_concurrency and self._queued == 0:
+            self.active += 1
+            self._publish()
+            QUEUE_WAIT.labels(priority=name).observe(0)
+            return Ticket(self)
+
+        if self._queued >= self.max_queue:
+            # Full: a higher-priority arrival displaces the lowest-priority, newest waiter
+            victim = self._lowest_queued()
+            if victim is None or victim.priority <= level:
+                raise self._reject(name, "queue_full")
+            victim.future.set_exception(self._reject(victim.name, "displaced"))
+            self._dequeue(victim)
+
+        waiter = _Waiter(level, name)
+        heapq.heappush(self._heap, (level, next(self._seq), waiter))
+        self._queued += 1
+        self._publish()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.exception():
+                # Granted at the deadline; keep the slot
+                return self._granted(waiter)
+            # Possibly displaced while the wait was torn down, and already dequeued
+            waiter.future.cancel()
+            self._dequeue(waiter)
+            self._publish()
+            raise self._reject(name, "deadline")
+        except asyncio.CancelledError:
+            # Caller went away while queued: give back a slot granted in the meantime
+            if waiter.future.done() and not waiter.future.cancelled() and not waiter.future.exception():
+                Ticket(self).release()
+            else:
+                waiter.future.cancel()
+                self._dequeue(waiter)
+                self._publish()
+            raise
+        return self._granted(waiter)
+
+    def _granted(self, waiter: _Waiter) -> Ticket:
+        QUEUE_WAIT.labels(priority=waiter.name).observe(time.monotonic() - waiter.enqueued_at)
+        return Ticket(self)
+
+    def _release(self, held_for: float):
+        self.service_time += 0.1 * (held_for - self.service_time)
+        # Hand the slot straight to the best waiter, skipping cancelled or displaced ones
+        while self._heap:
+            _, _, waiter = heapq.heappop(self._heap)
+            if waiter.future.done():
+                continue
+            self._dequeue(waiter)
+            waiter.future.set_result(None)
+            self._publish()
+            return
+        self.active -= 1
+        self._publish()
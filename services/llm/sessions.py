@@ -0,0 +1,111 @@
+"""
+Conversation affinity and KV-cache reuse accounting
+Pins each conversation to one llama-server instance and slot so the slot's
+KV cache still holds the previous turns, and measures how much prompt
+evaluation that reuse saves.
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+
+from prometheus_client import Counter, Gauge
+
+PROMPT_CACHE_TOKENS = Counter(
+    'llm_prompt_cache_tokens_total', 'Prompt tokens by KV-cache outcome', ['result']
+)
+PROMPT_CACHE_HIT_RATIO = Gauge(
+    'llm_prompt_cache_hit_ratio', 'Share of prompt tokens reused from the KV cache (moving average)'
+)
+PROMPT_EVAL_SECONDS_SAVED = Counter(
+    'llm_prompt_eval_seconds_saved_total', 'Estimated prompt evaluation time saved by KV-cache reuse'
+)
+SESSION_ROUTING = Counter(
+    'llm_session_routing_total', 'Conversation placement decisions', ['result']
+)
+
+
+def session_key(messages: list, user: Optional[str] = None) -> str:
+    """
+    Identify a conversation by the caller-supplied user id, or else by its
+    opening (system prompt + first user message), which stays fixed as the
+    conversation grows.
+    """
+    if user:
+        return f"user:{user}"
+    digest = hashlib.blake2b(digest_size=16)
+    for message in messages:
+        digest.update(message.role.encode())
+        digest.update(b"\0")
+        digest.update(message.content.encode())
+        digest.update(b"\0")
+        if message.role == "user":
+            break
+    return f"prefix:{digest.hexdigest()}"
+
+
+class SessionAffinity:
+    """LRU map of conversation -> (instance, slot) with slot busy tracking"""
+
+    def __init__(self, slots_per_instance: int, max_sessions: int = 10000):
+        self.slots_per_instance = slots_per_instance
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, tuple[int, int]] = OrderedDict()
+        self._next_slot: dict[int, int] = {}
+        self._busy: set[tuple[int, int]] = set()
+
+    def get(self, key: str) -> Optional[tuple[int, int]]:
+        placement = self._sessions.get(key)
+        if placement is not None:
+            self._sessions.move_to_end(key)
+        return placement
+
+    def pin(self, key: str, instance: int) -> tuple[int, int]:
+        """Assign the conversation to the next slot of an instance, round-robin"""
+        slot = self._next_slot.get(instance, 0)
+        self._next_slot[instance] = (slot + 1) % self.slots_per_instance
+        placement = (instance, slot)
+        self._sessions[key] = placement
+        self._sessions.move_to_end(key)
+        if len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return placement
+
+    def claim(self, placement: tuple[int, int]) -> bool:
+        """Mark a slot busy; False if another request is already using it"""
+        if placement in self._busy:
+            return False
+        self._busy.add(placement)
+        return True
+
+    def release(self, placement: tuple[int, int]):
+        self._busy.discard(placement)
+
+
+class PromptCacheStats:
+    """Turns llama.cpp's per-request counts into cache-hit and time-saved metrics"""
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self.hit_ratio = 0.0
+
+    def record(self, llama_data: dict):
+        timings = llama_data.get("timings") or {}
+        total = llama_data.get("tokens_evaluated")
+        evaluated = timings.get("prompt_n")
+        if not total or evaluated is None:
+            return
+        cached = max(total - evaluated, 0)
+        PROMPT_CACHE_TOKENS.labels(result="hit").inc(cached)
+        PROMPT_CACHE_TOKENS.labels(result="miss").inc(evaluated)
+
+        ratio = cached / total
+        self.hit_ratio += self.alpha * (ratio - self.hit_ratio)
+        PROMPT_CACHE_HIT_RATIO.set(self.hit_ratio)
+
+        # Reused tokens would have cost the per-token prompt speed of this request
+        ms_per_token = timings.get("prompt_per_token_ms")
+        if not ms_per_token and evaluated:
+            ms_per_token = timings.get("prompt_ms", 0) / evaluated
+        if cached and ms_per_token:
+            PROMPT_EVAL_SECONDS_SAVED.inc(cached * ms_per_token / 1000)
@@ -0,0 +1,133 @@
+"""
+SSE encoding for streamed chat completions
+Every OpenAI chunk frame is the same bytes around the delta text, so the
+frame is pre-encoded once and only the delta is escaped per token (with
+orjson when it is installed, else the stdlib's C string escaper). Deltas
+can also be coalesced into one frame per N tokens or T milliseconds,
+whichever comes first, trading a little latency for fewer frames and
+socket writes under load.
+"""
+
+import asyncio
+import json
+import os
+from json.encoder import encode_basestring_ascii
+from typing import AsyncGenerator, Callable
+
+try:
+    import orjson
+except ImportError:  # optional: faster escaping of longer and non-ASCII deltas
+    orjson = None
+
+# Tokens per frame; 1 sends every delta as it arrives
+SSE_COALESCE_TOKENS = int(os.getenv("SSE_COALESCE_TOKENS", "1"))
+# Longest a delta waits for others to share its frame
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "15"))
+
+# Same bytes json.dumps produces for {"choices": [{"delta": {"content": ...}}]}
+CONTENT_PREFIX = b'data: {"choices": [{"delta": {"content": '
+CONTENT_SUFFIX = b'}}]}\n\n'
+DONE_FRAME = b"data: [DONE]\n\n"
+
+
+def escape_stdlib(text: str) -> bytes:
+    """JSON string literal, ASCII-only like json.dumps"""
+    return encode_basestring_ascii(text).encode("ascii")
+
+
+def escape_orjson(text: str) -> bytes:
+    """JSON string literal with UTF-8 left as is"""
+    try:
+        return orjson.dumps(text)
+    except orjson.JSONEncodeError:
+        # Lone surrogates are not valid UTF-8; the ASCII escaper keeps them as \u escapes
+        return escape_stdlib(text)
+
+
+ESCAPERS: dict[str, Callable[[str], bytes]] = {"stdlib": escape_stdlib}
+if orjson is not None:
+    ESCAPERS["orjson"] = escape_orjson
+escape = ESCAPERS["orjson" if orjson is not None else "stdlib"]
+
+
+def content_frame(text: str) -> bytes:
+    """One chat.completion.chunk SSE frame carrying text as the delta"""
+    return CONTENT_PREFIX + escape(text) + CONTENT_SUFFIX
+
+
+def json_frame(payload: dict) -> bytes:
+    return b"data: " + json.dumps(payload).encode() + b"\n\n"
+
+
+async def coalesce(
+    deltas: AsyncGenerator[str, None], max_tokens: int, max_delay: float
+) -> AsyncGenerator[str, None]:
+    """
+    Join deltas into batches of up to max_tokens.
+
+    A batch is released once it is full, max_delay seconds after its first
+    delta arrived, or when deltas ends, so no delta waits longer than
+    max_delay. deltas is read by a separate task that runs ahead of the
+    consumer; closing this generator cancels that task and closes deltas,
+    which stops generation upstream as before.
+    """
+    buffer: list[str] = []
+    arrived = asyncio.Event()  # the batch has its first delta, or deltas has ended
+    full = asyncio.Event()  # the batch is full, or deltas has ended
+    finished = False
+
+    async def pump():
+        nonlocal finished
+        try:
+            async for delta in deltas:
+                buffer.append(delta)
+                if len(buffer) == 1:
+                    arrived.set()
+                if len(buffer) >= max_tokens:
+                    full.set()
+        finally:
+            finished = True
+            arrived.set()
+            full.set()
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.create_task(pump())
+    try:
+        while True:
+            await arrived.wait()
+            if not full.is_set():
+                try:
+                    async with asyncio.timeout_at(loop.time() + max_delay):
+                        await full.wait()
+                except TimeoutError:
+                    pass
+            batch = "".join(buffer)
+            buffer.clear()
+            arrived.clear()
+            full.clear()
+            if batch:
+                yield batch
+            # Deltas that arrived while the batch was being sent go out next round
+            if finished and not buffer:
+                break
+        # Surfaces upstream errors to the caller
+        await reader
+    finally:
+        if not reader.done():
+            reader.cancel()
+            try:
+                await reader
+            except asyncio.CancelledError:
+                pass
+        await deltas.aclose()
+
+
+def frame_deltas(
+    deltas: AsyncGenerator[str, None],
+    max_tokens: int = SSE_COALESCE_TOKENS,
+    max_delay_ms: float = SSE_COALESCE_MS,
+) -> AsyncGenerator[str, None]:
+    """deltas as they should be framed: coalesced if max_tokens > 1"""
+    if max_tokens > 1:
+        return coalesce(deltas, max_tokens, max_delay_ms / 1000)
+    return deltas
@@ -0,0 +1,56 @@
+"""
+Startup phase tracking
+Records which phase the service is in (starting -> warming -> ready, or
+failed) and how long each phase took, and publishes both as metrics.
+"""
+
+import logging
+import time
+
+from prometheus_client import Gauge
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("starting", "warming", "ready", "failed")
+
+STARTUP_PHASE = Gauge('llm_startup_phase', 'Current startup phase (1 for the active phase)', ['phase'])
+STARTUP_PHASE_DURATION = Gauge(
+    'llm_startup_phase_duration_seconds', 'Time spent in each completed startup phase', ['phase']
+)
+STARTUP_TOTAL_DURATION = Gauge('llm_startup_duration_seconds', 'Time from process start until ready')
+
+
+class StartupTracker:
+    """Current startup phase plus the duration of each phase already left"""
+
+    def __init__(self):
+        self.phase = "starting"
+        self.started_at = time.monotonic()
+        self.phase_started_at = self.started_at
+        self.durations: dict[str, float] = {}
+        self._publish()
+
+    def _publish(self):
+        for phase in PHASES:
+            STARTUP_PHASE.labels(phase=phase).set(1 if phase == self.phase else 0)
+
+    def enter(self, phase: str):
+        """Move to a new phase, recording how long the previous one took"""
+        if phase not in PHASES:
+            raise ValueError(f"Unknown startup phase: {phase}")
+        if phase == self.phase:
+            return
+        now = time.monotonic()
+        elapsed = now - self.phase_started_at
+        self.durations[self.phase] = elapsed
+        STARTUP_PHASE_DURATION.labels(phase=self.phase).set(elapsed)
+        logger.info(f"Startup phase {self.phase} -> {phase} after {elapsed:.2f}s")
+        if phase == "ready":
+            STARTUP_TOTAL_DURATION.set(now - self.started_at)
+        self.phase = phase
+        self.phase_started_at = now
+        self._publish()
+
+    @property
+    def ready(self) -> bool:
+        return self.phase == "ready"
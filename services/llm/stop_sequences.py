@@ -0,0 +1,138 @@
+"""
+Streaming stop-sequence matching
+Aho-Corasick automaton over all stop strings. Each stream feeds token
+deltas through it and only holds back the shortest suffix that could still
+grow into a stop string, so patterns split across deltas are caught and
+everything else is emitted immediately.
+"""
+
+from collections import deque
+from typing import Iterable
+
+# Conversation markers the model uses when it starts writing the next turn itself
+DEFAULT_STOP_SEQUENCES = [
+    "User:",
+    "Human:",
+    "Assistant:",
+    "Question:",
+    "user:",
+    "assistant:",
+    "<|im_start|>",
+    "<|im_end|>",
+]
+
+
+class StopSequenceMatcher:
+    """Automaton built once and shared by every stream"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = [p for p in dict.fromkeys(patterns) if p]
+        # State 0 is the root; goto[s] maps a character to the next state
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        # Depth of each state = length of the prefix it represents
+        self._depth: list[int] = [0]
+        # Length of the longest pattern ending at each state (0 if none)
+        self._match: list[int] = [0]
+
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._depth.append(self._depth[state] + 1)
+                    self._match.append(0)
+                state = nxt
+            self._match[state] = max(self._match[state], len(pattern))
+
+        # Breadth-first construction of failure links
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._match[nxt] = max(self._match[nxt], self._match[self._fail[nxt]])
+
+        # Memoized full transition table, filled lazily from goto/fail
+        self._delta: list[dict[str, int]] = [dict(goto) for goto in self._goto]
+
+    def step(self, state: int, char: str) -> int:
+        nxt = self._delta[state].get(char)
+        if nxt is None:
+            fallback = state
+            while fallback and char not in self._goto[fallback]:
+                fallback = self._fail[fallback]
+            nxt = self._goto[fallback].get(char, 0)
+            self._delta[state][char] = nxt
+        return nxt
+
+    def stream(self, strip_leading_whitespace: bool = True) -> "StopSequenceStream":
+        return StopSequenceStream(self, strip_leading_whitespace)
+
+    def truncate(self, text: str) -> str:
+        """Cut a complete text at the first stop sequence"""
+        stream = self.stream(strip_leading_whitespace=False)
+        return stream.feed(text) + stream.flush()
+
+
+class StopSequenceStream:
+    """Per-response matching state; feed deltas in order, then flush once"""
+
+    def __init__(self, matcher: StopSequenceMatcher, strip_leading_whitespace: bool = True):
+        self._matcher = matcher
+        self._state = 0
+        self._held = ""
+        self._strip_leading = strip_leading_whitespace
+        self.stopped = False
+
+    def feed(self, delta: str) -> str:
+        """Consume a delta and return the text that can no longer be part of a stop sequence"""
+        if self.stopped or not delta:
+            return ""
+        matcher = self._matcher
+        table = matcher._delta
+        matches = matcher._match
+        state = self._state
+        for index, char in enumerate(delta):
+            nxt = table[state].get(char)
+            state = matcher.step(state, char) if nxt is None else nxt
+            length = matches[state]
+            if length:
+                # Match ends at this character; drop it and everything after
+                pending = self._held + delta[:index + 1]
+                self.stopped = True
+                self._held = ""
+                self._state = 0
+                return self._emit(pending[:len(pending) - length])
+        self._state = state
+        pending = self._held + delta
+        keep = matcher._depth[state]
+        if keep:
+            self._held = pending[-keep:]
+            return self._emit(pending[:-keep])
+        self._held = ""
+        return self._emit(pending)
+
+    def flush(self) -> str:
+        """Release held-back text at end of stream"""
+        if self.stopped:
+            return ""
+        held, self._held = self._held, ""
+        self._state = 0
+        return self._emit(held)
+
+    def _emit(self, text: str) -> str:
+        if self._strip_leading and text:
+            text = text.lstrip()
+            if text:
+                self._strip_leading = False
+        return text
@@ -0,0 +1,179 @@
+"""download_model.download against a small local HTTP server with Range support"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import download_model
+from download_model import DownloadError, download
+
+PART_SIZE = 16 * 1024
+DATA = os.urandom(5 * PART_SIZE + 1234)
+DATA_SHA256 = hashlib.sha256(DATA).hexdigest()
+RANGE = re.compile(r"bytes=(\d+)-(\d+)")
+
+
+class ModelHost(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.ranges = True
+        self.linked_sha256 = DATA_SHA256
+        # Ranges starting at or after this offset are cut off halfway
+        self.cut_from = len(DATA)
+        # Like the Hub: redirect to a CDN path, with the linked ETag only on the redirect
+        self.redirect = False
+        # Added to the start a ranged answer reports in Content-Range
+        self.misreport = 0
+        self.requested: list[int] = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/model.gguf"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body: bool = True):
+        host = self.server
+        linked = host.linked_sha256 and f'"{host.linked_sha256}"'
+        if host.redirect and self.path == "/model.gguf":
+            self.send_response(302)
+            self.send_header("Location", "/cdn/model.gguf")
+            self.send_header("Content-Length", "0")
+            if linked:
+                self.send_header("X-Linked-ETag", linked)
+            self.end_headers()
+            return
+        start, end = 0, len(DATA)
+        match = RANGE.fullmatch(self.headers.get("Range", ""))
+        if host.ranges and match:
+            start, end = int(match.group(1)), int(match.group(2)) + 1
+            self.send_response(206)
+            shift = host.misreport if end - start > 1 else 0
+            self.send_header("Content-Range", f"bytes {start + shift}-{end - 1 + shift}/{len(DATA)}")
+            if end - start > 1:
+                host.requested.append(start)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("ETag", '"v1"')
+        if linked and not host.redirect:
+            self.send_header("X-Linked-ETag", linked)
+        self.end_headers()
+        if not body:
+            return
+        if start >= host.cut_from:
+            # Like a connection reset mid-transfer
+            self.wfile.write(DATA[start:start + (end - start) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(DATA[start:end])
+
+
+@pytest.fixture
+def host():
+    server = ModelHost()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fail_fast(monkeypatch):
+    monkeypatch.setattr(download_model, "RETRIES", 1)
+
+
+def test_parallel_range_download_verifies_and_renames(host, tmp_path):
+    path = str(tmp_path / "model.gguf")
+    digest = download(host.url, path, workers=3, part_size=PART_SIZE)
+    assert digest == DATA_SHA256
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert sorted(host.requested) == list(range(0, len(DATA), PART_SIZE))
+    assert os.listdir(tmp_path) == ["model.gguf"]
+
+
+def test_interrupted_download_resumes_with_missing_parts_only(host, tmp_path):
+    path = str(tmp_path / "model.gguf")
+    host.cut_from = 3 * PART_SIZE
+    with pytest.raises(DownloadError):
+        download(host.url, path, workers=1, part_size=PART_SIZE)
+    assert not os.path.exists(path)
+    with open(path + ".part.json") as f:
+        assert json.load(f)["done"] == [0, 1, 2]
+
+    host.cut_from = len(DATA)
+    host.requested.clear()
+    assert download(host.url, path, workers=2, part_size=PART_SIZE) == DATA_SHA256
+    assert sorted(host.requested) == [3 * PART_SIZE, 4 * PART_SIZE, 5 * PART_SIZE]
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + ".part.json")
+
+
+def test_resume_discarded_when_part_layout_changes(host, tmp_path):
+    path = str(tmp_path / "model.gguf")
+    host.cut_from = 2 * PART_SIZE
+    with pytest.raises(DownloadError):
+        download(host.url, path, workers=1, part_size=PART_SIZE)
+    host.cut_from = len(DATA)
+    host.requested.clear()
+    # Another part size describes different parts: start over
+    assert download(host.url, path, workers=2, part_size=2 * PART_SIZE) == DATA_SHA256
+    assert sorted(host.requested) == list(range(0, len(DATA), 2 * PART_SIZE))
+
+
+def test_sha256_mismatch_discards_partial_file(host, tmp_path):
+    path = str(tmp_path / "model.gguf")
+    with pytest.raises(DownloadError, match="mismatch"):
+        download(host.url, path, sha256="0" * 64, workers=2, part_size=PART_SIZE)
+    assert os.listdir(tmp_path) == []
+
+
+def test_missing_hash_refused_unless_allowed(host, tmp_path):
+    path = str(tmp_path / "model.gguf")
+    host.linked_sha256 = None
+    with pytest.raises(DownloadError, match="No SHA-256"):
+        download(host.url, path, part_size=PART_SIZE)
+    assert os.listdir(tmp_path) == []
+    assert host.requested == []
+    assert download(host.url, path, part_size=PART_SIZE, allow_unverified=True) == DATA_SHA256
+
+
+def test_falls_back_to_single_stream_without_ranges(host, tmp_path):
+    path = str(tmp_path / "model.gguf")
+    host.ranges = False
+    assert download(host.url, path, sha256=DATA_SHA256, part_size=PART_SIZE) == DATA_SHA256
+    with open(path, "rb") as f:
+        assert f.read() == DATA
+
+
+def test_linked_sha256_read_from_the_redirect(host, tmp_path):
+    path = str(tmp_path / "model.gguf")
+    host.redirect = True
+    assert download(host.url, path, workers=2, part_size=PART_SIZE) == DATA_SHA256
+    host.linked_sha256 = "0" * 64
+    with pytest.raises(DownloadError, match="mismatch"):
+        download(host.url, str(tmp_path / "other.gguf"), workers=2, part_size=PART_SIZE)
+
+
+def test_part_with_wrong_content_range_is_rejected(host, tmp_path):
+    path = str(tmp_path / "model.gguf")
+    host.misreport = 1
+    with pytest.raises(DownloadError, match="Content-Range"):
+        download(host.url, path, workers=2, part_size=PART_SIZE)
+    assert not os.path.exists(path)
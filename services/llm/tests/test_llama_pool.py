@@ -0,0 +1,118 @@
+"""Routing and failover of LlamaServerPool against fake_llama_server.py children"""
+
+import asyncio
+import os
+import signal
+import socket
+import sys
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+
+from llama_pool import LlamaServerPool, NoHealthyInstanceError
+from upstream import UpstreamClient
+
+FAKE_SERVER = os.path.join(os.path.dirname(__file__), "..", "fake_llama_server.py")
+COMPLETION = {"prompt": "Hi", "n_predict": 4, "stream": False}
+
+
+def free_base_port(size: int) -> int:
+    """A port with the size ports from it free, as the pool numbers children consecutively"""
+    for _ in range(50):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            base = probe.getsockname()[1]
+        if base + size >= 65535:
+            continue
+        try:
+            for port in range(base, base + size):
+                with socket.socket() as probe:
+                    probe.bind(("127.0.0.1", port))
+            return base
+        except OSError:
+            continue
+    raise RuntimeError("No free port range")
+
+
+@asynccontextmanager
+async def running_pool(size: int = 2, **kwargs):
+    pool = LlamaServerPool(
+        "/tmp/fake.gguf",
+        # Health probes of a restarting child trip the breaker; let it close again quickly
+        client_factory=lambda name, url: UpstreamClient(name, url, connect_retries=0, reset_timeout=0.5),
+        size=size,
+        base_port=free_base_port(size),
+        binary=f"{sys.executable} {FAKE_SERVER}",
+        **kwargs,
+    )
+    pool.start()
+    try:
+        assert await pool.wait_until_ready(timeout=20) == size
+        yield pool
+    finally:
+        await pool.stop()
+
+
+def kill(instance):
+    os.killpg(os.getpgid(instance.process.pid), signal.SIGKILL)
+    instance.process.wait()
+
+
+async def wait_for(condition, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        await asyncio.sleep(0.05)
+
+
+def test_routes_to_least_loaded_instance(monkeypatch):
+    # Long enough that the first stream is still open while the others are routed
+    monkeypatch.setenv("FAKE_TOKEN_DELAY", "0.05")
+
+    async def scenario():
+        async with running_pool(2) as pool:
+            body = {**COMPLETION, "stream": True}
+            async with pool.stream("POST", "/completion", json=body) as (busy, response):
+                assert busy.index == 0
+                assert busy.outstanding == 1
+                instance, response = await pool.request("POST", "/completion", route="completion", json=COMPLETION)
+                assert response.status_code == 200
+                assert instance.index == 1
+                await response.aread()
+            assert busy.outstanding == 0
+            instance, _ = await pool.request("POST", "/completion", route="completion", json=COMPLETION)
+            assert instance.index == 0
+
+    asyncio.run(scenario())
+
+
+def test_fails_over_and_restarts_dead_instance():
+    async def scenario():
+        async with running_pool(2, health_interval=0.2) as pool:
+            dead = pool.instances[0]
+            kill(dead)
+            # Still marked healthy, so it is picked first and the connect error moves the request
+            assert dead.healthy
+            instance, response = await pool.request("POST", "/completion", route="completion", json=COMPLETION)
+            assert response.status_code == 200
+            assert instance.index == 1
+            assert not dead.healthy
+
+            pool.start_monitor()
+            await wait_for(lambda: dead.restarts == 1 and dead.healthy)
+            instance, response = await pool.request("POST", "/completion", route="completion", json=COMPLETION)
+            assert response.status_code == 200
+            assert instance.index == 0
+
+    asyncio.run(scenario())
+
+
+def test_no_healthy_instance_left():
+    async def scenario():
+        async with running_pool(1) as pool:
+            kill(pool.instances[0])
+            with pytest.raises(NoHealthyInstanceError):
+                await pool.request("POST", "/completion", route="completion", json=COMPLETION)
+
+    asyncio.run(scenario())
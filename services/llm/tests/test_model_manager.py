@@ -0,0 +1,74 @@
+import asyncio
+
+from main import create_llama_pool
+from model_manager import ModelManager, ModelSettings
+
+
+class FakePool:
+    """Records its lifecycle; ready only if the factory says so"""
+
+    def __init__(self, settings: ModelSettings, green: bool, ready: bool):
+        self.settings = settings
+        self.green = green
+        self.ready = ready
+        self.instances = [object()]
+        self.ready_timeout = 1.0
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    async def wait_until_ready(self, timeout: float) -> int:
+        return len(self.instances) if self.ready else 0
+
+    def start_monitor(self):
+        pass
+
+    async def stop(self):
+        self.running = False
+
+
+def test_swap_after_failed_swap_uses_the_free_port_range():
+    async def scenario():
+        pools = []
+        broken = "/models/broken.gguf"
+
+        def pool_factory(settings, green):
+            pool = FakePool(settings, green, ready=settings.model_path != broken)
+            pools.append(pool)
+            return pool
+
+        async def warm_up(pool):
+            pass
+
+        manager = ModelManager(pool_factory, warm_up, drain_timeout=1.0)
+        first = manager.deploy(ModelSettings("/models/a.gguf"))
+
+        manager.start_swap(ModelSettings(broken))
+        await manager.swap_task
+        assert manager.status["state"] == "failed"
+        assert manager.current is first and first.pool.running
+
+        generation = manager.start_swap(ModelSettings("/models/b.gguf"))
+        await manager.swap_task
+        assert manager.status["state"] == "done"
+        assert manager.current.generation == generation
+        assert manager.current.pool.running and not first.pool.running
+        # Every pool started next to the serving one took the other range
+        assert [pool.green for pool in pools] == [False, True, True]
+
+        manager.start_swap(ModelSettings("/models/a.gguf"))
+        await manager.swap_task
+        assert manager.current.green is False
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_pool_colors_use_separate_ports_and_names():
+    settings = ModelSettings("/models/a.gguf")
+    blue, green = create_llama_pool(settings, green=False), create_llama_pool(settings, green=True)
+    blue_ports = {instance.port for instance in blue.instances}
+    green_ports = {instance.port for instance in green.instances}
+    assert not blue_ports & green_ports
+    assert {i.name for i in blue.instances}.isdisjoint(i.name for i in green.instances)
@@ -0,0 +1,141 @@
+import asyncio
+import gc
+
+from main import ChatCompletionRequest, ChatMessage
+from response_cache import ResponseCache
+
+
+def generation(chunks: list[str], started: asyncio.Event, release: asyncio.Event, cancelled: list):
+    async def produce(flight):
+        try:
+            started.set()
+            for chunk in chunks:
+                await release.wait()
+                flight.publish(chunk)
+                await asyncio.sleep(0)
+            flight.finish({"completion_tokens": len(chunks)})
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+    return produce
+
+
+def test_joiner_survives_first_follower_leaving_before_it_reads():
+    async def scenario():
+        cache = ResponseCache()
+        started, release, cancelled = asyncio.Event(), asyncio.Event(), []
+        produce = generation(["a", "b", "c"], started, release, cancelled)
+
+        entry, first = cache.lookup("k", produce)
+        assert entry is None
+        await started.wait()
+        # Handed out, not yet read from
+        _, joiner = cache.lookup("k", produce)
+        await first.aclose()
+        release.set()
+        result = await joiner.result()
+        assert result.content == "abc"
+        assert not cancelled
+        assert cache.get("k").content == "abc"
+
+    asyncio.run(scenario())
+
+
+def test_flight_cancelled_when_its_only_caller_never_reads():
+    async def scenario():
+        cache = ResponseCache()
+        started, release, cancelled = asyncio.Event(), asyncio.Event(), []
+        entry, follower = cache.lookup("k", generation(["a"], started, release, cancelled))
+        task = follower.flight.task
+        await started.wait()
+        del follower
+        gc.collect()
+        await asyncio.gather(task, return_exceptions=True)
+        assert cancelled
+        assert not cache.contains("k")
+
+    asyncio.run(scenario())
+
+
+def test_last_follower_leaving_early_cancels_generation():
+    async def scenario():
+        cache = ResponseCache()
+        started, release, cancelled = asyncio.Event(), asyncio.Event(), []
+        _, first = cache.lookup("k", generation(["a", "b"], started, release, cancelled))
+        _, second = cache.lookup("k", generation(["x"], started, release, cancelled))
+        release.set()
+        assert await first.__anext__() == "a"
+        await first.aclose()
+        assert not cancelled
+        assert await second.__anext__() == "a"
+        await second.aclose()
+        await asyncio.gather(second.flight.task, return_exceptions=True)
+        assert cancelled
+
+    asyncio.run(scenario())
+
+
+def test_late_follower_replays_from_the_start_and_release_is_idempotent():
+    async def scenario():
+        cache = ResponseCache()
+        started, release, cancelled = asyncio.Event(), asyncio.Event(), []
+        release.set()
+        produce = generation(["a", "b", "c"], started, release, cancelled)
+        _, first = cache.lookup("k", produce)
+        assert await first.__anext__() == "a"
+        _, late = cache.lookup("k", produce)
+        chunks = [chunk async for chunk in late]
+        assert chunks == ["a", "b", "c"]
+        late.release()
+        await first.aclose()
+        await first.aclose()
+        assert first.flight.followers == 0
+        assert not cancelled
+
+    asyncio.run(scenario())
+
+
+def test_clear_detaches_in_flight_generations():
+    async def scenario():
+        cache = ResponseCache()
+        started, release, cancelled = asyncio.Event(), asyncio.Event(), []
+        _, old = cache.lookup("k", generation(["old"], started, release, cancelled))
+        await started.wait()
+        cache.clear()
+        # Not joined to the generation started before the clear
+        assert not cache.contains("k")
+        fresh_started = asyncio.Event()
+        _, new = cache.lookup("k", generation(["new"], fresh_started, release, cancelled))
+        assert new.flight is not old.flight
+        release.set()
+        assert (await old.result()).content == "old"
+        assert (await new.result()).content == "new"
+        await asyncio.gather(old.flight.task, new.flight.task)
+        assert cache.get("k").content == "new"
+
+    asyncio.run(scenario())
+
+
+def test_generation_finishing_after_clear_is_not_stored():
+    async def scenario():
+        cache = ResponseCache()
+        started, release, cancelled = asyncio.Event(), asyncio.Event(), []
+        _, old = cache.lookup("k", generation(["old"], started, release, cancelled))
+        await started.wait()
+        cache.clear()
+        release.set()
+        assert (await old.result()).content == "old"
+        await old.flight.task
+        assert cache.get("k") is None
+
+    asyncio.run(scenario())
+
+
+def test_streamed_and_whole_replies_use_separate_keys():
+    cache = ResponseCache()
+    messages = [ChatMessage(role="user", content="Hi  there")]
+    whole = cache.key_for(ChatCompletionRequest(messages=messages, temperature=0))
+    streamed = cache.key_for(ChatCompletionRequest(messages=messages, temperature=0, stream=True))
+    spaced = cache.key_for(ChatCompletionRequest(messages=[ChatMessage(role="user", content="Hi there")], temperature=0))
+    assert whole != streamed
+    assert whole == spaced
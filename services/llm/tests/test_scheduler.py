@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from scheduler import AdmissionRejected, AdmissionScheduler
+
+
+def test_queued_waiters_are_served_by_priority():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrency=1)
+        holder = await scheduler.acquire()
+        text = asyncio.create_task(scheduler.acquire("text"))
+        voice = asyncio.create_task(scheduler.acquire("voice"))
+        await asyncio.sleep(0)
+        assert scheduler._queued == 2
+        holder.release()
+        ticket = await voice
+        assert not text.done()
+        ticket.release()
+        (await text).release()
+        assert scheduler._queued == 0 and scheduler.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_displaces_lowest_priority():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrency=1, max_queue=1)
+        holder = await scheduler.acquire()
+        text = asyncio.create_task(scheduler.acquire("text"))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected, match="queue_full"):
+            await scheduler.acquire("text")
+        voice = asyncio.create_task(scheduler.acquire("voice"))
+        with pytest.raises(AdmissionRejected, match="displaced"):
+            await text
+        assert scheduler._queued == 1
+        holder.release()
+        (await voice).release()
+        assert scheduler._queued == 0 and scheduler.active == 0
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("interruption, raised", [
+    (asyncio.TimeoutError, AdmissionRejected),
+    (asyncio.CancelledError, asyncio.CancelledError),
+])
+def test_waiter_displaced_while_leaving_is_dequeued_once(monkeypatch, interruption, raised):
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrency=1, max_queue=1)
+        holder = await scheduler.acquire()
+        real_wait_for = asyncio.wait_for
+        voice = None
+
+        async def wait_for(future, timeout):
+            nonlocal voice
+            if voice is not None:
+                return await real_wait_for(future, timeout)
+            # The text request's wait ends, and a voice request displaces it before that is handled
+            voice = asyncio.create_task(scheduler.acquire("voice"))
+            await asyncio.sleep(0)
+            future.cancel()
+            raise interruption
+
+        monkeypatch.setattr(asyncio, "wait_for", wait_for)
+        with pytest.raises(raised):
+            await scheduler.acquire("text")
+        # Only the voice request is left waiting
+        assert scheduler._queued == 1
+        holder.release()
+        (await voice).release()
+        assert scheduler._queued == 0 and scheduler.active == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,69 @@
+import pytest
+
+from stop_sequences import DEFAULT_STOP_SEQUENCES, StopSequenceMatcher
+
+MATCHER = StopSequenceMatcher(DEFAULT_STOP_SEQUENCES)
+
+
+def run_stream(deltas: list[str], matcher: StopSequenceMatcher = MATCHER) -> str:
+    stream = matcher.stream()
+    out = [stream.feed(delta) for delta in deltas]
+    out.append(stream.flush())
+    return "".join(out)
+
+
+@pytest.mark.parametrize(
+    "deltas, expected",
+    [
+        (["Hello", " there", "\nUs", "er:", " hi"], "Hello there\n"),
+        (["Sure", ". U", "s", "e", "r", ":"], "Sure. "),
+        (["Answer <|im", "_end|>", "junk"], "Answer "),
+        (["A use", "r: x"], "A "),
+        (["ok Assist", "ant", ": more"], "ok "),
+    ],
+)
+def test_stop_sequence_split_across_deltas(deltas, expected):
+    assert run_stream(deltas) == expected
+
+
+@pytest.mark.parametrize(
+    "deltas, expected",
+    [
+        (["Users are happy", "."], "Users are happy."),
+        (["Hum", "an", " rights"], "Human rights"),
+        (["Question", "s welcome"], "Questions welcome"),
+    ],
+)
+def test_held_back_prefix_released_when_it_stops_matching(deltas, expected):
+    assert run_stream(deltas) == expected
+
+
+def test_only_possible_stop_prefix_is_held_back():
+    stream = MATCHER.stream()
+    assert stream.feed("Hello Us") == "Hello "
+    assert stream.feed("e") == ""
+    assert stream.feed("d it") == "Used it"
+
+
+def test_leading_whitespace_stripped_once():
+    assert run_stream(["  leading", " space"]) == "leading space"
+    stream = MATCHER.stream(strip_leading_whitespace=False)
+    assert stream.feed("  x") == "  x"
+
+
+def test_nothing_emitted_after_stop():
+    stream = MATCHER.stream()
+    assert stream.feed("done User: more") == "done "
+    assert stream.stopped
+    assert stream.feed("even more") == ""
+    assert stream.flush() == ""
+
+
+def test_overlapping_patterns_match_earliest_end():
+    matcher = StopSequenceMatcher(["abcd", "bc"])
+    assert run_stream(["xa", "b", "cd"], matcher) == "xa"
+
+
+def test_truncate_complete_text():
+    assert MATCHER.truncate("  answer\nHuman: next") == "  answer\n"
+    assert MATCHER.truncate("no stop here") == "no stop here"
@@ -0,0 +1,121 @@
+"""
+Token accounting
+Counts tokens with the model's own tokenizer (a local tokenizer.json when
+configured, otherwise llama-server's /tokenize endpoint) behind an LRU cache
+keyed by text hash, and records prompt size and generation speed.
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable, Optional
+
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # optional: only needed for LLAMA_TOKENIZER_PATH
+    Tokenizer = None
+
+PROMPT_TOKENS = Histogram(
+    'llm_prompt_tokens', 'Prompt size in tokens',
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+)
+COMPLETION_TOKENS = Histogram(
+    'llm_completion_tokens', 'Completion size in tokens',
+    buckets=(1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048)
+)
+TOKENS_PER_SECOND = Histogram(
+    'llm_tokens_per_second', 'Generation speed per request in tokens/s',
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 250)
+)
+TOKENIZE_CACHE = Counter('llm_tokenize_cache_total', 'Token count cache lookups', ['result'])
+TOKENIZE_SOURCE = Counter('llm_tokenize_total', 'Token counts computed, by tokenizer used', ['source'])
+
+# Rough characters-per-token ratio used only when no tokenizer is reachable
+FALLBACK_CHARS_PER_TOKEN = 4
+
+
+class TokenCounter:
+    """Cached token counts; the remote tokenizer is a coroutine returning token ids"""
+
+    def __init__(
+        self,
+        remote: Optional[Callable[[str], Awaitable[list[int]]]] = None,
+        tokenizer_path: Optional[str] = None,
+        cache_size: int = 4096,
+    ):
+        self.remote = remote
+        self.cache_size = cache_size
+        self._cache: OrderedDict[bytes, int] = OrderedDict()
+        self._local = None
+        if tokenizer_path:
+            if Tokenizer is None:
+                logger.warning("LLAMA_TOKENIZER_PATH set but the tokenizers package is not installed")
+            else:
+                self._local = Tokenizer.from_file(tokenizer_path)
+                logger.info(f"Loaded local tokenizer from {tokenizer_path}")
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def cached(self, text: str) -> Optional[int]:
+        key = self._key(text)
+        count = self._cache.get(key)
+        if count is not None:
+            self._cache.move_to_end(key)
+        return count
+
+    def _store(self, text: str, count: int):
+        self._cache[self._key(text)] = count
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        """Drop cached counts, e.g. after switching to a model with another vocabulary"""
+        self._cache.clear()
+
+    async def _tokenize(self, text: str) -> int:
+        if self._local is not None:
+            TOKENIZE_SOURCE.labels(source="local").inc()
+            return len(self._local.encode(text, add_special_tokens=False).ids)
+        if self.remote is not None:
+            try:
+                tokens = await self.remote(text)
+                TOKENIZE_SOURCE.labels(source="llama-server").inc()
+                return len(tokens)
+            except Exception as e:
+                logger.warning(f"Remote tokenization failed, estimating: {e}")
+        TOKENIZE_SOURCE.labels(source="estimate").inc()
+        return max(1, round(len(text) / FALLBACK_CHARS_PER_TOKEN)) if text else 0
+
+    async def count(self, text: str) -> int:
+        """Token count for one text; repeated texts are tokenized only once"""
+        if not text:
+            return 0
+        count = self.cached(text)
+        if count is not None:
+            TOKENIZE_CACHE.labels(result="hit").inc()
+            return count
+        TOKENIZE_CACHE.labels(result="miss").inc()
+        count = await self._tokenize(text)
+        self._store(text, count)
+        return count
+
+    async def count_segments(self, segments: Iterable[str]) -> int:
+        """Sum of per-segment counts, so shared prefixes (system prompt, RAG context) hit the cache"""
+        total = 0
+        for segment in segments:
+            total += await self.count(segment)
+        return total
+
+
+def record_usage(prompt_tokens: int, completion_tokens: int, tokens_per_second: Optional[float]):
+    """Observe per-request token histograms"""
+    PROMPT_TOKENS.observe(prompt_tokens)
+    COMPLETION_TOKENS.observe(completion_tokens)
+    if tokens_per_second:
+        TOKENS_PER_SECOND.observe(tokens_per_second)
@@ -0,0 +1,276 @@
+"""
+Upstream HTTP client layer
+Long-lived, pooled httpx clients with per-route timeouts, bounded connect
+retries and a circuit breaker. One UpstreamClient per upstream service.
+
+Kept identical in services/app and services/llm, as each image is built
+from its own directory; CI fails if the copies differ.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import httpx
+from prometheus_client import Counter, Gauge
+
+from tracing import propagation_headers
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_REQUESTS = Counter(
+    'upstream_requests_total', 'Requests sent to upstream services', ['upstream', 'route', 'outcome']
+)
+UPSTREAM_RETRIES = Counter(
+    'upstream_connect_retries_total', 'Connect retries against upstream services', ['upstream']
+)
+UPSTREAM_CONNECTIONS_OPENED = Counter(
+    'upstream_connections_opened_total', 'New TCP connections opened to upstream services', ['upstream']
+)
+UPSTREAM_CONNECTIONS_REUSED = Counter(
+    'upstream_connections_reused_total', 'Requests served on a pooled keep-alive connection', ['upstream']
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    'upstream_in_flight_requests', 'Requests currently in flight to upstream services', ['upstream']
+)
+UPSTREAM_POOL_UTILIZATION = Gauge(
+    'upstream_pool_utilization', 'In-flight requests divided by the connection pool limit', ['upstream']
+)
+UPSTREAM_CIRCUIT_STATE = Gauge(
+    'upstream_circuit_state', 'Circuit breaker state (0=closed, 1=half-open, 2=open)', ['upstream']
+)
+
+# Default timeouts per route; a route is a logical call type, not a URL
+DEFAULT_ROUTE_TIMEOUTS = {
+    "default": httpx.Timeout(connect=2.0, read=30.0, write=10.0, pool=5.0),
+    "health": httpx.Timeout(connect=1.0, read=2.0, write=2.0, pool=1.0),
+    "completion": httpx.Timeout(connect=2.0, read=30.0, write=10.0, pool=5.0),
+    # Streams are bounded by the idle gap between tokens, not total duration
+    "stream": httpx.Timeout(connect=2.0, read=30.0, write=10.0, pool=5.0),
+}
+
+
+class CircuitOpenError(httpx.RequestError):
+    """Raised when a call is refused because the upstream circuit is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with a single half-open probe"""
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        UPSTREAM_CIRCUIT_STATE.labels(upstream=name).set(0)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit for {self.name}: {self.state} -> {state}")
+        self.state = state
+        UPSTREAM_CIRCUIT_STATE.labels(upstream=self.name).set(self._STATE_VALUES[state])
+
+    def allow(self) -> bool:
+        """Return True if a request may be sent now"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._set_state(self.HALF_OPEN)
+        # Half-open: let exactly one probe through
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self._probe_in_flight = False
+        self._set_state(self.CLOSED)
+
+    def release_probe(self):
+        """Give up the half-open probe without a verdict, so the next call probes instead"""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+
+class UpstreamClient:
+    """Pooled keep-alive client for a single upstream service"""
+
+    def __init__(
+        self,
+        name: str,
+        base_url: str,
+        route_timeouts: Optional[dict[str, httpx.Timeout]] = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        connect_retries: int = 2,
+        retry_backoff: float = 0.1,
+        failure_threshold: int = 5,
+        reset_timeout: float = 10.0,
+    ):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.route_timeouts = {**DEFAULT_ROUTE_TIMEOUTS, **(route_timeouts or {})}
+        self.max_connections = max_connections
+        self.connect_retries = connect_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.in_flight = 0
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            timeout=self.route_timeouts["default"],
+        )
+
+    def _timeout(self, route: str) -> httpx.Timeout:
+        return self.route_timeouts.get(route, self.route_timeouts["default"])
+
+    def _track(self, delta: int):
+        self.in_flight += delta
+        UPSTREAM_IN_FLIGHT.labels(upstream=self.name).set(self.in_flight)
+        UPSTREAM_POOL_UTILIZATION.labels(upstream=self.name).set(self.in_flight / self.max_connections)
+
+    def _build_request(self, method: str, path: str, route: str, **kwargs) -> tuple[httpx.Request, dict]:
+        """Build a request carrying trace headers and a hook that records whether a new connection was opened"""
+        state = {"opened": False}
+
+        async def trace(event_name: str, info: dict):
+            if event_name == "connection.connect_tcp.complete":
+                state["opened"] = True
+
+        extensions = {**kwargs.pop("extensions", {}), "trace": trace}
+        # The current span, if any, continues in the upstream service
+        headers = {**propagation_headers(), **(kwargs.pop("headers", None) or {})}
+        request = self._client.build_request(
+            method, path, timeout=self._timeout(route), extensions=extensions, headers=headers, **kwargs
+        )
+        return request, state
+
+    def _record_connection(self, state: dict):
+        if state["opened"]:
+            UPSTREAM_CONNECTIONS_OPENED.labels(upstream=self.name).inc()
+        else:
+            UPSTREAM_CONNECTIONS_REUSED.labels(upstream=self.name).inc()
+
+    async def _send(self, method: str, path: str, route: str, stream: bool, **kwargs) -> httpx.Response:
+        """Send with bounded retries on connect errors only, so no request is ever sent twice"""
+        if not self.breaker.allow():
+            UPSTREAM_REQUESTS.labels(upstream=self.name, route=route, outcome="circuit_open").inc()
+            raise CircuitOpenError(f"Circuit open for upstream {self.name}")
+        probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+        try:
+            return await self._send_allowed(method, path, route, stream, **kwargs)
+        except BaseException:
+            # Cancelled (client gone, barge-in) or failed before a verdict: a held
+            # probe would otherwise keep the circuit half-open and refusing forever
+            if probe:
+                self.breaker.release_probe()
+            raise
+
+    async def _send_allowed(self, method: str, path: str, route: str, stream: bool, **kwargs) -> httpx.Response:
+        attempt = 0
+        while True:
+            request, state = self._build_request(method, path, route, **kwargs)
+            try:
+                response = await self._client.send(request, stream=stream)
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt < self.connect_retries:
+                    attempt += 1
+                    UPSTREAM_RETRIES.labels(upstream=self.name).inc()
+                    await asyncio.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+                    continue
+                self.breaker.record_failure()
+                UPSTREAM_REQUESTS.labels(upstream=self.name, route=route, outcome="connect_error").inc()
+                raise e
+            except httpx.TransportError:
+                self.breaker.record_failure()
+                UPSTREAM_REQUESTS.labels(upstream=self.name, route=route, outcome="transport_error").inc()
+                raise
+
+            self._record_connection(state)
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+                UPSTREAM_REQUESTS.labels(upstream=self.name, route=route, outcome="server_error").inc()
+            else:
+                self.breaker.record_success()
+                UPSTREAM_REQUESTS.labels(upstream=self.name, route=route, outcome="ok").inc()
+            return response
+
+    async def request(self, method: str, path: str, route: str = "default", **kwargs) -> httpx.Response:
+        """Send a request and read the full body"""
+        self._track(1)
+        try:
+            return await self._send(method, path, route, stream=False, **kwargs)
+        finally:
+            self._track(-1)
+
+    async def get(self, path: str, route: str = "default", **kwargs) -> httpx.Response:
+        return await self.request("GET", path, route=route, **kwargs)
+
+    async def post(self, path: str, route: str = "default", **kwargs) -> httpx.Response:
+        return await self.request("POST", path, route=route, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, path: str, route: str = "stream", **kwargs) -> AsyncIterator[httpx.Response]:
+        """Send a request and yield the response with an unread body"""
+        self._track(1)
+        try:
+            response = await self._send(method, path, route, stream=True, **kwargs)
+            try:
+                yield response
+            finally:
+                await response.aclose()
+        finally:
+            self._track(-1)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+class UpstreamRegistry:
+    """Named set of upstream clients created once per process in lifespan"""
+
+    def __init__(self):
+        self._clients: dict[str, UpstreamClient] = {}
+
+    def add(self, client: UpstreamClient) -> UpstreamClient:
+        self._clients[client.name] = client
+        return client
+
+    def get(self, name: str) -> UpstreamClient:
+        return self._clients[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._clients
+
+    async def aclose(self):
+        for client in self._clients.values():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f"Error closing upstream client {client.name}: {e}")
+        self._clients.clear()
@@ -0,0 +1,183 @@
+"""
+Dynamic micro-batching for embeddings
+Embed requests arrive one at a time, but a forward pass costs about the
+same for one text as for dozens. Requests are queued and collected into
+batches bounded by max batch size and max wait, embedded in one forward
+pass on a worker thread, and the rows are scattered back to the callers.
+While a batch is running the next one fills up, so batches grow with load.
+A text that finds nothing else queued goes straight to the model; max wait
+only holds a batch open while other texts are still arriving.
+
+Repeated query strings are answered from an LRU cache, and identical
+texts already waiting for a batch share its result.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+EMBED_BATCH_SIZE = Histogram(
+    'rag_embed_batch_size', 'Texts per embedding forward pass',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+EMBED_BATCH_WAIT = Histogram(
+    'rag_embed_batch_wait_seconds', 'Time a text waited for its batch to start (latency added by batching)',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+)
+EMBED_FORWARD = Histogram(
+    'rag_embed_forward_seconds', 'Duration of one embedding forward pass',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+EMBED_ITEMS = Counter('rag_embed_items_total', 'Texts embedded, by where the vector came from', ['source'])
+
+KINDS = ("query", "passage")
+
+
+@dataclass
+class _Pending:
+    """A text waiting for a forward pass"""
+    text: str
+    kind: str
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+class EmbeddingBatcher:
+    """Collects concurrent embed calls into batched forward passes"""
+
+    def __init__(self, embedder, max_batch_size: int = 32, max_wait_ms: float = 5.0, cache_size: int = 4096):
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._waiting: dict[tuple[str, str], asyncio.Future] = {}
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # One forward pass at a time: the model already uses every core
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._executor.shutdown(wait=False)
+
+    async def embed(self, texts: list[str], kind: str = "query") -> np.ndarray:
+        """Embed texts as queries or passages; returns a (len(texts), dim) float32 array"""
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {KINDS}")
+        rows: list[Optional[np.ndarray]] = [None] * len(texts)
+        futures = {}
+        for i, text in enumerate(texts):
+            cached = self._cache_get(text) if kind == "query" else None
+            if cached is not None:
+                EMBED_ITEMS.labels(source="cache").inc()
+                rows[i] = cached
+                continue
+            key = (kind, text)
+            future = self._waiting.get(key)
+            if future is not None:
+                EMBED_ITEMS.labels(source="coalesced").inc()
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self._waiting[key] = future
+                self._queue.put_nowait(_Pending(text, kind, future))
+            futures[i] = future
+        for i, future in futures.items():
+            # shield: a caller giving up must not cancel a row other callers share
+            rows[i] = await asyncio.shield(future)
+        if not rows:
+            return np.zeros((0, self.embedder.dim), dtype=np.float32)
+        return np.stack(rows)
+
+    def _cache_get(self, text: str) -> Optional[np.ndarray]:
+        vector = self._cache.get(text)
+        if vector is not None:
+            self._cache.move_to_end(text)
+        return vector
+
+    def _cache_put(self, text: str, vector: np.ndarray):
+        if self.cache_size <= 0:
+            return
+        self._cache[text] = vector
+        self._cache.move_to_end(text)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _collect(self) -> list[_Pending]:
+        """Wait for a first text, then gather more until the batch is full or its wait is over"""
+        batch = [await self._queue.get()]
+        deadline = batch[0].enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            if len(batch) == 1:
+                # Alone: waiting would only add latency; later texts fill the next batch while this one runs
+                break
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _forward(self, batch: list[_Pending]) -> list[np.ndarray]:
+        """Embed a batch on the worker thread, one model call per kind present"""
+        rows: list[Optional[np.ndarray]] = [None] * len(batch)
+        for kind in KINDS:
+            indexes = [i for i, item in enumerate(batch) if item.kind == kind]
+            if not indexes:
+                continue
+            texts = [batch[i].text for i in indexes]
+            if kind == "query":
+                vectors = self.embedder.embed_queries(texts)
+            else:
+                vectors = self.embedder.embed_passages(texts)
+            for i, vector in zip(indexes, vectors):
+                rows[i] = vector
+        return rows
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            started = time.perf_counter()
+            for item in batch:
+                EMBED_BATCH_WAIT.observe(started - item.enqueued_at)
+            EMBED_BATCH_SIZE.observe(len(batch))
+            try:
+                with EMBED_FORWARD.time():
+                    rows = await loop.run_in_executor(self._executor, self._forward, batch)
+            except Exception as e:
+                logger.error(f"Embedding batch of {len(batch)} failed: {e!r}")
+                for item in batch:
+                    self._waiting.pop((item.kind, item.text), None)
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+            EMBED_ITEMS.labels(source="model").inc(len(batch))
+            for item, row in zip(batch, rows):
+                self._waiting.pop((item.kind, item.text), None)
+                if item.kind == "query":
+                    self._cache_put(item.text, row)
+                if not item.future.done():
+                    item.future.set_result(row)
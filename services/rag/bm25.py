@@ -0,0 +1,174 @@
+"""
+BM25 inverted index
+Lexical retrieval next to the vector index, for what embeddings blur:
+product codes, error strings, version numbers. Compound tokens such as
+"ERR-4021" or "v2.3.1" are indexed whole and by their parts, so both an
+exact code and a fragment of it match.
+
+Postings are appended in place (array-backed), so adding a chunk costs
+only its own terms; deleted chunks are excluded at query time until the
+knowledge base compacts and rebuilds the index.
+
+The postings of a base index are saved next to it and memory-mapped on
+load, so startup does not tokenize the corpus again:
+    bm25.json         k1, b, chunk count, total length, terms in posting order
+    bm25_offsets.bin  int64 start of each term's postings, plus the end
+    bm25_ids.bin      int32 chunk ids, grouped by term
+    bm25_tfs.bin      float32 term frequency of each posting
+    bm25_lengths.bin  float32 token count of each chunk id
+"""
+
+import json
+import math
+import os
+import re
+from array import array
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+from vector_store import top_k_indices
+
+BM25_META_FILE = "bm25.json"
+BM25_OFFSETS_FILE = "bm25_offsets.bin"
+BM25_IDS_FILE = "bm25_ids.bin"
+BM25_TFS_FILE = "bm25_tfs.bin"
+BM25_LENGTHS_FILE = "bm25_lengths.bin"
+
+# Alphanumeric runs, keeping separators inside codes (err-4021, v2.3.1, a_b/c)
+TOKEN = re.compile(r"[^\W_]+(?:[-_./:#][^\W_]+)*")
+SEPARATORS = re.compile(r"[-_./:#]")
+
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for match in TOKEN.finditer(text.lower()):
+        token = match.group()
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(part for part in SEPARATORS.split(token) if part)
+    return tokens
+
+
+def _map(path: str, dtype) -> np.ndarray:
+    # np.memmap refuses empty files
+    if not os.path.getsize(path):
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class InvertedIndex:
+    """Append-only BM25 index over integer chunk ids"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.count = 0
+        self.total_length = 0
+        self._postings: dict[str, tuple[array, array]] = {}
+        self._lengths = array("f")
+        # Saved postings, memory-mapped and read-only; appends go to _postings
+        self._saved_terms: dict[str, int] = {}
+        self._saved_offsets = np.zeros(1, dtype=np.int64)
+        self._saved_ids = np.empty(0, dtype=np.int32)
+        self._saved_tfs = np.empty(0, dtype=np.float32)
+
+    @classmethod
+    def open(cls, directory: str) -> "InvertedIndex":
+        """Map postings saved in directory; FileNotFoundError if there are none"""
+        with open(os.path.join(directory, BM25_META_FILE)) as f:
+            meta = json.load(f)
+        index = cls(k1=meta["k1"], b=meta["b"])
+        index.count = meta["count"]
+        index.total_length = meta["total_length"]
+        index._saved_terms = {term: slot for slot, term in enumerate(meta["terms"])}
+        index._saved_offsets = np.fromfile(os.path.join(directory, BM25_OFFSETS_FILE), dtype=np.int64)
+        index._saved_ids = _map(os.path.join(directory, BM25_IDS_FILE), np.int32)
+        index._saved_tfs = _map(os.path.join(directory, BM25_TFS_FILE), np.float32)
+        with open(os.path.join(directory, BM25_LENGTHS_FILE), "rb") as f:
+            index._lengths.frombytes(f.read())
+        return index
+
+    def save(self, directory: str):
+        """Write the postings to directory, metadata last so a partial save is never opened"""
+        terms = sorted(self._saved_terms.keys() | self._postings.keys())
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        with open(os.path.join(directory, BM25_IDS_FILE), "wb") as ids_file, \
+                open(os.path.join(directory, BM25_TFS_FILE), "wb") as tfs_file:
+            for slot, term in enumerate(terms):
+                ids, tfs = self._posting(term)
+                ids_file.write(ids.astype(np.int32).tobytes())
+                tfs_file.write(tfs.astype(np.float32).tobytes())
+                offsets[slot + 1] = offsets[slot] + len(ids)
+        offsets.tofile(os.path.join(directory, BM25_OFFSETS_FILE))
+        with open(os.path.join(directory, BM25_LENGTHS_FILE), "wb") as f:
+            f.write(self._lengths.tobytes())
+        meta = {"k1": self.k1, "b": self.b, "count": self.count, "total_length": self.total_length, "terms": terms}
+        with open(os.path.join(directory, BM25_META_FILE), "w") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    def _posting(self, term: str) -> Optional[tuple[np.ndarray, np.ndarray]]:
+        """Chunk ids and term frequencies of a term, saved postings first"""
+        parts = []
+        slot = self._saved_terms.get(term)
+        if slot is not None:
+            start, end = self._saved_offsets[slot], self._saved_offsets[slot + 1]
+            parts.append((self._saved_ids[start:end], self._saved_tfs[start:end]))
+        appended = self._postings.get(term)
+        if appended is not None:
+            parts.append((np.asarray(appended[0]), np.asarray(appended[1])))
+        if not parts:
+            return None
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([ids for ids, _ in parts]), np.concatenate([tfs for _, tfs in parts])
+
+    def add(self, chunk_id: int, text: str):
+        terms = Counter(tokenize(text))
+        if chunk_id >= len(self._lengths):
+            self._lengths.extend([0.0] * (chunk_id + 1 - len(self._lengths)))
+        for term, tf in terms.items():
+            ids, tfs = self._postings.setdefault(term, (array("i"), array("f")))
+            ids.append(chunk_id)
+            tfs.append(tf)
+        length = sum(terms.values())
+        self._lengths[chunk_id] = length
+        self.total_length += length
+        self.count += 1
+
+    def search(self, query: str, k: int, exclude: frozenset = frozenset()) -> list[tuple[int, float]]:
+        """
+        Score chunks sharing terms with the query.
+
+        Not safe to run concurrently with add(): callers hold the
+        knowledge base lock.
+
+        Returns:
+            (chunk id, BM25 score) pairs, best first
+        """
+        if not self.count:
+            return []
+        # A view, not a copy: the array cannot be resized until it is dropped, which the lock ensures
+        lengths = np.frombuffer(self._lengths, dtype=np.float32)
+        average_length = self.total_length / self.count
+        matched_ids, matched_scores = [], []
+        for term in set(tokenize(query)):
+            posting = self._posting(term)
+            if posting is None:
+                continue
+            ids = np.asarray(posting[0], dtype=np.int64)
+            tfs = np.asarray(posting[1], dtype=np.float32)
+            idf = math.log(1 + (self.count - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = tfs + self.k1 * (1 - self.b + self.b * lengths[ids] / average_length)
+            matched_ids.append(ids)
+            matched_scores.append(idf * tfs * (self.k1 + 1) / norm)
+        if not matched_ids:
+            return []
+        chunk_ids, inverse = np.unique(np.concatenate(matched_ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(matched_scores))
+        if exclude:
+            keep = ~np.isin(chunk_ids, np.fromiter(exclude, dtype=np.int64, count=len(exclude)))
+            chunk_ids, scores = chunk_ids[keep], scores[keep]
+        best = top_k_indices(scores, k)
+        return [(int(chunk_ids[i]), float(scores[i])) for i in best]
@@ -0,0 +1,97 @@
+"""
+Text embedders
+The RAG service embeds passages at ingestion and queries at search time
+with the same embedder; its name is stored with the index so a mismatch
+is caught at load time. A sentence-transformers model is used when the
+package is installed, otherwise a deterministic hashing embedder that
+needs no model download (good enough for lexical matching and for tests).
+"""
+
+import hashlib
+import logging
+import os
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "intfloat/e5-small-v2")
+# "auto", "sentence-transformers" or "hashing"
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "auto")
+HASHING_DIM = int(os.getenv("HASHING_EMBED_DIM", "384"))
+
+WORD = re.compile(r"\w+")
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows so dot products are cosine similarities"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class HashingEmbedder:
+    """
+    Feature-hashed bag of words and word bigrams.
+
+    Deterministic across processes and machines (blake2b, not hash()),
+    so indexes built anywhere can be queried anywhere.
+    """
+
+    def __init__(self, dim: int = HASHING_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text: str) -> list[str]:
+        words = WORD.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def _embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                vectors[row, digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        return normalize(vectors)
+
+    def embed_queries(self, texts: list[str]) -> np.ndarray:
+        return self._embed(texts)
+
+    def embed_passages(self, texts: list[str]) -> np.ndarray:
+        return self._embed(texts)
+
+
+class SentenceTransformerEmbedder:
+    """Dense embeddings from a sentence-transformers model (e.g. e5-small-v2)"""
+
+    def __init__(self, model_name: str = EMBED_MODEL):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model_name
+        # e5 models are trained with these role prefixes
+        self._prefixes = ("query: ", "passage: ") if "e5" in model_name.lower() else ("", "")
+
+    def _embed(self, texts: list[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True)
+        return vectors.astype(np.float32)
+
+    def embed_queries(self, texts: list[str]) -> np.ndarray:
+        return self._embed([self._prefixes[0] + text for text in texts])
+
+    def embed_passages(self, texts: list[str]) -> np.ndarray:
+        return self._embed([self._prefixes[1] + text for text in texts])
+
+
+def create_embedder(backend: str = EMBED_BACKEND, model_name: str = EMBED_MODEL):
+    """Create the configured embedder, falling back to hashing in auto mode"""
+    if backend == "hashing":
+        return HashingEmbedder()
+    try:
+        return SentenceTransformerEmbedder(model_name)
+    except ImportError:
+        if backend != "auto":
+            raise
+        logger.warning("sentence-transformers not installed, using the hashing embedder")
+        return HashingEmbedder()
@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""
+Corpus ingestion
+Loads document dumps into the RAG index with a streaming pipeline:
+
+    read -> chunk (token windows) -> dedupe (content hash) -> embed (process pool) -> bulk write
+
+Documents are read lazily, embedded in batches with a bounded number in
+flight, and written straight to the index files, so memory use stays
+flat however large the corpus is. Seen chunk hashes live in SQLite next
+to the index being built, together with the checkpoint, and both are
+committed in one transaction after the written files are synced. An
+interrupted run started again with the same inputs resumes from the
+last checkpoint. With --append, a document whose id is ingested again
+replaces the chunks it had in the existing index.
+
+The finished index, with its BM25 postings, replaces the one at --index
+with renames. A running RAG service picks it up with POST /admin/reload,
+or runs the ingest itself through POST /ingest.
+
+Input formats:
+    *.jsonl         one document per line: {"text": ..., "id": ..., "metadata": {...}}
+    *.txt, *.md     one document per file
+
+Usage:
+    python ingest.py /data/corpus --index /data/index --workers 4
+    python ingest.py dump.jsonl --index /data/index --append
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterator, Optional
+
+import numpy as np
+from prometheus_client import Counter
+
+from embeddings import EMBED_BACKEND, EMBED_MODEL, create_embedder
+from knowledge_base import index_base
+from vector_store import BLOCK_ROWS, META_FILE, IndexWriter, VectorIndex, publish_index
+
+logger = logging.getLogger(__name__)
+
+INGEST_DOCUMENTS = Counter('rag_ingest_documents_total', 'Documents read by ingestion')
+INGEST_CHUNKS = Counter('rag_ingest_chunks_total', 'Chunks produced by ingestion', ['result'])
+
+TEXT_SUFFIXES = (".txt", ".md")
+JSONL_SUFFIXES = (".jsonl",)
+STATE_FILE = "ingest.sqlite"
+
+# Word and punctuation tokens; subword tokenizers see roughly 1.3x as many
+TOKEN = re.compile(r"\w+|[^\w\s]")
+SENTENCE_END = {".", "!", "?"}
+
+
+@dataclass
+class Document:
+    doc_id: str
+    text: str
+    metadata: dict
+    # (file index, byte offset) just past this document, where a resumed run starts
+    position: tuple[int, int]
+
+
+@dataclass
+class IngestStats:
+    docs: int = 0
+    chunks: int = 0
+    duplicates: int = 0
+    elapsed: float = 0.0
+    # Progress made by this run, for rates when resuming
+    run_docs: int = field(default=0, repr=False)
+    run_chunks: int = field(default=0, repr=False)
+
+    @property
+    def docs_per_second(self) -> float:
+        return self.run_docs / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.run_chunks / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "docs": self.docs,
+            "chunks": self.chunks,
+            "duplicates": self.duplicates,
+            "elapsed_s": round(self.elapsed, 1),
+            "docs_per_s": round(self.docs_per_second, 1),
+            "chunks_per_s": round(self.chunks_per_second, 1),
+        }
+
+
+# =============================================================================
+# Read
+# =============================================================================
+
+def list_inputs(paths: list[str]) -> list[str]:
+    """Supported files under the given paths, in a stable order"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+    return sorted(f for f in files if f.endswith(TEXT_SUFFIXES + JSONL_SUFFIXES))
+
+
+def read_documents(files: list[str], start: tuple[int, int] = (0, 0)) -> Iterator[Document]:
+    """Yield documents from start on, one at a time"""
+    first_file, first_offset = start
+    for file_index in range(first_file, len(files)):
+        path = files[file_index]
+        offset = first_offset if file_index == first_file else 0
+        if path.endswith(JSONL_SUFFIXES):
+            with open(path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    line_start, offset = offset, offset + len(line)
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Skipping malformed line at {path}:{line_start}")
+                        continue
+                    if not record.get("text"):
+                        continue
+                    yield Document(
+                        doc_id=str(record.get("id") or f"{path}:{line_start}"),
+                        text=record["text"],
+                        metadata={**record.get("metadata", {}), "source": path},
+                        position=(file_index, offset),
+                    )
+        elif offset == 0:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+            yield Document(doc_id=path, text=text, metadata={"source": path}, position=(file_index, 1))
+
+
+# =============================================================================
+# Chunk and dedupe
+# =============================================================================
+
+class Chunker:
+    """Token windows with overlap, ending at a sentence boundary where one is close"""
+
+    def __init__(self, max_tokens: int = 200, overlap: int = 32):
+        if overlap >= max_tokens:
+            raise ValueError("overlap must be smaller than max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+
+    def split(self, text: str) -> list[str]:
+        tokens = [(m.start(), m.end(), m.group()) for m in TOKEN.finditer(text)]
+        chunks = []
+        start = 0
+        while start < len(tokens):
+            end = min(start + self.max_tokens, len(tokens))
+            if end < len(tokens):
+                # Back off to a sentence end in the last quarter of the window
+                for cut in range(end, start + self.max_tokens * 3 // 4, -1):
+                    if tokens[cut - 1][2] in SENTENCE_END:
+                        end = cut
+                        break
+            chunks.append(text[tokens[start][0]:tokens[end - 1][1]])
+            if end == len(tokens):
+                break
+            start = max(end - self.overlap, start + 1)
+        return chunks
+
+
+def chunk_digest(text: str) -> bytes:
+    """Content hash, insensitive to case and whitespace"""
+    return hashlib.blake2b(" ".join(text.lower().split()).encode("utf-8"), digest_size=16).digest()
+
+
+class IngestState:
+    """
+    Seen chunk hashes, the ids of the documents being ingested and the
+    checkpoint, in one SQLite file.
+
+    Hashes of chunks that are batched but not yet written are held in
+    memory (bounded by the batches in flight) and only inserted once
+    their batch is written, so a commit never covers a chunk the index
+    files do not contain.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (hash BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS ingested (doc_id TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY, state TEXT)")
+        self.db.commit()
+        self._pending: set[bytes] = set()
+
+    def checkpoint(self) -> Optional[dict]:
+        row = self.db.execute("SELECT state FROM checkpoint WHERE id = 1").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def is_new(self, digest: bytes) -> bool:
+        if digest in self._pending:
+            return False
+        if self.db.execute("SELECT 1 FROM seen WHERE hash = ?", (digest,)).fetchone():
+            return False
+        self._pending.add(digest)
+        return True
+
+    def add_ingested(self, doc_ids: Iterator[str]):
+        self.db.executemany("INSERT OR IGNORE INTO ingested VALUES (?)", ((d,) for d in doc_ids))
+
+    def is_ingested(self, doc_id: str) -> bool:
+        return self.db.execute("SELECT 1 FROM ingested WHERE doc_id = ?", (doc_id,)).fetchone() is not None
+
+    def written(self, digests: list[bytes]):
+        self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((d,) for d in digests))
+        self._pending.difference_update(digests)
+
+    def commit(self, checkpoint: dict):
+        self.db.execute("INSERT OR REPLACE INTO checkpoint VALUES (1, ?)", (json.dumps(checkpoint),))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+@dataclass
+class _Batch:
+    chunks: list[dict]
+    digests: list[bytes]
+    docs: int
+    duplicates: int
+    position: tuple[int, int]
+
+
+def make_batches(documents: Iterator[Document], chunker: Chunker, state: IngestState,
+                 batch_size: int) -> Iterator[_Batch]:
+    """Group new chunks into batches that end on a document boundary"""
+    chunks, digests, docs, duplicates = [], [], 0, 0
+    position = None
+    for doc in documents:
+        docs += 1
+        position = doc.position
+        for index, text in enumerate(chunker.split(doc.text)):
+            digest = chunk_digest(text)
+            if not state.is_new(digest):
+                duplicates += 1
+                continue
+            chunks.append({"text": text, "metadata": {**doc.metadata, "doc_id": doc.doc_id, "chunk": index}})
+            digests.append(digest)
+        if len(chunks) >= batch_size or docs >= batch_size:
+            yield _Batch(chunks, digests, docs, duplicates, position)
+            chunks, digests, docs, duplicates = [], [], 0, 0
+    if docs:
+        yield _Batch(chunks, digests, docs, duplicates, position)
+
+
+# =============================================================================
+# Embed
+# =============================================================================
+
+_worker_embedder = None
+
+
+def _init_worker(backend: str, model: str, threads: int):
+    global _worker_embedder
+    # Keep each worker's math library to its share of the cores
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    _worker_embedder = create_embedder(backend, model)
+
+
+def _describe_embedder() -> tuple[str, int]:
+    return _worker_embedder.name, _worker_embedder.dim
+
+
+def _embed(texts: list[str]) -> np.ndarray:
+    return _worker_embedder.embed_passages(texts)
+
+
+class _InlineExecutor:
+    """Executor stand-in for workers=0: embeds in this process"""
+
+    def __init__(self, backend: str, model: str):
+        _init_worker(backend, model, os.cpu_count() or 1)
+
+    def submit(self, fn, *args) -> Future:
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def shutdown(self, wait: bool = True, cancel_futures: bool = False):
+        pass
+
+
+# =============================================================================
+# Pipeline
+# =============================================================================
+
+def copy_base(index_path: str, embedder: str, writer: IndexWriter, state: IngestState,
+              files: list[str]) -> tuple[int, int]:
+    """
+    Stream the existing index into the new one, so ingestion appends to it.
+    Chunks of documents that are in files are left out; the new version
+    replaces them. Returns the chunks copied and dropped.
+    """
+    if not os.path.exists(os.path.join(index_path, META_FILE)):
+        return 0, 0
+    base = VectorIndex(index_path)
+    try:
+        if base.embedder != embedder:
+            raise ValueError(f"Existing index was built with {base.embedder}, not {embedder}")
+        # A pass over the ids only; nothing is chunked or embedded
+        state.add_ingested(doc.doc_id for doc in read_documents(files))
+        copied = 0
+        for start in range(0, base.count, BLOCK_ROWS):
+            ids, chunks = [], []
+            for i in range(start, min(start + BLOCK_ROWS, base.count)):
+                chunk = base.chunk(i)
+                doc_id = chunk["metadata"].get("doc_id")
+                if doc_id is None or not state.is_ingested(str(doc_id)):
+                    ids.append(i)
+                    chunks.append(chunk)
+            if chunks:
+                writer.add(base.vectors_for(np.array(ids)), chunks)
+                state.written([chunk_digest(chunk["text"]) for chunk in chunks])
+                copied += len(chunks)
+        return copied, base.count - copied
+    finally:
+        base.close()
+
+
+def ingest(
+    paths: list[str],
+    index_path: str,
+    workers: Optional[int] = None,
+    batch_size: int = 64,
+    max_tokens: int = 200,
+    overlap: int = 32,
+    append: bool = False,
+    backend: str = EMBED_BACKEND,
+    model: str = EMBED_MODEL,
+    checkpoint_seconds: float = 10.0,
+    progress: Optional[Callable[[IngestStats], None]] = None,
+) -> IngestStats:
+    """
+    Build an index from documents and swap it in at index_path.
+
+    Args:
+        paths: Files or directories to ingest
+        index_path: Index directory to replace
+        workers: Embedding processes; 0 embeds in this process
+        batch_size: Chunks per embedding batch
+        max_tokens: Chunk window size in word/punctuation tokens
+        overlap: Tokens repeated between consecutive chunks
+        append: Keep the chunks of the existing index, except those of
+            documents ingested again
+        backend: Embedder backend, see embeddings.create_embedder
+        model: Embedding model name
+        checkpoint_seconds: Minimum time between checkpoints
+        progress: Called with the running totals at every checkpoint
+
+    Returns:
+        Totals and this run's docs/s and chunks/s
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    files = list_inputs(paths)
+    settings = {"files": files, "max_tokens": max_tokens, "overlap": overlap, "append": append}
+    staging = index_path.rstrip("/") + ".ingest"
+    os.makedirs(staging, exist_ok=True)
+    state = IngestState(os.path.join(staging, STATE_FILE))
+    checkpoint = state.checkpoint()
+    if checkpoint and checkpoint["settings"] != settings:
+        logger.warning("Discarding the checkpoint of an ingest with different inputs")
+        checkpoint = None
+    if checkpoint is None:
+        state.close()
+        shutil.rmtree(staging)
+        os.makedirs(staging)
+        state = IngestState(os.path.join(staging, STATE_FILE))
+
+    if workers > 0:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            # spawn: forking a threaded server process is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(backend, model, max(1, (os.cpu_count() or 1) // workers)),
+        )
+    else:
+        executor = _InlineExecutor(backend, model)
+    try:
+        embedder, dim = executor.submit(_describe_embedder).result()
+        if checkpoint and checkpoint["embedder"] != embedder:
+            raise ValueError(f"Checkpoint was written with {checkpoint['embedder']}, embedder is now {embedder}")
+        writer = IndexWriter(staging, dim, embedder, state=checkpoint["writer"] if checkpoint else None)
+        stats = IngestStats(**checkpoint["stats"]) if checkpoint else IngestStats()
+        position = tuple(checkpoint["position"]) if checkpoint else (0, 0)
+        started = time.perf_counter()
+
+        def save(position: tuple[int, int]):
+            stats.elapsed = time.perf_counter() - started
+            # Files first: the commit must never cover rows that are not on disk
+            writer_state = writer.flush()
+            state.commit({
+                "settings": settings,
+                "embedder": embedder,
+                "writer": writer_state,
+                "position": position,
+                "stats": {"docs": stats.docs, "chunks": stats.chunks, "duplicates": stats.duplicates},
+            })
+            logger.info(
+                f"Ingested {stats.docs} docs, {stats.chunks} chunks ({stats.duplicates} duplicates): "
+                f"{stats.docs_per_second:.0f} docs/s, {stats.chunks_per_second:.0f} chunks/s"
+            )
+            if progress:
+                progress(stats)
+
+        if checkpoint:
+            logger.info(f"Resuming ingest at file {position[0]} offset {position[1]}")
+        elif append:
+            copied, dropped = copy_base(index_path, embedder, writer, state, files)
+            stats.chunks += copied
+            logger.info(f"Copied {copied} chunks from the existing index, dropped {dropped} of re-ingested documents")
+            save(position)
+
+        last_save = time.monotonic()
+        in_flight: deque[tuple[_Batch, Future]] = deque()
+
+        def write_oldest():
+            nonlocal last_save
+            batch, future = in_flight.popleft()
+            # Oldest first, so every write extends a contiguous prefix of the input
+            vectors = future.result()
+            writer.add(vectors, batch.chunks)
+            state.written(batch.digests)
+            stats.docs += batch.docs
+            stats.chunks += len(batch.chunks)
+            stats.duplicates += batch.duplicates
+            stats.run_docs += batch.docs
+            stats.run_chunks += len(batch.chunks)
+            INGEST_DOCUMENTS.inc(batch.docs)
+            INGEST_CHUNKS.labels(result="written").inc(len(batch.chunks))
+            INGEST_CHUNKS.labels(result="duplicate").inc(batch.duplicates)
+            if time.monotonic() - last_save >= checkpoint_seconds:
+                save(batch.position)
+                last_save = time.monotonic()
+            return batch.position
+
+        chunker = Chunker(max_tokens, overlap)
+        for batch in make_batches(read_documents(files, position), chunker, state, batch_size):
+            texts = [chunk["text"] for chunk in batch.chunks]
+            future = executor.submit(_embed, texts) if texts else _completed(np.zeros((0, dim), np.float32))
+            in_flight.append((batch, future))
+            # Bounded in flight: reading never runs far ahead of embedding
+            if len(in_flight) >= max(2, workers * 2):
+                position = write_oldest()
+        while in_flight:
+            position = write_oldest()
+        save(position)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        state.close()
+
+    writer.finish()
+    index_base(staging)
+    os.remove(os.path.join(staging, STATE_FILE))
+    publish_index(staging, index_path)
+    stats.elapsed = time.perf_counter() - started
+    logger.info(f"Ingest finished: {stats.as_dict()}")
+    return stats
+
+
+def _completed(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest documents into the RAG index")
+    parser.add_argument("paths", nargs="+", help="Files or directories (.jsonl, .txt, .md)")
+    parser.add_argument("--index", default=os.getenv("RAG_INDEX_PATH", "/data/index"))
+    parser.add_argument("--workers", type=int, default=None, help="Embedding processes (default: CPU count, 0 inline)")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--max-tokens", type=int, default=200)
+    parser.add_argument("--overlap", type=int, default=32)
+    parser.add_argument("--append", action="store_true", help="Keep the chunks already in the index, replacing re-ingested documents")
+    parser.add_argument("--checkpoint-seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stats = ingest(
+        args.paths,
+        args.index,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        max_tokens=args.max_tokens,
+        overlap=args.overlap,
+        append=args.append,
+        checkpoint_seconds=args.checkpoint_seconds,
+    )
+    print(json.dumps(stats.as_dict()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+"""
+Updatable hybrid knowledge base
+Combines the immutable memory-mapped vector index (the base) with an
+in-memory delta of chunks added since it was built, and a BM25 index
+over both. Documents are added, replaced or deleted without a rebuild:
+new chunks go to the delta, replaced or deleted ones are tombstoned and
+filtered out of results. Every change is appended to a write-ahead log
+next to the index so it survives restarts.
+
+Compaction, run in the background once tombstones or the delta grow past
+a threshold, streams live chunks into a fresh base and swaps it in while
+searches and updates continue; changes made meanwhile are carried over.
+
+A base is saved with its BM25 postings and the chunk ids of each document,
+so loading maps them instead of parsing and tokenizing every chunk:
+    docs.json        document ids and the offset of each one's chunk ids
+    doc_chunks.bin   int64 chunk ids, grouped by document
+    bm25*            see bm25.py
+
+Vector and BM25 results are fused with reciprocal-rank fusion, which
+needs no score calibration between the two.
+"""
+
+import base64
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+import numpy as np
+from prometheus_client import Counter, Gauge, Histogram
+
+from bm25 import InvertedIndex
+from vector_store import BLOCK_ROWS, CHUNKS_FILE, META_FILE, IndexWriter, VectorIndex, publish_index, top_k_indices
+
+logger = logging.getLogger(__name__)
+
+TOMBSTONES = Gauge('rag_tombstones', 'Deleted chunks still present in the index')
+DELTA_CHUNKS = Gauge('rag_delta_chunks', 'Chunks added since the base index was built')
+DOCUMENT_UPDATES = Counter('rag_document_updates_total', 'Document changes', ['op'])
+COMPACTIONS = Counter('rag_compactions_total', 'Index compactions')
+COMPACTION_DURATION = Histogram(
+    'rag_compaction_seconds', 'Duration of an index compaction',
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900)
+)
+
+# Reciprocal-rank fusion constant; 60 is the usual choice and rarely worth tuning
+RRF_K = 60
+MODES = ("hybrid", "vector", "bm25")
+
+DOCS_FILE = "docs.json"
+DOC_CHUNKS_FILE = "doc_chunks.bin"
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = RRF_K) -> dict[int, float]:
+    """Fused score per chunk id: sum over rankings of 1 / (k + rank)"""
+    fused: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, 1):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return fused
+
+
+def _index(bm25: InvertedIndex, docs: dict[str, list[int]], chunk_id: int, chunk: dict):
+    bm25.add(chunk_id, chunk["text"])
+    doc_id = chunk.get("metadata", {}).get("doc_id")
+    if doc_id is not None:
+        docs.setdefault(str(doc_id), []).append(chunk_id)
+
+
+def read_chunks(directory: str) -> Iterator[dict]:
+    """Every chunk of an index directory, in chunk id order"""
+    with open(os.path.join(directory, CHUNKS_FILE), "rb") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def save_lookup(directory: str, bm25: InvertedIndex, docs: dict[str, list[int]]):
+    """Save BM25 postings and the chunk ids of each document next to an index"""
+    names = list(docs)
+    offsets = np.cumsum([0] + [len(docs[name]) for name in names])
+    chunk_ids = np.fromiter(
+        itertools.chain.from_iterable(docs[name] for name in names), dtype=np.int64, count=int(offsets[-1])
+    )
+    chunk_ids.tofile(os.path.join(directory, DOC_CHUNKS_FILE))
+    with open(os.path.join(directory, DOCS_FILE), "w") as f:
+        json.dump({"docs": names, "offsets": offsets.tolist()}, f, ensure_ascii=False)
+    # Last: open_lookup() looks for the BM25 metadata first
+    bm25.save(directory)
+
+
+def open_lookup(directory: str) -> tuple[InvertedIndex, dict[str, list[int]]]:
+    """Map what save_lookup() wrote; FileNotFoundError if it never ran for this index"""
+    bm25 = InvertedIndex.open(directory)
+    with open(os.path.join(directory, DOCS_FILE)) as f:
+        saved = json.load(f)
+    chunk_ids = np.fromfile(os.path.join(directory, DOC_CHUNKS_FILE), dtype=np.int64)
+    offsets = saved["offsets"]
+    docs = {name: chunk_ids[offsets[i]:offsets[i + 1]].tolist() for i, name in enumerate(saved["docs"])}
+    return bm25, docs
+
+
+def index_base(directory: str):
+    """Tokenize every chunk of a finished index directory and save the lookup tables with it"""
+    bm25, docs = InvertedIndex(), {}
+    for chunk_id, chunk in enumerate(read_chunks(directory)):
+        _index(bm25, docs, chunk_id, chunk)
+    save_lookup(directory, bm25, docs)
+
+
+@dataclass
+class _View:
+    """Consistent state for one search, unaffected by a concurrent compaction swap"""
+    base: Optional[VectorIndex]
+    base_count: int
+    delta_vectors: np.ndarray
+    delta_chunks: list[dict]
+    tombstones: frozenset
+    bm25: InvertedIndex
+
+    def chunk(self, chunk_id: int) -> dict:
+        if chunk_id < self.base_count:
+            return self.base.chunk(chunk_id)
+        return self.delta_chunks[chunk_id - self.base_count]
+
+
+class KnowledgeBase:
+    """Base index + delta + tombstones, searchable by vector, BM25 or both"""
+
+    def __init__(
+        self,
+        path: str,
+        embedder: str,
+        dim: int,
+        nprobe: int = 8,
+        compact_tombstone_ratio: float = 0.1,
+        compact_delta_chunks: int = 20000,
+    ):
+        self.path = path.rstrip("/")
+        self.wal_path = self.path + ".wal"
+        self.embedder = embedder
+        self.dim = dim
+        self.nprobe = nprobe
+        self.compact_tombstone_ratio = compact_tombstone_ratio
+        self.compact_delta_chunks = compact_delta_chunks
+        # Guards the mutable state; the base index itself is immutable
+        self._lock = threading.RLock()
+        # Held by whatever rewrites the base on disk: compaction or a bulk ingest
+        self._compact_lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, base: Optional[VectorIndex]):
+        self.base = base
+        self.base_count = base.count if base else 0
+        # Grown by doubling; rows past len(delta_chunks) are unused
+        self._delta_buffer = np.zeros((0, self.dim), dtype=np.float32)
+        self.delta_chunks: list[dict] = []
+        # Replaced on change, never mutated, so searches can use a snapshot without the lock
+        self.tombstones: frozenset = frozenset()
+        self.docs: dict[str, list[int]] = {}
+        self.bm25 = InvertedIndex()
+
+    @property
+    def delta_vectors(self) -> np.ndarray:
+        return self._delta_buffer[:len(self.delta_chunks)]
+
+    @property
+    def count(self) -> int:
+        """Live chunks"""
+        return self.base_count + len(self.delta_chunks) - len(self.tombstones)
+
+    @property
+    def kind(self) -> str:
+        return self.base.kind if self.base else "exact"
+
+    def _track(self):
+        TOMBSTONES.set(len(self.tombstones))
+        DELTA_CHUNKS.set(len(self.delta_chunks))
+
+    # -------------------------------------------------------------------------
+    # Loading
+    # -------------------------------------------------------------------------
+
+    def load(self):
+        """Map the base index with its BM25 postings and replay the write-ahead log"""
+        base = None
+        if os.path.exists(os.path.join(self.path, META_FILE)):
+            base = VectorIndex(self.path, nprobe=self.nprobe)
+            if base.embedder != self.embedder:
+                logger.error(f"Index was built with {base.embedder}, service embeds with {self.embedder}; not loading it")
+                base.close()
+                base = None
+        else:
+            logger.warning(f"No index at {self.path}; starting empty")
+        lookup = self._open_lookup() if base else None
+        with self._lock:
+            self._reset(base)
+            if lookup:
+                self.bm25, self.docs = lookup
+            replayed = self._replay()
+            self._track()
+        logger.info(
+            f"Loaded {self.kind} index: {self.base_count} base chunks, "
+            f"{len(self.delta_chunks)} from {replayed} logged changes, {len(self.tombstones)} tombstones"
+        )
+
+    def _open_lookup(self) -> tuple[InvertedIndex, dict[str, list[int]]]:
+        try:
+            return open_lookup(self.path)
+        except FileNotFoundError:
+            pass
+        # Built before the lookup tables were saved with the index: index it once
+        logger.warning(f"No BM25 postings saved with {self.path}; indexing its chunks")
+        try:
+            index_base(self.path)
+        except OSError as e:
+            logger.error(f"Cannot save BM25 postings with {self.path}, indexing in memory: {e}")
+            bm25, docs = InvertedIndex(), {}
+            for chunk_id, chunk in enumerate(read_chunks(self.path)):
+                _index(bm25, docs, chunk_id, chunk)
+            return bm25, docs
+        return open_lookup(self.path)
+
+    def _index_chunk(self, chunk_id: int, chunk: dict):
+        _index(self.bm25, self.docs, chunk_id, chunk)
+
+    def _replay(self) -> int:
+        if not os.path.exists(self.wal_path):
+            return 0
+        replayed = 0
+        with open(self.wal_path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("Ignoring truncated write-ahead log record")
+                    break
+                if record["op"] == "put":
+                    vectors = np.frombuffer(base64.b64decode(record["vectors"]), dtype=np.float32)
+                    self._apply_put(record["doc_id"], record["chunks"], vectors.reshape(-1, self.dim))
+                else:
+                    self._apply_delete(record["doc_id"])
+                replayed += 1
+        return replayed
+
+    # -------------------------------------------------------------------------
+    # Updates
+    # -------------------------------------------------------------------------
+
+    def _log(self, record: dict):
+        with open(self.wal_path, "ab") as f:
+            f.write(json.dumps(record).encode("utf-8") + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _apply_delete(self, doc_id: str) -> int:
+        removed = self.docs.pop(doc_id, [])
+        if removed:
+            self.tombstones = self.tombstones | frozenset(removed)
+        return len(removed)
+
+    def _apply_put(self, doc_id: str, chunks: list[dict], vectors: np.ndarray):
+        self._apply_delete(doc_id)
+        first = self.base_count + len(self.delta_chunks)
+        self._append_vectors(vectors)
+        for offset, chunk in enumerate(chunks):
+            chunk = {"text": chunk["text"], "metadata": {**chunk.get("metadata", {}), "doc_id": doc_id}}
+            self.delta_chunks.append(chunk)
+            self._index_chunk(first + offset, chunk)
+
+    def _append_vectors(self, vectors: np.ndarray):
+        used = len(self.delta_chunks)
+        needed = used + len(vectors)
+        if needed > len(self._delta_buffer):
+            # A new buffer, not a resize: searches may still hold a view of the old one
+            grown = np.zeros((max(needed, 2 * len(self._delta_buffer), 1024), self.dim), dtype=np.float32)
+            grown[:used] = self._delta_buffer[:used]
+            self._delta_buffer = grown
+        self._delta_buffer[used:needed] = vectors
+
+    def put_document(self, doc_id: str, chunks: list[dict], vectors: np.ndarray):
+        """
+        Add a document or replace all of its chunks.
+
+        Args:
+            doc_id: Document identifier, stored in each chunk's metadata
+            chunks: {"text": ..., "metadata": {...}} per chunk
+            vectors: (len(chunks), dim) passage embeddings
+        """
+        if len(chunks) != len(vectors):
+            raise ValueError(f"Got {len(vectors)} vectors for {len(chunks)} chunks")
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            replaced = doc_id in self.docs
+            self._log({
+                "op": "put",
+                "doc_id": doc_id,
+                "chunks": chunks,
+                "vectors": base64.b64encode(vectors.tobytes()).decode("ascii"),
+            })
+            self._apply_put(doc_id, chunks, vectors)
+            self._track()
+        DOCUMENT_UPDATES.labels(op="update" if replaced else "add").inc()
+
+    def delete_document(self, doc_id: str) -> bool:
+        """Tombstone every chunk of a document; False if it does not exist"""
+        with self._lock:
+            if doc_id not in self.docs:
+                return False
+            self._log({"op": "delete", "doc_id": doc_id})
+            self._apply_delete(doc_id)
+            self._track()
+        DOCUMENT_UPDATES.labels(op="delete").inc()
+        return True
+
+    # -------------------------------------------------------------------------
+    # Search
+    # -------------------------------------------------------------------------
+
+    def _view(self) -> _View:
+        with self._lock:
+            return _View(
+                self.base, self.base_count, self.delta_vectors, self.delta_chunks, self.tombstones, self.bm25
+            )
+
+    def _search_vector(self, view: _View, query: np.ndarray, k: int, nprobe: Optional[int]) -> list[tuple[int, float]]:
+        """Top-k live chunks by cosine similarity, over base and delta"""
+        hits = []
+        if view.base and view.base_count:
+            # Over-fetch so tombstoned rows cannot crowd live ones out of the top k
+            hits = view.base.search(query, k=k + min(len(view.tombstones), view.base_count), nprobe=nprobe)
+        if len(view.delta_vectors):
+            scores = view.delta_vectors @ query
+            top = top_k_indices(scores, k + len(view.tombstones))
+            hits += [(view.base_count + int(i), float(scores[i])) for i in top]
+        hits = [hit for hit in hits if hit[0] not in view.tombstones]
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:k]
+
+    def _search_bm25(self, view: _View, query: str, k: int) -> list[tuple[int, float]]:
+        # Postings grow in place on updates, so scoring holds the lock
+        with self._lock:
+            return view.bm25.search(query, k, exclude=view.tombstones)
+
+    def search(
+        self,
+        query: str,
+        query_vector: Optional[np.ndarray],
+        k: int,
+        mode: str = "hybrid",
+        nprobe: Optional[int] = None,
+        min_score: float = 0.0,
+        candidates: int = 20,
+    ) -> tuple[list[dict], dict[str, float]]:
+        """
+        Search by vector similarity, BM25 or both fused.
+
+        Args:
+            query: Query text, for BM25
+            query_vector: Query embedding, for vector search (unused in bm25 mode)
+            k: Results to return
+            mode: "hybrid", "vector" or "bm25"
+            nprobe: IVF clusters to scan
+            min_score: Vector hits below this cosine similarity are dropped
+                before fusion; BM25 hits always share a term with the query
+            candidates: Hits taken from each index before fusion
+
+        Returns:
+            Hits best first as {"id", "text", "metadata", "score",
+            "vector_score", "bm25_score"}, where score is the fused score in
+            hybrid mode, and the time spent per index and in fusion, in seconds
+        """
+        view = self._view()
+        timings: dict[str, float] = {}
+        vector_hits: list[tuple[int, float]] = []
+        bm25_hits: list[tuple[int, float]] = []
+        depth = max(candidates, k) if mode == "hybrid" else k
+
+        if mode in ("hybrid", "vector"):
+            start = time.perf_counter()
+            vector_hits = [hit for hit in self._search_vector(view, query_vector, depth, nprobe) if hit[1] >= min_score]
+            timings["vector"] = time.perf_counter() - start
+        if mode in ("hybrid", "bm25"):
+            start = time.perf_counter()
+            bm25_hits = self._search_bm25(view, query, depth)
+            timings["bm25"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        vector_scores, bm25_scores = dict(vector_hits), dict(bm25_hits)
+        if mode == "hybrid":
+            fused = reciprocal_rank_fusion([[i for i, _ in vector_hits], [i for i, _ in bm25_hits]])
+            ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+        else:
+            ranked = vector_hits or bm25_hits
+        results = []
+        for chunk_id, score in ranked:
+            chunk = view.chunk(chunk_id)
+            results.append({
+                "id": chunk_id,
+                "text": chunk["text"],
+                "metadata": chunk.get("metadata", {}),
+                "score": score,
+                "vector_score": vector_scores.get(chunk_id),
+                "bm25_score": bm25_scores.get(chunk_id),
+            })
+        timings["fusion"] = time.perf_counter() - start
+        return results, timings
+
+    # -------------------------------------------------------------------------
+    # Compaction
+    # -------------------------------------------------------------------------
+
+    @contextmanager
+    def exclusive(self) -> Iterator[None]:
+        """Keep compaction away while the base index is rewritten by someone else"""
+        with self._compact_lock:
+            yield
+
+    @property
+    def busy(self) -> bool:
+        return self._compact_lock.locked()
+
+    def needs_compaction(self) -> bool:
+        total = self.base_count + len(self.delta_chunks)
+        if not total:
+            return False
+        return (
+            len(self.tombstones) / total > self.compact_tombstone_ratio
+            or len(self.delta_chunks) > self.compact_delta_chunks
+        )
+
+    def _write_base(self, base: Optional[VectorIndex], base_count: int, delta_vectors: np.ndarray,
+                    delta_chunks: list[dict], live: np.ndarray):
+        """Stream the live chunks into a new base at self.path, BLOCK_ROWS at a time"""
+        building = self.path + ".building"
+        shutil.rmtree(building, ignore_errors=True)
+        writer = IndexWriter(building, self.dim, self.embedder)
+        bm25, docs = InvertedIndex(), {}
+        for start in range(0, len(live), BLOCK_ROWS):
+            ids = live[start:start + BLOCK_ROWS]
+            # live is sorted, so the base rows of a block come before its delta rows
+            in_base, in_delta = ids[ids < base_count], ids[ids >= base_count] - base_count
+            vectors = delta_vectors[in_delta]
+            if len(in_base):
+                vectors = np.concatenate([base.vectors_for(in_base), vectors])
+            chunks = [base.chunk(int(i)) for i in in_base] + [delta_chunks[i] for i in in_delta]
+            for offset, chunk in enumerate(chunks):
+                _index(bm25, docs, start + offset, chunk)
+            writer.add(vectors, chunks)
+        writer.finish()
+        save_lookup(building, bm25, docs)
+        publish_index(building, self.path)
+
+    def compact(self):
+        """
+        Rewrite the base with every live chunk and drop tombstones.
+
+        Blocking; run it in a worker thread. Searches and updates proceed
+        meanwhile: the new base covers the state at the start, and later
+        changes are re-applied on top of it before it is swapped in.
+        """
+        with self._compact_lock:
+            start = time.perf_counter()
+            with self._lock:
+                base, base_count = self.base, self.base_count
+                delta_count = len(self.delta_chunks)
+                delta_vectors = self.delta_vectors
+                delta_chunks = list(self.delta_chunks)
+                tombstones = self.tombstones
+                wal_offset = os.path.getsize(self.wal_path) if os.path.exists(self.wal_path) else 0
+
+            total = base_count + delta_count
+            alive = np.ones(total, dtype=bool)
+            if tombstones:
+                alive[np.fromiter(tombstones, dtype=np.int64, count=len(tombstones))] = False
+            live = np.flatnonzero(alive)
+            self._write_base(base, base_count, delta_vectors, delta_chunks, live)
+            new_base = VectorIndex(self.path, nprobe=self.nprobe)
+            bm25, docs = open_lookup(self.path)
+
+            with self._lock:
+                # Changes made while the new base was written
+                tail_chunks = self.delta_chunks[delta_count:]
+                tail_vectors = self.delta_vectors[delta_count:].copy()
+                later_tombstones = self.tombstones - tombstones
+                old_to_new = np.full(total, -1, dtype=np.int64)
+                old_to_new[live] = np.arange(len(live))
+
+                self._reset(new_base)
+                self.bm25, self.docs = bm25, docs
+                self._delta_buffer = tail_vectors
+                for offset, chunk in enumerate(tail_chunks):
+                    self.delta_chunks.append(chunk)
+                    self._index_chunk(new_base.count + offset, chunk)
+                self.tombstones = frozenset(
+                    int(old_to_new[t]) if t < total else new_base.count + t - total for t in later_tombstones
+                )
+                self.docs = {
+                    doc_id: [i for i in ids if i not in self.tombstones]
+                    for doc_id, ids in self.docs.items()
+                }
+                self.docs = {doc_id: ids for doc_id, ids in self.docs.items() if ids}
+                self._truncate_wal(wal_offset)
+                self._track()
+
+            elapsed = time.perf_counter() - start
+            COMPACTIONS.inc()
+            COMPACTION_DURATION.observe(elapsed)
+            logger.info(
+                f"Compacted index: {len(live)} live of {total} chunks in {elapsed:.1f}s, "
+                f"{len(tail_chunks)} chunks added meanwhile"
+            )
+
+    def _truncate_wal(self, offset: int):
+        """Drop log records already folded into the base"""
+        if not os.path.exists(self.wal_path):
+            return
+        with open(self.wal_path, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        replacement = self.wal_path + ".tmp"
+        with open(replacement, "wb") as f:
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(replacement, self.wal_path)
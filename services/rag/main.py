@@ -0,0 +1,334 @@
+"""
+RAG Service - in-process hybrid retrieval
+Serves top-k passage search (vector, BM25 or fused) over a memory-mapped
+embedding index, with per-document updates and bulk corpus ingestion
+"""
+
+import asyncio
+import logging
+import os
+import secrets
+import time
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Response
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from pydantic import BaseModel, Field
+
+from batcher import EmbeddingBatcher
+from embeddings import create_embedder
+from ingest import IngestStats, ingest
+from knowledge_base import KnowledgeBase
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RAG_INDEX_PATH = os.getenv("RAG_INDEX_PATH", "/data/index")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "4"))
+RAG_NPROBE = int(os.getenv("RAG_NPROBE", "8"))
+RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "hybrid")
+# Hits taken from each index before reciprocal-rank fusion
+RAG_FUSION_CANDIDATES = int(os.getenv("RAG_FUSION_CANDIDATES", "20"))
+RAG_COMPACT_INTERVAL = float(os.getenv("RAG_COMPACT_INTERVAL", "30"))
+RAG_COMPACT_TOMBSTONE_RATIO = float(os.getenv("RAG_COMPACT_TOMBSTONE_RATIO", "0.1"))
+RAG_COMPACT_DELTA_CHUNKS = int(os.getenv("RAG_COMPACT_DELTA_CHUNKS", "20000"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "32"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "2"))
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+# Embedding processes for POST /ingest; searches keep the cores this leaves
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+# /ingest and /admin endpoints rewrite the index; they are refused until a token is set
+RAG_ADMIN_TOKEN = os.getenv("RAG_ADMIN_TOKEN", "")
+# POST /ingest may only read files from here; relative paths are taken from it
+CORPUS_DIR = os.path.realpath(os.getenv("CORPUS_DIR", "/data/corpus"))
+
+# stage: embed, vector, bm25, fusion, and total for the whole search
+SEARCH_DURATION = Histogram(
+    'rag_search_duration_seconds', 'Time per search stage', ['stage'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+)
+SEARCHES = Counter('rag_searches_total', 'Searches served', ['mode'])
+INDEX_CHUNKS = Gauge('rag_index_chunks', 'Live chunks in the knowledge base')
+
+# Global variables
+embedder = None
+batcher: Optional[EmbeddingBatcher] = None
+knowledge_base: Optional[KnowledgeBase] = None
+ingest_status: dict = {"state": "idle"}
+ingest_task: Optional[asyncio.Task] = None
+
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    """Bearer RAG_ADMIN_TOKEN, checked in constant time"""
+    if not RAG_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set RAG_ADMIN_TOKEN")
+    if not secrets.compare_digest((authorization or "").encode(), f"Bearer {RAG_ADMIN_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
+
+
+def in_corpus_dir(path: str) -> Optional[str]:
+    """The resolved path if it is inside CORPUS_DIR, else None"""
+    real = os.path.realpath(os.path.join(CORPUS_DIR, path))
+    return real if os.path.commonpath([real, CORPUS_DIR]) == CORPUS_DIR else None
+
+
+async def compact_periodically():
+    """Fold the delta and tombstones into a new base whenever they grow past the thresholds"""
+    while True:
+        await asyncio.sleep(RAG_COMPACT_INTERVAL)
+        if knowledge_base.needs_compaction() and not knowledge_base.busy:
+            try:
+                await asyncio.to_thread(knowledge_base.compact)
+            except Exception as e:
+                logger.error(f"Compaction failed: {e!r}")
+            INDEX_CHUNKS.set(knowledge_base.count)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the embedder, start the embedding batcher, load the index and start compaction"""
+    global embedder, batcher, knowledge_base
+    embedder = create_embedder()
+    logger.info(f"Embedder: {embedder.name} ({embedder.dim} dims)")
+    batcher = EmbeddingBatcher(
+        embedder, max_batch_size=EMBED_MAX_BATCH, max_wait_ms=EMBED_MAX_WAIT_MS, cache_size=EMBED_CACHE_SIZE
+    )
+    batcher.start()
+    knowledge_base = KnowledgeBase(
+        RAG_INDEX_PATH,
+        embedder=embedder.name,
+        dim=embedder.dim,
+        nprobe=RAG_NPROBE,
+        compact_tombstone_ratio=RAG_COMPACT_TOMBSTONE_RATIO,
+        compact_delta_chunks=RAG_COMPACT_DELTA_CHUNKS,
+    )
+    await asyncio.to_thread(knowledge_base.load)
+    INDEX_CHUNKS.set(knowledge_base.count)
+    compactor = asyncio.create_task(compact_periodically())
+    yield
+    compactor.cancel()
+    await batcher.stop()
+
+
+app = FastAPI(title="RAG Service", version="1.0.0", lifespan=lifespan)
+
+
+class SearchRequest(BaseModel):
+    query: str
+    top_k: int = Field(default=RAG_TOP_K, ge=1, le=100)
+    mode: Literal["hybrid", "vector", "bm25"] = RAG_SEARCH_MODE
+    nprobe: Optional[int] = Field(default=None, ge=1)
+    # Minimum cosine similarity for vector hits
+    min_score: float = 0.0
+
+
+class Passage(BaseModel):
+    id: int
+    text: str
+    # Fused RRF score in hybrid mode, otherwise the single index's score
+    score: float
+    vector_score: Optional[float] = None
+    bm25_score: Optional[float] = None
+    metadata: dict = {}
+
+
+class SearchResponse(BaseModel):
+    results: list[Passage]
+    took_ms: float
+    timings_ms: dict[str, float] = {}
+
+
+class ChunkIn(BaseModel):
+    text: str = Field(min_length=1)
+    metadata: dict = {}
+
+
+class DocumentRequest(BaseModel):
+    chunks: list[ChunkIn] = Field(min_length=1)
+
+
+class IngestRequest(BaseModel):
+    # Files or directories inside CORPUS_DIR
+    paths: list[str] = Field(min_length=1)
+    append: bool = True
+    workers: Optional[int] = Field(default=None, ge=0)
+
+
+class EmbedRequest(BaseModel):
+    texts: list[str] = Field(min_length=1, max_length=256)
+    kind: Literal["query", "passage"] = "query"
+
+
+class EmbedResponse(BaseModel):
+    embeddings: list[list[float]]
+    model: str
+    dim: int
+
+
+def run_search(query_vector, request: SearchRequest) -> tuple[list[Passage], dict[str, float]]:
+    """Search the knowledge base; CPU-bound, runs in a worker thread"""
+    hits, timings = knowledge_base.search(
+        request.query,
+        query_vector,
+        k=request.top_k,
+        mode=request.mode,
+        nprobe=request.nprobe,
+        min_score=request.min_score,
+        candidates=RAG_FUSION_CANDIDATES,
+    )
+    return [Passage(**hit) for hit in hits], timings
+
+
+@app.post("/search", response_model=SearchResponse)
+async def search(request: SearchRequest):
+    """Top-k passages for a query, best first"""
+    start = time.perf_counter()
+    results, timings = [], {}
+    if knowledge_base.count:
+        query_vector = None
+        if request.mode != "bm25":
+            # Concurrent searches share embedding forward passes
+            embed_start = time.perf_counter()
+            query_vector = (await batcher.embed([request.query], kind="query"))[0]
+            timings["embed"] = time.perf_counter() - embed_start
+        # NumPy releases the GIL in the matrix product, so searches overlap across threads
+        results, search_timings = await asyncio.to_thread(run_search, query_vector, request)
+        timings.update(search_timings)
+    elapsed = time.perf_counter() - start
+    timings["total"] = elapsed
+    for stage, seconds in timings.items():
+        SEARCH_DURATION.labels(stage=stage).observe(seconds)
+    SEARCHES.labels(mode=request.mode).inc()
+    return SearchResponse(
+        results=results,
+        took_ms=round(elapsed * 1000, 2),
+        timings_ms={stage: round(seconds * 1000, 3) for stage, seconds in timings.items()},
+    )
+
+
+@app.post("/embed", response_model=EmbedResponse)
+async def embed(request: EmbedRequest):
+    """Embed texts with the service model; concurrent calls are micro-batched"""
+    vectors = await batcher.embed(request.texts, kind=request.kind)
+    return EmbedResponse(embeddings=vectors.tolist(), model=embedder.name, dim=embedder.dim)
+
+
+@app.put("/documents/{doc_id}")
+async def put_document(doc_id: str, request: DocumentRequest):
+    """Add a document or replace all of its chunks; searchable as soon as this returns"""
+    chunks = [chunk.model_dump() for chunk in request.chunks]
+    vectors = await batcher.embed([chunk["text"] for chunk in chunks], kind="passage")
+    await asyncio.to_thread(knowledge_base.put_document, doc_id, chunks, vectors)
+    INDEX_CHUNKS.set(knowledge_base.count)
+    return {"doc_id": doc_id, "chunks": len(chunks)}
+
+
+@app.delete("/documents/{doc_id}")
+async def delete_document(doc_id: str):
+    """Remove a document from search results; space is reclaimed at the next compaction"""
+    deleted = await asyncio.to_thread(knowledge_base.delete_document, doc_id)
+    if not deleted:
+        raise HTTPException(status_code=404, detail=f"Unknown document {doc_id}")
+    INDEX_CHUNKS.set(knowledge_base.count)
+    return {"doc_id": doc_id, "deleted": True}
+
+
+def run_ingest(request: IngestRequest):
+    """Build the new base with compaction held off, then switch to it; runs in a worker thread"""
+
+    def progress(stats: IngestStats):
+        ingest_status["progress"] = stats.as_dict()
+
+    with knowledge_base.exclusive():
+        stats = ingest(
+            request.paths,
+            RAG_INDEX_PATH,
+            workers=INGEST_WORKERS if request.workers is None else request.workers,
+            append=request.append,
+            progress=progress,
+        )
+        # Updates made meanwhile are in the WAL and are replayed onto the new base
+        knowledge_base.load()
+    return stats
+
+
+async def ingest_in_background(request: IngestRequest):
+    ingest_status.clear()
+    ingest_status.update(state="running", paths=request.paths, started_at=time.time())
+    try:
+        stats = await asyncio.to_thread(run_ingest, request)
+        ingest_status.update(state="done", progress=stats.as_dict())
+    except Exception as e:
+        logger.error(f"Ingest failed: {e!r}")
+        ingest_status.update(state="failed", error=repr(e))
+    ingest_status["finished_at"] = time.time()
+    INDEX_CHUNKS.set(knowledge_base.count)
+
+
+@app.post("/ingest", status_code=202, dependencies=[Depends(require_admin)])
+async def start_ingest(request: IngestRequest):
+    """Ingest a corpus in the background; an interrupted ingest resumes when started again with the same paths"""
+    global ingest_task
+    if ingest_task and not ingest_task.done():
+        raise HTTPException(status_code=409, detail="An ingest is already running")
+    paths = [in_corpus_dir(path) for path in request.paths]
+    if None in paths:
+        raise HTTPException(status_code=400, detail=f"paths must be inside {CORPUS_DIR}")
+    request = request.model_copy(update={"paths": paths})
+    ingest_task = asyncio.create_task(ingest_in_background(request))
+    return {"state": "running", "paths": request.paths}
+
+
+@app.get("/ingest")
+async def get_ingest():
+    """State and progress of the latest ingest"""
+    return ingest_status
+
+
+@app.post("/admin/compact", dependencies=[Depends(require_admin)])
+async def compact_index():
+    """Compact now instead of waiting for the thresholds"""
+    if knowledge_base.busy:
+        raise HTTPException(status_code=409, detail="Compaction or ingest already running")
+    await asyncio.to_thread(knowledge_base.compact)
+    INDEX_CHUNKS.set(knowledge_base.count)
+    return {"chunks": knowledge_base.count, "index": knowledge_base.kind}
+
+
+@app.post("/admin/reload", dependencies=[Depends(require_admin)])
+async def reload_index():
+    """Re-open the index after it has been rebuilt on disk"""
+    await asyncio.to_thread(knowledge_base.load)
+    INDEX_CHUNKS.set(knowledge_base.count)
+    return {"chunks": knowledge_base.count, "index": knowledge_base.kind}
+
+
+@app.get("/healthz")
+async def health_check():
+    """Health check endpoint; an empty index is healthy, searches just return nothing"""
+    return {
+        "status": "ok",
+        "embedder": embedder.name if embedder else None,
+        "index": knowledge_base.kind if knowledge_base else None,
+        "chunks": knowledge_base.count if knowledge_base else 0,
+        "delta_chunks": len(knowledge_base.delta_chunks) if knowledge_base else 0,
+        "tombstones": len(knowledge_base.tombstones) if knowledge_base else 0,
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics endpoint"""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8004,
+        log_level="info"
+    )
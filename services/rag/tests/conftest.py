@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Service modules import each other flat, as they do in the container
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,129 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from batcher import EmbeddingBatcher
+from embeddings import HashingEmbedder
+
+
+class RecordingEmbedder(HashingEmbedder):
+    """Deterministic stand-in model that records every forward pass"""
+
+    def __init__(self, forward_ms: float = 0.0):
+        super().__init__()
+        self.forward = forward_ms / 1000
+        self.calls: list[tuple[str, list[str]]] = []
+
+    def embed_queries(self, texts):
+        self.calls.append(("query", list(texts)))
+        time.sleep(self.forward)
+        return super().embed_queries(texts)
+
+    def embed_passages(self, texts):
+        self.calls.append(("passage", list(texts)))
+        time.sleep(self.forward)
+        return super().embed_passages(texts)
+
+
+def run(scenario, embedder, **kwargs):
+    async def main():
+        batcher = EmbeddingBatcher(embedder, **kwargs)
+        batcher.start()
+        try:
+            return await scenario(batcher)
+        finally:
+            await batcher.stop()
+    return asyncio.run(main())
+
+
+def test_batches_never_exceed_max_batch_size():
+    embedder = RecordingEmbedder(forward_ms=5)
+    texts = [f"question {i}" for i in range(10)]
+
+    async def scenario(batcher):
+        return await asyncio.gather(*(batcher.embed([text]) for text in texts))
+
+    results = run(scenario, embedder, max_batch_size=4, max_wait_ms=50)
+    sizes = [len(call[1]) for call in embedder.calls]
+    assert max(sizes) <= 4
+    assert sum(sizes) == 10
+    assert len(sizes) == 3
+    reference = HashingEmbedder().embed_queries(texts)
+    np.testing.assert_allclose(np.vstack(results), reference, rtol=1e-6)
+
+
+def test_lone_request_does_not_wait_for_max_wait():
+    embedder = RecordingEmbedder()
+
+    async def scenario(batcher):
+        started = time.perf_counter()
+        await batcher.embed(["only one"])
+        return time.perf_counter() - started
+
+    elapsed = run(scenario, embedder, max_wait_ms=500)
+    assert elapsed < 0.25
+    assert [len(texts) for _, texts in embedder.calls] == [1]
+
+
+def test_open_batch_flushes_at_max_wait():
+    embedder = RecordingEmbedder()
+
+    async def scenario(batcher):
+        started = time.perf_counter()
+        await asyncio.gather(batcher.embed(["a"]), batcher.embed(["b"]))
+        return time.perf_counter() - started
+
+    elapsed = run(scenario, embedder, max_batch_size=8, max_wait_ms=100)
+    # Two texts arrived together: the batch stays open for more, but no longer than max wait
+    assert 0.08 <= elapsed < 0.5
+    assert [len(texts) for _, texts in embedder.calls] == [2]
+
+
+def test_rows_scattered_back_in_caller_order_across_kinds():
+    embedder = RecordingEmbedder()
+    reference = HashingEmbedder()
+
+    async def scenario(batcher):
+        return await asyncio.gather(
+            batcher.embed(["q1", "q2", "q3"], kind="query"),
+            batcher.embed(["p1", "p2"], kind="passage"),
+            batcher.embed(["q3", "q1"], kind="query"),
+        )
+
+    queries, passages, repeated = run(scenario, embedder, max_batch_size=16, max_wait_ms=20)
+    np.testing.assert_allclose(queries, reference.embed_queries(["q1", "q2", "q3"]), rtol=1e-6)
+    np.testing.assert_allclose(passages, reference.embed_passages(["p1", "p2"]), rtol=1e-6)
+    np.testing.assert_allclose(repeated, reference.embed_queries(["q3", "q1"]), rtol=1e-6)
+    # Texts already waiting are shared rather than embedded twice
+    embedded = [text for _, texts in embedder.calls for text in texts]
+    assert sorted(embedded) == ["p1", "p2", "q1", "q2", "q3"]
+
+
+def test_query_cache_is_lru_and_skips_passages():
+    embedder = RecordingEmbedder()
+
+    async def scenario(batcher):
+        for text in ["a", "b", "a", "c"]:
+            await batcher.embed([text])
+        before = len(embedder.calls)
+        await batcher.embed(["a"])  # recently used: cached
+        await batcher.embed(["c"])
+        assert len(embedder.calls) == before
+        await batcher.embed(["b"])  # least recently used: evicted by c
+        assert len(embedder.calls) == before + 1
+        await batcher.embed(["doc"], kind="passage")
+        await batcher.embed(["doc"], kind="passage")
+        assert embedder.calls[-2:] == [("passage", ["doc"]), ("passage", ["doc"])]
+
+    run(scenario, embedder, cache_size=2)
+    assert [texts for _, texts in embedder.calls[:3]] == [["a"], ["b"], ["c"]]
+
+
+def test_unknown_kind_rejected():
+    async def scenario(batcher):
+        with pytest.raises(ValueError):
+            await batcher.embed(["x"], kind="document")
+
+    run(scenario, RecordingEmbedder())
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import ingest as ingest_module
+from ingest import ingest
+from vector_store import VectorIndex
+
+
+class Interrupted(Exception):
+    pass
+
+
+def write_corpus(path, docs: list[tuple[str, str]]):
+    with open(path, "w") as f:
+        for doc_id, text in docs:
+            f.write(json.dumps({"id": doc_id, "text": text}) + "\n")
+    return str(path)
+
+
+def corpus(count: int) -> list[tuple[str, str]]:
+    return [(f"doc-{i}", f"Document {i} is about topic {i * 7}. It has one more sentence.") for i in range(count)]
+
+
+def index_chunks(index_path) -> list[tuple[str, str]]:
+    index = VectorIndex(str(index_path))
+    try:
+        return [(index.chunk(i)["metadata"]["doc_id"], index.chunk(i)["text"]) for i in range(index.count)]
+    finally:
+        index.close()
+
+
+def run(paths, index_path, **options):
+    return ingest(paths, str(index_path), workers=0, batch_size=4, backend="hashing", **options)
+
+
+def test_interrupted_ingest_resumes_from_its_checkpoint(tmp_path):
+    source = write_corpus(tmp_path / "docs.jsonl", corpus(40))
+    expected = run([source], tmp_path / "reference")
+    saves = 0
+
+    def interrupt(stats):
+        nonlocal saves
+        saves += 1
+        if saves == 3:
+            raise Interrupted
+
+    with pytest.raises(Interrupted):
+        run([source], tmp_path / "index", checkpoint_seconds=0, progress=interrupt)
+    resumed = run([source], tmp_path / "index")
+    assert 0 < resumed.run_docs < 40
+    assert (resumed.docs, resumed.chunks) == (expected.docs, expected.chunks)
+    assert index_chunks(tmp_path / "index") == index_chunks(tmp_path / "reference")
+    assert not (tmp_path / "index.ingest").exists()
+
+
+def test_duplicate_chunks_are_written_once(tmp_path):
+    docs = corpus(5) + [("copy", "  document 0 IS about topic 0.   It has one more sentence. ")]
+    stats = run([write_corpus(tmp_path / "docs.jsonl", docs)], tmp_path / "index")
+    assert (stats.docs, stats.chunks, stats.duplicates) == (6, 5, 1)
+    assert [doc_id for doc_id, _ in index_chunks(tmp_path / "index")] == [f"doc-{i}" for i in range(5)]
+
+
+def test_append_replaces_reingested_documents(tmp_path):
+    run([write_corpus(tmp_path / "first.jsonl", corpus(3))], tmp_path / "index")
+    update = write_corpus(tmp_path / "update.jsonl", [("doc-1", "Document 1 was rewritten."), ("doc-9", "A new one.")])
+    stats = run([update], tmp_path / "index", append=True)
+    chunks = index_chunks(tmp_path / "index")
+    assert [doc_id for doc_id, _ in chunks] == ["doc-0", "doc-2", "doc-1", "doc-9"]
+    assert ("doc-1", "Document 1 was rewritten.") in chunks
+    assert stats.chunks == 4
+
+
+def test_reading_stays_a_bounded_distance_ahead_of_writing(tmp_path, monkeypatch):
+    source = write_corpus(tmp_path / "docs.jsonl", corpus(100))
+    read = 0
+    ahead = []
+    real_read_documents = ingest_module.read_documents
+
+    def read_documents(files, start=(0, 0)):
+        nonlocal read
+        for doc in real_read_documents(files, start):
+            read += 1
+            yield doc
+
+    monkeypatch.setattr(ingest_module, "read_documents", read_documents)
+    run([source], tmp_path / "index", checkpoint_seconds=0, progress=lambda stats: ahead.append(read - stats.docs))
+    # At most the in-flight batches and the one being filled, whatever the corpus size
+    assert max(ahead) <= 3 * 4
+    assert read == 100
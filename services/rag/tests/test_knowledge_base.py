@@ -0,0 +1,121 @@
+import os
+
+import numpy as np
+import pytest
+
+import knowledge_base
+from bm25 import BM25_META_FILE, InvertedIndex
+from embeddings import HashingEmbedder
+from knowledge_base import KnowledgeBase
+from vector_store import VectorIndex, write_index
+
+EMBEDDER = HashingEmbedder(dim=64)
+TEXTS = [
+    "Refunds are issued within 30 days of purchase.",
+    "Error ERR-4021 means the payment card was declined.",
+    "Upgrade to v2.3.1 to fix the login loop.",
+    "Orders ship within two business days.",
+    "Contact support to change the delivery address.",
+    "ERR-5000 is returned when the service is overloaded.",
+    "Gift cards cannot be refunded.",
+]
+QUERIES = ["refund", "ERR-4021", "4021", "v2.3.1", "ship orders", "delivery address", "err"]
+
+
+def put(kb: KnowledgeBase, doc_id: str, texts: list[str]):
+    chunks = [{"text": text, "metadata": {"chunk": i}} for i, text in enumerate(texts)]
+    kb.put_document(doc_id, chunks, EMBEDDER.embed_passages(texts))
+
+
+def bm25(kb: KnowledgeBase, query: str) -> list[tuple[str, float]]:
+    hits, _ = kb.search(query, None, k=20, mode="bm25")
+    return sorted((hit["text"], round(hit["score"], 4)) for hit in hits)
+
+
+def vector(kb: KnowledgeBase, query: str) -> list[tuple[str, float]]:
+    hits, _ = kb.search(query, EMBEDDER.embed_queries([query])[0], k=20, mode="vector")
+    return sorted((hit["text"], round(hit["score"], 4)) for hit in hits)
+
+
+def results(kb: KnowledgeBase) -> dict[str, tuple]:
+    return {query: (bm25(kb, query), vector(kb, query)) for query in QUERIES}
+
+
+@pytest.fixture
+def kb(tmp_path):
+    kb = KnowledgeBase(str(tmp_path / "index"), EMBEDDER.name, EMBEDDER.dim)
+    kb.load()
+    for i, text in enumerate(TEXTS):
+        put(kb, f"doc-{i}", [text, f"{text} See also document {i}."])
+    return kb
+
+
+def test_saved_postings_score_like_in_memory_ones(tmp_path):
+    memory = InvertedIndex()
+    for chunk_id, text in enumerate(TEXTS[:4]):
+        memory.add(chunk_id, text)
+    memory.save(str(tmp_path))
+    saved = InvertedIndex.open(str(tmp_path))
+    # Appended chunks extend the mapped postings of the same terms
+    for chunk_id, text in enumerate(TEXTS[4:], 4):
+        memory.add(chunk_id, text)
+        saved.add(chunk_id, text)
+    for query in QUERIES:
+        assert saved.search(query, 10) == memory.search(query, 10)
+
+
+def test_compaction_streams_live_chunks_in_blocks(kb, tmp_path, monkeypatch):
+    # Several blocks, each mixing base and delta rows after the first compaction
+    monkeypatch.setattr(knowledge_base, "BLOCK_ROWS", 3)
+    kb.compact()
+    kb.delete_document("doc-1")
+    put(kb, "doc-2", ["Upgrade to v2.4.0 instead."])
+    put(kb, "doc-new", ["Refunds for gift cards go to store credit."])
+    kb.compact()
+    assert not kb.tombstones and not kb.delta_chunks
+
+    # Same live documents, never compacted
+    fresh = KnowledgeBase(str(tmp_path / "fresh"), EMBEDDER.name, EMBEDDER.dim)
+    for i, text in enumerate(TEXTS):
+        if i not in (1, 2):
+            put(fresh, f"doc-{i}", [text, f"{text} See also document {i}."])
+    put(fresh, "doc-2", ["Upgrade to v2.4.0 instead."])
+    put(fresh, "doc-new", ["Refunds for gift cards go to store credit."])
+    assert results(kb) == results(fresh)
+    assert sorted(kb.docs) == sorted(fresh.docs)
+    texts = [kb.base.chunk(i)["text"] for i in range(kb.base.count)]
+    assert len(texts) == fresh.count
+    assert np.allclose(kb.base.vectors_for(np.arange(kb.base.count)), EMBEDDER.embed_passages(texts), atol=1e-6)
+
+
+def test_load_maps_saved_postings_without_reading_chunks(kb, monkeypatch):
+    kb.compact()
+    put(kb, "doc-late", ["Late changes are replayed from the log: ERR-4021."])
+    kb.delete_document("doc-3")
+    expected = results(kb)
+
+    def unexpected(*args):
+        raise AssertionError("load parsed the chunks of the base")
+
+    monkeypatch.setattr(VectorIndex, "chunk", unexpected)
+    monkeypatch.setattr(knowledge_base, "read_chunks", unexpected)
+    reloaded = KnowledgeBase(kb.path, EMBEDDER.name, EMBEDDER.dim)
+    reloaded.load()
+    monkeypatch.undo()
+    assert results(reloaded) == expected
+    assert reloaded.docs == kb.docs
+    assert reloaded.delete_document("doc-0")
+
+
+def test_index_without_saved_postings_is_indexed_once(tmp_path):
+    path = str(tmp_path / "index")
+    chunks = [{"text": text, "metadata": {"doc_id": f"doc-{i}"}} for i, text in enumerate(TEXTS)]
+    write_index(path, EMBEDDER.embed_passages(TEXTS), chunks, embedder=EMBEDDER.name)
+    assert not os.path.exists(os.path.join(path, BM25_META_FILE))
+
+    kb = KnowledgeBase(path, EMBEDDER.name, EMBEDDER.dim)
+    kb.load()
+    hits, _ = kb.search("ERR-4021", None, k=1, mode="bm25")
+    assert hits[0]["text"] == TEXTS[1]
+    assert kb.docs == {f"doc-{i}": [i] for i in range(len(TEXTS))}
+    assert os.path.exists(os.path.join(path, BM25_META_FILE))
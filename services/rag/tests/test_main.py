@@ -0,0 +1,46 @@
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    corpus = tmp_path / "corpus"
+    corpus.mkdir()
+    monkeypatch.setattr(main, "CORPUS_DIR", os.path.realpath(corpus))
+    monkeypatch.setattr(main, "RAG_ADMIN_TOKEN", "secret")
+    # No lifespan: nothing here may reach the knowledge base
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("method, path, body", [
+    ("post", "/ingest", {"paths": ["docs"]}),
+    ("post", "/admin/reload", None),
+    ("post", "/admin/compact", None),
+])
+def test_admin_endpoints_need_the_token(client, monkeypatch, method, path, body):
+    assert client.request(method, path, json=body).status_code == 401
+    response = client.request(method, path, json=body, headers={"Authorization": "Bearer wrong"})
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+    monkeypatch.setattr(main, "RAG_ADMIN_TOKEN", "")
+    response = client.request(method, path, json=body, headers={"Authorization": "Bearer "})
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize("path", ["/etc", "../outside", "docs/../../outside", "escape/passwd"])
+def test_ingest_paths_must_stay_inside_the_corpus_dir(client, tmp_path, path):
+    os.symlink("/etc", tmp_path / "corpus" / "escape")
+    response = client.post("/ingest", json={"paths": ["docs", path]}, headers={"Authorization": "Bearer secret"})
+    assert response.status_code == 400
+    assert main.ingest_task is None
+
+
+def test_relative_paths_are_taken_from_the_corpus_dir(client, tmp_path):
+    corpus = main.CORPUS_DIR
+    assert main.in_corpus_dir("docs/a.jsonl") == os.path.join(corpus, "docs", "a.jsonl")
+    assert main.in_corpus_dir(os.path.join(corpus, "b.md")) == os.path.join(corpus, "b.md")
+    assert main.in_corpus_dir(corpus + "-other/c.md") is None
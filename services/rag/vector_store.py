@@ -0,0 +1,349 @@
+"""
+Memory-mapped vector index
+Embeddings are one flat float16/float32 row-major file opened with
+np.memmap: loading is instant, pages come in on demand, and every worker
+process shares them through the page cache. Chunk texts live in a JSONL
+file with a byte-offset table, so only the top-k texts are ever read.
+
+Search is a blocked matrix-vector product with argpartition top-k. For
+large corpora an optional IVF layout stores rows grouped by k-means
+cluster, so a query scans only the contiguous row ranges of the nprobe
+clusters nearest to it.
+
+Index directory layout:
+    meta.json     count, dim, dtype, embedder, nlist
+    vectors.bin   count x dim unit vectors (IVF: in cluster order)
+    rows.bin      int64 chunk id of each row (IVF only)
+    ivf.npz       centroids and per-cluster row offsets (IVF only)
+    chunks.jsonl  one {"text", "metadata"} object per chunk id
+    offsets.bin   uint64 byte offset of each chunk line, plus the end
+"""
+
+import itertools
+import json
+import math
+import mmap
+import os
+import shutil
+import time
+from typing import Iterable, Optional
+
+import numpy as np
+
+from embeddings import normalize
+
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.bin"
+ROWS_FILE = "rows.bin"
+IVF_FILE = "ivf.npz"
+CHUNKS_FILE = "chunks.jsonl"
+OFFSETS_FILE = "offsets.bin"
+
+# Rows scored per matrix-vector product; bounds the float32 copy of a float16 block
+BLOCK_ROWS = 16384
+# Below this many chunks an exact scan is fast enough that IVF is not worth its recall loss
+IVF_MIN_CHUNKS = 200_000
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, without sorting everything"""
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def default_nlist(count: int) -> int:
+    """Number of IVF clusters for a corpus, 0 for an exact index"""
+    if count < IVF_MIN_CHUNKS:
+        return 0
+    return int(4 * math.sqrt(count))
+
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int = 10, sample_size: int = 65536, seed: int = 0) -> np.ndarray:
+    """Spherical k-means on a sample of unit vectors; returns unit centroids"""
+    rng = np.random.default_rng(seed)
+    size = min(sample_size, len(vectors))
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(size, k, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        centroids = normalize(sums)
+        # Reseed clusters that lost all their points
+        empty = np.bincount(assignment, minlength=k) == 0
+        if empty.any():
+            centroids[empty] = sample[rng.choice(size, int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_clusters(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Nearest centroid of every vector, computed block by block"""
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + BLOCK_ROWS], dtype=np.float32)
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
+
+
+class IndexWriter:
+    """
+    Streams chunks and their vectors into a new index directory.
+
+    Rows are appended as float32 to a raw file as they arrive, so memory
+    use does not depend on corpus size; finish() picks the layout once the
+    count is known. flush() returns a resumable state: a writer created
+    with it truncates the files back to that point and carries on.
+    """
+
+    RAW_VECTORS_FILE = "vectors.raw"
+
+    def __init__(self, directory: str, dim: int, embedder: str, state: Optional[dict] = None):
+        self.directory = directory
+        self.dim = dim
+        self.embedder = embedder
+        os.makedirs(directory, exist_ok=True)
+        self.count = state["count"] if state else 0
+        self._chunk_bytes = state["chunk_bytes"] if state else 0
+        self._vectors = self._open(self.RAW_VECTORS_FILE, self.count * dim * 4)
+        self._chunks = self._open(CHUNKS_FILE, self._chunk_bytes)
+        self._offsets = self._open(OFFSETS_FILE, (self.count + 1) * 8 if state else 0)
+        if not state:
+            self._offsets.write(np.uint64(0).tobytes())
+
+    def _open(self, name: str, size: int):
+        path = os.path.join(self.directory, name)
+        f = open(path, "r+b" if os.path.exists(path) else "w+b")
+        f.truncate(size)
+        f.seek(size)
+        return f
+
+    def add(self, vectors: np.ndarray, chunks: list[dict]):
+        if len(vectors) != len(chunks):
+            raise ValueError(f"Got {len(chunks)} chunks for {len(vectors)} vectors")
+        if not len(chunks):
+            return
+        self._vectors.write(normalize(np.asarray(vectors, dtype=np.float32)).tobytes())
+        offsets = []
+        for chunk in chunks:
+            line = json.dumps(
+                {"text": chunk["text"], "metadata": chunk.get("metadata", {})}, ensure_ascii=False
+            ).encode("utf-8") + b"\n"
+            self._chunks.write(line)
+            self._chunk_bytes += len(line)
+            offsets.append(self._chunk_bytes)
+        self._offsets.write(np.asarray(offsets, dtype=np.uint64).tobytes())
+        self.count += len(chunks)
+
+    def flush(self) -> dict:
+        """Make everything added so far durable and return the state to resume from"""
+        for f in (self._vectors, self._chunks, self._offsets):
+            f.flush()
+            os.fsync(f.fileno())
+        return {"count": self.count, "chunk_bytes": self._chunk_bytes}
+
+    def finish(self, dtype: Optional[str] = None, nlist: Optional[int] = None):
+        """
+        Write the final vector layout and metadata.
+
+        Args:
+            dtype: "float16" halves memory and I/O at negligible recall cost but
+                every scanned row has to be widened; None picks float16 for IVF
+                (which scans a small slice) and float32 for exact indexes
+            nlist: IVF clusters; None picks from corpus size, 0 forces exact search
+        """
+        self.flush()
+        for f in (self._vectors, self._chunks, self._offsets):
+            f.close()
+        count = self.count
+        if nlist is None:
+            nlist = default_nlist(count)
+        nlist = min(nlist, count)
+        if dtype is None:
+            dtype = "float16" if nlist else "float32"
+
+        raw_path = os.path.join(self.directory, self.RAW_VECTORS_FILE)
+        vectors_path = os.path.join(self.directory, VECTORS_FILE)
+        raw = np.memmap(raw_path, dtype=np.float32, mode="r", shape=(count, self.dim)) if count else \
+            np.zeros((0, self.dim), dtype=np.float32)
+        if nlist:
+            centroids = kmeans(raw, nlist)
+            assignment = assign_clusters(raw, centroids)
+            order = np.argsort(assignment, kind="stable")
+            list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+            np.savez(os.path.join(self.directory, IVF_FILE), centroids=centroids, list_offsets=list_offsets)
+            order.astype(np.int64).tofile(os.path.join(self.directory, ROWS_FILE))
+        else:
+            order = None
+        if order is None and dtype == "float32":
+            del raw
+            os.replace(raw_path, vectors_path)
+        else:
+            # Rewrite block by block in cluster order and/or the narrower dtype
+            with open(vectors_path, "wb") as f:
+                for start in range(0, count, BLOCK_ROWS):
+                    rows = slice(start, start + BLOCK_ROWS) if order is None else order[start:start + BLOCK_ROWS]
+                    f.write(np.asarray(raw[rows]).astype(dtype).tobytes())
+            del raw
+            os.remove(raw_path)
+
+        meta = {
+            "count": count,
+            "dim": self.dim,
+            "dtype": dtype,
+            "embedder": self.embedder,
+            "nlist": nlist,
+            "created_at": time.time(),
+        }
+        with open(os.path.join(self.directory, META_FILE), "w") as f:
+            json.dump(meta, f)
+
+
+def publish_index(building: str, path: str):
+    """Swap a finished index directory in at path with renames, so readers never see a partial index"""
+    previous = path.rstrip("/") + ".previous"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, previous)
+    os.rename(building, path)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def write_index(
+    path: str,
+    vectors: np.ndarray,
+    chunks: Iterable[dict],
+    embedder: str,
+    dtype: Optional[str] = None,
+    nlist: Optional[int] = None,
+):
+    """
+    Write an index directory, replacing any existing one at path.
+
+    Args:
+        path: Index directory
+        vectors: (count, dim) passage embeddings, chunk id = row number
+        chunks: {"text": ..., "metadata": {...}} per row, in the same order
+        embedder: Name of the embedder that produced the vectors
+        dtype: Row dtype, see IndexWriter.finish
+        nlist: IVF clusters, see IndexWriter.finish
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    building = path.rstrip("/") + ".building"
+    shutil.rmtree(building, ignore_errors=True)
+    writer = IndexWriter(building, vectors.shape[1], embedder)
+    chunks = iter(chunks)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = vectors[start:start + BLOCK_ROWS]
+        writer.add(block, list(itertools.islice(chunks, len(block))))
+    if next(chunks, None) is not None:
+        raise ValueError(f"Got more chunks than the {len(vectors)} vectors")
+    writer.finish(dtype=dtype, nlist=nlist)
+    publish_index(building, path)
+
+
+class VectorIndex:
+    """Read-only view of an index directory"""
+
+    def __init__(self, path: str, nprobe: int = 8):
+        self.path = path
+        self.nprobe = nprobe
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.count = self.meta["count"]
+        self.dim = self.meta["dim"]
+        self.embedder = self.meta["embedder"]
+        self.nlist = self.meta.get("nlist", 0)
+
+        dtype = np.dtype(self.meta["dtype"])
+        if self.count:
+            self.vectors = np.memmap(
+                os.path.join(path, VECTORS_FILE), dtype=dtype, mode="r", shape=(self.count, self.dim)
+            )
+        else:
+            self.vectors = np.zeros((0, self.dim), dtype=dtype)
+        self.offsets = np.fromfile(os.path.join(path, OFFSETS_FILE), dtype=np.uint64)
+
+        self.rows: Optional[np.ndarray] = None
+        self.centroids: Optional[np.ndarray] = None
+        self.list_offsets: Optional[np.ndarray] = None
+        # Row of each chunk id, the inverse of rows; built on first use
+        self._positions: Optional[np.ndarray] = None
+        if self.nlist:
+            self.rows = np.memmap(os.path.join(path, ROWS_FILE), dtype=np.int64, mode="r", shape=(self.count,))
+            with np.load(os.path.join(path, IVF_FILE)) as ivf:
+                self.centroids = ivf["centroids"]
+                self.list_offsets = ivf["list_offsets"]
+
+        self._chunks_file = open(os.path.join(path, CHUNKS_FILE), "rb")
+        self._chunks = (
+            mmap.mmap(self._chunks_file.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b""
+        )
+
+    @property
+    def kind(self) -> str:
+        return "ivf" if self.nlist else "exact"
+
+    def _row_ranges(self, query: np.ndarray, nprobe: int) -> list[tuple[int, int]]:
+        if not self.nlist or nprobe >= self.nlist:
+            return [(0, self.count)]
+        probe = top_k_indices(self.centroids @ query, nprobe)
+        return [(int(self.list_offsets[c]), int(self.list_offsets[c + 1])) for c in np.sort(probe)]
+
+    def search(self, query: np.ndarray, k: int = 5, nprobe: Optional[int] = None) -> list[tuple[int, float]]:
+        """
+        Find the k chunks most similar to a query embedding.
+
+        Args:
+            query: (dim,) query embedding
+            k: Results to return
+            nprobe: IVF clusters to scan (default self.nprobe); ignored for exact indexes
+
+        Returns:
+            (chunk id, cosine similarity) pairs, best first
+        """
+        query = normalize(np.asarray(query, dtype=np.float32).reshape(-1))
+        # float16 rows are widened block by block: BLAS only multiplies float32
+        widened = None if self.vectors.dtype == np.float32 else np.empty((BLOCK_ROWS, self.dim), np.float32)
+        rows, scores = [], []
+        for start, end in self._row_ranges(query, nprobe or self.nprobe):
+            for block_start in range(start, end, BLOCK_ROWS):
+                block = self.vectors[block_start:min(block_start + BLOCK_ROWS, end)]
+                if widened is not None:
+                    np.copyto(widened[:len(block)], block)
+                    block = widened[:len(block)]
+                block_scores = block @ query
+                top = top_k_indices(block_scores, k)
+                rows.append(top + block_start)
+                scores.append(block_scores[top])
+        if not rows:
+            return []
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        best = top_k_indices(scores, k)
+        ids = rows[best] if self.rows is None else self.rows[rows[best]]
+        return [(int(chunk_id), float(score)) for chunk_id, score in zip(ids, scores[best])]
+
+    def vectors_for(self, chunk_ids: np.ndarray) -> np.ndarray:
+        """float32 embeddings of the given chunks, in the given order"""
+        rows = np.asarray(chunk_ids, dtype=np.int64)
+        if self.rows is not None:
+            if self._positions is None:
+                positions = np.empty(self.count, dtype=np.int64)
+                positions[self.rows] = np.arange(self.count)
+                self._positions = positions
+            rows = self._positions[rows]
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def chunk(self, chunk_id: int) -> dict:
+        """Text and metadata of a chunk, read straight from the mapped file"""
+        start, end = int(self.offsets[chunk_id]), int(self.offsets[chunk_id + 1])
+        return json.loads(self._chunks[start:end])
+
+    def close(self):
+        if isinstance(self._chunks, mmap.mmap):
+            self._chunks.close()
+        self._chunks_file.close()